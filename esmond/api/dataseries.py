@@ -278,51 +278,128 @@ def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
     {120: 33, 180: 1, 90: 33, 60: 0, 150: 33}
     """
 
+    return fit_delta_to_bins(bin_layout(freq, ts_prev, ts_curr),
+            val_curr - val_prev)
+
+class BinLayout(object):
+    """The bins and per-bin fractions for one pair of timestamps.
+
+    The layout depends only on the bin frequency and the two timestamps, not
+    on the counter values, so when many counters were sampled at the same
+    times (all the interfaces in one PollResult for instance) it can be
+    computed once and shared with fit_delta_to_bins().
+
+    bins is the bins in order: bin_prev, the mid bins and bin_curr.
+    """
+    __slots__ = ('bin_prev', 'bin_curr', 'frac_prev', 'frac_curr',
+            'mid_bins', 'frac_mid', 'fractions', 'bins', '_order')
+
+    def __init__(self, bin_prev, bin_curr, frac_prev=None, frac_curr=None,
+            mid_bins=(), frac_mid=None):
+        self.bin_prev = bin_prev
+        self.bin_curr = bin_curr
+        self.frac_prev = frac_prev
+        self.frac_curr = frac_curr
+        self.mid_bins = mid_bins
+        self.frac_mid = frac_mid
+
+        self.fractions = [(bin_prev, frac_prev), (bin_curr, frac_curr)]
+        if mid_bins:
+            frac_per_midbin = frac_mid / len(mid_bins)
+            for b in mid_bins:
+                self.fractions.append((b, frac_per_midbin))
+
+        if bin_prev == bin_curr:
+            self.bins = (bin_prev,)
+        else:
+            self.bins = (bin_prev,) + tuple(mid_bins) + (bin_curr,)
+
+        self._order = {}
+
+    def by_fraction(self, reverse):
+        """Bins ordered by fraction, used to hand out the remainder."""
+        return [self.bins[i] for i in self.order(reverse)]
+
+    def order(self, reverse):
+        """Like by_fraction() but indexes into bins."""
+        try:
+            return self._order[reverse]
+        except KeyError:
+            pass
+
+        # The same order as a stable sort of fractions (bin_prev, bin_curr,
+        # then the mid bins), without sorting the mid bins since they all
+        # have the same fraction.
+        n = len(self.bins)
+        ends = sorted([(0, self.frac_prev), (n - 1, self.frac_curr)],
+                key=lambda x: x[1], reverse=reverse)
+
+        if not self.mid_bins:
+            order = [i for i, frac in ends]
+        else:
+            frac_mid = self.fractions[2][1]
+            if reverse:
+                first = [i for i, frac in ends if frac >= frac_mid]
+                last = [i for i, frac in ends if frac < frac_mid]
+            else:
+                first = [i for i, frac in ends if frac <= frac_mid]
+                last = [i for i, frac in ends if frac > frac_mid]
+            order = first + range(1, n - 1) + last
+
+        self._order[reverse] = order
+        return order
+
+def bin_layout(freq, ts_prev, ts_curr):
+    """Compute the BinLayout for samples at ts_prev and ts_curr."""
     assert ts_curr > ts_prev
 
     bin_prev = ts_prev - (ts_prev % freq)
     bin_mid = (ts_prev + freq) - (ts_prev % freq)
     bin_curr = ts_curr - (ts_curr % freq)
 
-    delta_t = ts_curr - ts_prev
-    delta_v = val_curr - val_prev
-
     # if samples are less than freq apart and both in the same bin
     # all of the data goes into the same bin
     if bin_curr == bin_prev:
-        return {bin_prev: delta_v}
+        return BinLayout(bin_prev, bin_curr)
 
     assert bin_prev < bin_mid <= bin_curr
 
+    delta_t = ts_curr - ts_prev
+
     frac_prev = (bin_mid - ts_prev)/float(delta_t)
     frac_curr = (ts_curr - bin_curr)/float(delta_t)
 
-    p = int(round(frac_prev * delta_v))
-    c = int(round(frac_curr * delta_v))
+    mid_bins = ()
+    frac_mid = None
+    if bin_curr - bin_mid > 0:
+        frac_mid = (bin_curr - bin_mid)/float(delta_t)
+        mid_bins = range(bin_mid, bin_curr, freq)
+
+    return BinLayout(bin_prev, bin_curr, frac_prev, frac_curr, mid_bins,
+            frac_mid)
 
-    # updates maps bins to byte deltas
-    updates = {}
-    updates[bin_prev] = p
-    updates[bin_curr] = c
+def fit_increments(layout, delta_v):
+    """Distribute delta_v over the bins in layout.
 
-    fractions = []
-    fractions.append((bin_prev, frac_prev))
-    fractions.append((bin_curr, frac_curr))
+    Returns a list of increments parallel to layout.bins."""
 
-    if bin_curr - bin_mid > 0:
-        frac_mid = (bin_curr - bin_mid)/float(delta_t)
-        m = frac_mid * delta_v
-        n_mid_bins = (bin_curr-bin_mid)/freq
-        m_per_midbin = int(round(m / n_mid_bins))
-        frac_per_midbin = frac_mid / n_mid_bins
+    if len(layout.bins) == 1:
+        return [delta_v]
+
+    n = len(layout.bins)
+    incrs = [0] * n
+    incrs[0] = int(round(layout.frac_prev * delta_v))
+    incrs[-1] = int(round(layout.frac_curr * delta_v))
 
-        for b in range(bin_mid, bin_curr, freq):
-            updates[b] = m_per_midbin
-            fractions.append((b, frac_per_midbin))
+    if layout.mid_bins:
+        m = layout.frac_mid * delta_v
+        incrs[1:-1] = [int(round(m / len(layout.mid_bins)))] * (n - 2)
 
-    remainder = delta_v - sum(updates.itervalues())
+    remainder = delta_v - sum(incrs)
     if remainder != 0:
-        #print "%d bytes left over, %d bins" % (remainder, len(updates))
+        # The remainder is handed out a unit at a time to the bins in order
+        # of their fractions, wrapping around, so every bin gets 
+        # abs(remainder) / n and the first abs(remainder) % n get one more.
         if remainder > 0:
             incr = 1
             reverse = True
@@ -330,10 +407,56 @@ def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
             incr = -1
             reverse = False
 
-        fractions.sort(key=lambda x: x[1], reverse=reverse)
-        for i in range(abs(remainder)):
-            b = fractions[i % len(updates)][0]
-            updates[b] += incr
+        rounds, extra = divmod(abs(remainder), n)
+        order = layout.order(reverse)
+        if rounds:
+            for i in order:
+                incrs[i] += incr * rounds
+        for i in order[:extra]:
+            incrs[i] += incr
 
-    return updates
+    return incrs
 
+def fit_delta_to_bins(layout, delta_v):
+    """Distribute delta_v over the bins in layout.
+
+    Returns the same dictionary fit_to_bins() does."""
+
+    return dict(zip(layout.bins, fit_increments(layout, delta_v)))
+
+def fit_to_bins_series(freq, timestamps, vals):
+    """Fit a whole series of counter measurements into bins.
+
+    timestamps and vals are parallel sequences of integer timestamps and
+    counter values.  Each pair of successive measurements is fitted as
+    fit_to_bins() would and the result is returned as two parallel lists,
+    the bins and the amounts to increment them by, pair by pair with the
+    bins of each pair in order.
+
+    The layout of a pair only depends on how far apart the timestamps are
+    and where in its bin the first one falls, so for regularly polled data
+    nearly every pair shares a layout with the one before.
+
+    >>> fit_to_bins_series(30, [0, 30, 62], [0, 100, 213])
+    ([0, 30, 30, 60], [100, 0, 106, 7])
+    """
+    bins = []
+    incrs = []
+    layouts = {}
+
+    for i in xrange(1, len(timestamps)):
+        ts_prev = timestamps[i-1]
+        delta_t = timestamps[i] - ts_prev
+        offset = ts_prev % freq
+        base = ts_prev - offset
+
+        # The layout relative to the bin ts_prev is in.
+        key = (offset, delta_t)
+        layout = layouts.get(key)
+        if layout is None:
+            layout = layouts[key] = bin_layout(freq, offset, offset + delta_t)
+
+        bins.extend([b + base for b in layout.bins])
+        incrs.extend(fit_increments(layout, vals[i] - vals[i-1]))
+
+    return bins, incrs
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryTableDigest',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('device_name', models.CharField(max_length=256)),
+                ('table', models.CharField(max_length=64)),
+                ('digest', models.CharField(max_length=40)),
+                ('updated', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'historytabledigest',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='historytabledigest',
+            unique_together=set([('device_name', 'table')]),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_historytabledigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceLease',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('device_name', models.CharField(unique=True, max_length=256)),
+                ('owner', models.CharField(max_length=256)),
+                ('expires', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'devicelease',
+            },
+        ),
+        migrations.CreateModel(
+            name='PollerInstance',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=256)),
+                ('heartbeat', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'pollerinstance',
+            },
+        ),
+    ]
@@ -379,6 +379,49 @@ class LSPOpStatus(models.Model):
     def __unicode__(self):
         return "%s %s" % (self.device, self.name)
 
+class HistoryTableDigest(models.Model):
+    """Digest of the last poll result applied to a history table for a
+    device, used by the history table persisters to skip unchanged
+    results."""
+    device_name = models.CharField(max_length=256)
+    table = models.CharField(max_length=64)
+    digest = models.CharField(max_length=40)
+    updated = models.DateTimeField()
+
+    class Meta:
+        app_label = 'api'
+        db_table = "historytabledigest"
+        unique_together = (('device_name', 'table'),)
+
+    def __unicode__(self):
+        return "%s %s: %s" % (self.device_name, self.table, self.digest)
+
+class PollerInstance(models.Model):
+    """An espolld instance taking part in dividing up the devices, see
+    :py:mod:`esmond.lease`."""
+    name = models.CharField(max_length=256, unique=True)
+    heartbeat = models.DateTimeField()
+
+    class Meta:
+        app_label = 'api'
+        db_table = "pollerinstance"
+
+    def __unicode__(self):
+        return "%s %s" % (self.name, self.heartbeat)
+
+class DeviceLease(models.Model):
+    """The espolld instance that polls a device until the lease expires."""
+    device_name = models.CharField(max_length=256, unique=True)
+    owner = models.CharField(max_length=256)
+    expires = models.DateTimeField()
+
+    class Meta:
+        app_label = 'api'
+        db_table = "devicelease"
+
+    def __unicode__(self):
+        return "%s %s until %s" % (self.device_name, self.owner, self.expires)
+
 class APIPermissionManager(models.Manager):
     def get_query_set(self):
         return super(APIPermissionManager, self).\
@@ -0,0 +1,65 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from esmond.cache_snapshot import read_snapshot, write_snapshot, SnapshotError
+
+class TestCacheSnapshot(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'test.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_round_trip(self):
+        ts = 1343955624000
+        metadata = {
+            'snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0/0/0:30000': dict(
+                path=['snmp', 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'xe-0/0/0'],
+                freq=30000, last_update=ts, min_ts=ts - 30000,
+                last_val=2**64 - 1),
+            u'snmp:rtr_d:SparkySet:outletLoadValue:a\\:\xe9:30000': dict(
+                path=['snmp', 'rtr_d', 'SparkySet', 'outletLoadValue', 
+                    'a:\xc3\xa9'],
+                freq=30000,
+                last_update=datetime.datetime.utcfromtimestamp(ts/1000),
+                min_ts=datetime.datetime.utcfromtimestamp(ts/1000),
+                last_val=1.5),
+        }
+        aggregation = {
+            'snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0/0/0:3600000:2012': {
+                1343955600000: {'min': 0, 'max': 7500, 'min_ts': ts,
+                    'max_ts': ts + 30000},
+            },
+        }
+
+        write_snapshot(self.filename, metadata, aggregation, clean=True)
+        snapshot = read_snapshot(self.filename)
+
+        self.assertTrue(snapshot.clean)
+        self.assertEqual(snapshot.aggregation, aggregation)
+        self.assertEqual(len(snapshot.metadata), 2)
+        # The keys come back as utf-8 strs like the ones in the caches.
+        for k in snapshot.metadata.keys() + snapshot.aggregation.keys():
+            self.assertTrue(isinstance(k, str))
+        for k, v in metadata.iteritems():
+            r = snapshot.metadata[k.encode('utf-8')]
+            self.assertEqual(r['path'], v['path'])
+            self.assertEqual(r['freq'], v['freq'])
+            self.assertEqual(r['last_val'], v['last_val'])
+            self.assertEqual(r['last_update'], ts)
+
+        write_snapshot(self.filename, metadata, {})
+        self.assertFalse(read_snapshot(self.filename).clean)
+
+    def test_bad_snapshot(self):
+        self.assertIsNone(read_snapshot(self.filename))
+
+        write_snapshot(self.filename, {}, {})
+        data = open(self.filename).read()
+        open(self.filename, 'w').write('XXXX' + data[4:])
+        self.assertRaises(SnapshotError, read_snapshot, self.filename)
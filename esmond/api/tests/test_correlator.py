@@ -1,7 +1,7 @@
 from django.test import TestCase
 from esmond.poll import IfNameCorrelator, JnxFirewallCorrelator, \
                             JnxCOSCorrelator, SentryCorrelator, \
-                            ALUSAPCorrelator
+                            ALUSAPCorrelator, PollData, filter_data
 class MockSession(object):
     def walk(self, oid):
         if oid == 'ifName':
@@ -111,9 +111,29 @@ class TestCorrelators(TestCase):
             for oid_name in c.oids:
                 setup_data.extend(s.walk(oid_name))
 
-            c.setup(setup_data)
-            for (var,val,check) in s.walk(oid.name):
-                self.assertEqual(check, c.lookup(oid, var))
+            for data in (setup_data, PollData(setup_data)):
+                c.setup(data)
+                for (var,val,check) in s.walk(oid.name):
+                    self.assertEqual(check, c.lookup(oid, var))
+
+class TestPollData(TestCase):
+    def test_filter_data(self):
+        s = MockSession()
+        data = []
+        for oid_name in ('ifName', 'ifAlias', 'ifHCInOctets',
+                'jnxCosIfqQedBytes', 'outletName', 'outletLoadValue'):
+            data.extend([x[:2] for x in s.walk(oid_name)])
+        indexed = PollData(data)
+
+        # whole columns, prefixes of several columns, names that include
+        # part of the index and names that aren't there
+        for name in ('ifName', 'ifAlias', 'ifHCInOctets', 'jnxCosIfqQedBytes',
+                'ifHC', 'outlet', 'if', '', 'ifName.116',
+                'jnxCosIfqQedBytes.117."', 'ifDescr', 'ifNames'):
+            self.assertEqual(filter_data(name, data),
+                    filter_data(name, indexed))
+
+        self.assertEqual(indexed, data)
 
 #def test_jnx_cos_correlator():
 #    s = MockSession()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from esmond.hashring import HashRing, plan_moves, read_balance, \
+     write_balance_file, set_active_workers
+
+class TestHashRing(TestCase):
+    def test_consistent(self):
+        keys = ['FastPollHC:rtr_%d' % i for i in range(1000)]
+        ring = HashRing(dict((i, 1.0) for i in range(1, 5)))
+        bigger = HashRing(dict((i, 1.0) for i in range(1, 6)))
+
+        for k in keys:
+            self.assertEqual(ring.get_worker(k), ring.get_worker(k))
+            # Adding a worker only moves keys to the new worker.
+            if ring.get_worker(k) != bigger.get_worker(k):
+                self.assertEqual(bigger.get_worker(k), 5)
+
+        ring = HashRing({1: 1.0, 2: 0})
+        self.assertEqual(set(ring.get_worker(k) for k in keys), set([1]))
+
+    def test_plan_moves(self):
+        costs = {
+            1: {'hot': 0.4, 'a': 0.05, 'b': 0.05},
+            2: {'c': 0.1},
+            3: {},
+        }
+        moves = plan_moves(costs, [1, 2, 3])
+        self.assertEqual(moves[0], ('hot', 1, 3))
+
+        load = {1: 0.5, 2: 0.1, 3: 0.0}
+        for key, src, dst in moves:
+            cost = [c[key] for c in costs.values() if key in c][0]
+            load[src] -= cost
+            load[dst] += cost
+        # The hot key ends up on its own.
+        self.assertAlmostEqual(max(load.values()), 0.4)
+
+        self.assertEqual(plan_moves({1: {'a': 0.1}, 2: {'b': 0.1}}, [1, 2]),
+                [])
+
+    def test_set_active_workers(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'cassandra.balance')
+            write_balance_file(filename, {2: 0.5},
+                    {'FastPollHC:rtr_a': 2, 'FastPollHC:rtr_b': 4})
+
+            set_active_workers(filename, 4, 2, now=1000)
+            weights, overrides, handoff = read_balance(filename)
+            self.assertEqual(weights, {2: 0.5, 3: 0.0, 4: 0.0})
+            self.assertEqual(overrides, {'FastPollHC:rtr_a': 2})
+            # The keys are handed off from the old assignment.
+            self.assertEqual(handoff, dict(weights={2: 0.5},
+                overrides={'FastPollHC:rtr_a': 2, 'FastPollHC:rtr_b': 4},
+                since=1000, fences={}))
+
+            ring = HashRing(dict((w, weights.get(w, 1.0))
+                                for w in range(1, 5)))
+            keys = ['FastPollHC:rtr_%d' % i for i in range(1000)]
+            self.assertEqual(set(ring.get_worker(k) for k in keys),
+                    set([1, 2]))
+
+            set_active_workers(filename, 4, 3, now=1010)
+            weights, overrides, handoff = read_balance(filename)
+            self.assertEqual(weights, {2: 0.5, 3: 1.0, 4: 0.0})
+            # Still from the assignment before the first change.
+            self.assertEqual(handoff['weights'], {2: 0.5})
+            self.assertEqual(handoff['since'], 1010)
+
+            # Nothing changes, nothing to hand off.
+            write_balance_file(filename, weights, overrides)
+            set_active_workers(filename, 4, 3)
+            self.assertIsNone(read_balance(filename)[2])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,71 @@
+import json
+
+from django.test import TestCase
+
+from esmond.cassandra import DatabaseMetrics
+from esmond.metrics import LogHistogram
+
+class TestLogHistogram(TestCase):
+    def test_percentile(self):
+        h = LogHistogram()
+        self.assertEqual(h.percentile(99), 0)
+
+        for i in range(1, 1001):
+            h.add(i / 1000.0)
+        self.assertEqual(h.count, 1000)
+        self.assertAlmostEqual(h.mean(), 0.5005)
+        self.assertEqual(h.max, 1.0)
+
+        for p in (50, 90, 99):
+            # within the width of a bucket
+            self.assertTrue(p / 100.0 <= h.percentile(p) < p / 100.0 * 1.19)
+        self.assertEqual(h.percentile(100), 1.0)
+
+        h.add(0)
+        h.add(1e9)
+        self.assertEqual(h.count, 1002)
+
+    def test_merge(self):
+        a = LogHistogram()
+        b = LogHistogram()
+        for i in range(100):
+            a.add(0.001)
+            b.add(2.0)
+
+        c = LogHistogram.from_dict(json.loads(json.dumps(a.to_dict())))
+        self.assertEqual(c.counts, a.counts)
+        c.merge(b)
+        self.assertEqual(c.count, 200)
+        self.assertEqual(c.max, 2.0)
+        self.assertTrue(c.percentile(50) < 0.0012)
+        self.assertTrue(c.percentile(51) > 1.9)
+
+class TestDatabaseMetrics(TestCase):
+    def test_sampling(self):
+        metrics = DatabaseMetrics(sample_every=10)
+        self.assertTrue(metrics.enabled)
+
+        for i in range(10000):
+            metrics.raw_insert(0.001, 5)
+        metrics.query_raw(0.5, 100)
+
+        stats = metrics.snapshot(reset=True)
+        self.assertEqual(sorted(stats.keys()), ['query_raw', 'raw_insert'])
+        self.assertEqual(stats['raw_insert']['calls'], 10000)
+        self.assertEqual(stats['raw_insert']['items'], 50000)
+        latency = LogHistogram.from_dict(stats['raw_insert']['latency'])
+        # About one call in ten is timed.
+        self.assertTrue(800 < latency.count < 1200)
+        self.assertAlmostEqual(latency.percentile(99), 0.001)
+
+        self.assertEqual(metrics.snapshot(), {})
+        self.assertEqual(DatabaseMetrics().snapshot(), {})
+
+        # The running sums still work when profiling.
+        metrics = DatabaseMetrics(profiling=True, sample_every=1)
+        metrics.stat_fetch(0.25, 2)
+        metrics.stat_fetch(0.25, 2)
+        stats = metrics.snapshot()
+        self.assertEqual(stats['stat_fetch']['time'], 0.5)
+        self.assertEqual(stats['stat_fetch']['count'], 4)
+        self.assertEqual(stats['stat_fetch']['latency']['count'], 2)
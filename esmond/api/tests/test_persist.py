@@ -6,12 +6,15 @@ Replace this with more appropriate tests for your application.
 """
 
 import copy
+import mock
 import os
 import os.path
 import json
+import logging
 import datetime
 import calendar
 import shutil
+import tempfile
 import time
 
 import pprint
@@ -23,21 +26,32 @@ os.environ['ESMOND_UNIT_TESTS'] = 'True'
 
 from collections import namedtuple
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
 
 from rest_framework.test import APIClient
 
-from esmond.api.models import Device, IfRef, ALUSAPRef, OIDSet, DeviceOIDSetMap
+from esmond.api.models import Device, IfRef, ALUSAPRef, OIDSet, DeviceOIDSetMap, \
+     HistoryTableDigest
 
 from esmond.persist import IfRefPollPersister, ALUSAPRefPersister, \
-     PersistQueueEmpty, CassandraPollPersister
-from esmond.api.dataseries import fit_to_bins
+     PersistQueueEmpty, CassandraPollPersister, PollResult, \
+     MemcachedPersistQueue, WorkerScaler, PollPersister, latency_stats, \
+     PERSIST_MIN_SLEEP_TIME, PERSIST_SLEEP_TIME, MultiWorkerQueue, \
+     PersistManager
+from esmond.api.dataseries import fit_to_bins, fit_to_bins_series
+from esmond.hashring import HashRing, read_balance, read_balance_file, \
+     write_balance_file, set_active_workers
 from esmond.config import get_config, get_config_path
-from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD
+from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD, RawRateData, \
+     MutationBatcher, WritePipeline, DatabaseMetrics
 from esmond.util import max_datetime
 
 from pycassa.columnfamily import ColumnFamily
+from pycassa.pool import MaximumRetryException, AllServersUnavailable
+from pycassa.cassandra.ttypes import TimedOutException
 
 from esmond.api.tests.example_data import build_rtr_d_metadata, \
      build_metadata_from_test_data, load_test_data, build_rtr_alu_metadata
@@ -127,16 +141,235 @@ class TestPersistQueue(object):
     """Data is a list of dicts, representing the objects"""
     def __init__(self, data):
         self.data = data
+        self.count = 0
 
     def get(self):
         try:
-            return TestPollResult(self.data.pop(0))
+            val = TestPollResult(self.data.pop(0))
         except IndexError:
             raise PersistQueueEmpty()
+        self.count += 1
+        return val
+
+    def get_many(self, n):
+        if not self.data:
+            raise PersistQueueEmpty()
+        vals = [TestPollResult(d) for d in self.data[:n]]
+        del self.data[:n]
+        self.count += len(vals)
+        return vals
+
+    def position(self):
+        return None
+
+    def taken(self):
+        return self.count
+
+    def commit(self, position=None):
+        pass
+
+    def __len__(self):
+        return len(self.data)
 
 class MockConfig(object):
     def __init__(self):
         self.profile_persister = False
+        self.persist_balance_dir = None
+        self.persist_flush_threshold = 0
+        self.persist_idle_flush = 1.0
+        self.persist_stats_dir = None
+        self.persister_history_digests = False
+        self.debug = False
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class ScriptedPersistQueue(object):
+    """Returns batches of script[i] results from get_many(), an empty batch
+    for 0, and advances the clock by step for each get and by the timeout
+    for each wait."""
+    def __init__(self, clock, script, step=0.1):
+        self.clock = clock
+        self.script = list(script)
+        self.step = step
+        self.waits = []
+        self.gotten = 0
+
+    def get_many(self, n):
+        if not self.script:
+            raise PersistQueueEmpty()
+        self.clock.now += self.step
+        n = self.script.pop(0)
+        self.gotten += n
+        return [TestPollResult(dict(data=[1])) for i in range(n)]
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.clock.now += timeout
+
+    def position(self):
+        return None
+
+    def taken(self):
+        return self.gotten
+
+    def commit(self, position=None):
+        pass
+
+    def __len__(self):
+        return len(self.script)
+
+class FakeHandoffWatcher(object):
+    def __init__(self, fence):
+        self.current = fence
+        self.done = None
+        self.moved = False
+
+    def fence(self, now):
+        if self.current != self.done:
+            return self.current
+
+    def passed(self, fence):
+        self.done = fence
+        self.moved = True
+
+class FlushRecorder(PollPersister):
+    def __init__(self, config, persistq, clock):
+        PollPersister.__init__(self, config, "test", persistq)
+        self.clock = clock
+        self.stored = 0
+        self.flushes = []
+
+    def store(self, result):
+        self.stored += 1
+
+    def flush(self, full=False):
+        self.flushes.append((self.clock.now, self.stored, full))
+
+class TestPollPersisterRun(TestCase):
+    def _run(self, config, script, handoff=None):
+        clock = FakeClock()
+        q = ScriptedPersistQueue(clock, script)
+        with mock.patch('esmond.persist.time') as fake_time:
+            fake_time.time.side_effect = clock.time
+            p = FlushRecorder(config, q, clock)
+            p.handoff = handoff
+            p.run()
+        return p, q
+
+    def test_idle_flush(self):
+        config = MockConfig()
+        p, q = self._run(config, [5] + [0] * 20)
+
+        # The waits back off while the queue is empty.
+        self.assertEqual(q.waits[0], PERSIST_MIN_SLEEP_TIME)
+        for a, b in zip(q.waits, q.waits[1:]):
+            self.assertEqual(b, min(a * 2, PERSIST_SLEEP_TIME))
+
+        # One flush once the queue has been idle for persist_idle_flush
+        # seconds and the final one.
+        self.assertEqual(len(p.flushes), 2)
+        (t, stored, full), last = p.flushes
+        self.assertFalse(full)
+        self.assertEqual(stored, 5)
+        last_task = 1000.1
+        self.assertTrue(last_task + config.persist_idle_flush <= t <
+                last_task + config.persist_idle_flush + PERSIST_SLEEP_TIME)
+        self.assertTrue(last[2])
+
+        # Nothing to flush while the queue is busy.
+        p, q = self._run(config, [5] * 20)
+        self.assertEqual(len(p.flushes), 1)
+        self.assertEqual(q.waits, [])
+
+    def test_flush_threshold(self):
+        config = MockConfig()
+        config.persist_flush_threshold = 10
+        p, q = self._run(config, [4] * 6)
+
+        self.assertEqual([(stored, full) for t, stored, full in p.flushes],
+                [(12, False), (24, False), (24, True)])
+
+    def test_max_flush_interval(self):
+        config = MockConfig()
+        p, q = self._run(config, [1] * 1000)
+
+        # A queue that is never idle is still flushed now and then.
+        flushes = [t for t, stored, full in p.flushes if not full]
+        self.assertEqual(len(flushes), 1)
+        self.assertTrue(flushes[0] >= 1000 + p.MAX_FLUSH_INTERVAL)
+
+    def test_handoff_fence(self):
+        # Everything up to the fence is written as soon as it's taken.
+        p, q = self._run(MockConfig(), [4] * 5, FakeHandoffWatcher(10))
+        self.assertEqual([(stored, full) for t, stored, full in p.flushes],
+                [(12, True), (20, True)])
+
+class FakeMemcache(object):
+    def __init__(self, *args, **kwargs):
+        self.d = {}
+
+    def get(self, k):
+        return self.d.get(k)
+
+    def set(self, k, v):
+        self.d[k] = v
+        return True
+
+    def incr(self, k, n=1):
+        self.d[k] += n
+        return self.d[k]
+
+    def decr(self, k, n=1):
+        self.d[k] -= n
+        return self.d[k]
+
+    def get_multi(self, keys):
+        return dict((k, self.d[k]) for k in keys if k in self.d)
+
+    def set_multi(self, mapping):
+        self.d.update(mapping)
+        return []
+
+    def delete_multi(self, keys):
+        for k in keys:
+            del self.d[k]
+
+class TestMemcachedPersistQueue(TestCase):
+    def _results(self, first, n):
+        return [PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', t,
+            [], {}) for t in range(first, first + n)]
+
+    @mock.patch('esmond.persist.memcache.Client', FakeMemcache)
+    def test_unwritten(self):
+        q = MemcachedPersistQueue('test', None)
+        w = MemcachedPersistQueue('test', None)
+        w.mc = q.mc
+
+        # A writer has reserved qids 1-3 but not set them yet.
+        q.mc.incr(q.last_added, 3)
+        w.put_many(self._results(4, 2))
+        self.assertEqual(q.get_many(10), [])
+        self.assertEqual(len(q), 5)
+
+        mapping = dict(('_mcpq__test_%d' % qid, r.json())
+                for qid, r in enumerate(self._results(1, 3), 1))
+        q.mc.set_multi(mapping)
+        self.assertEqual([r.timestamp for r in q.get_many(10)],
+                [1, 2, 3, 4, 5])
+        self.assertEqual(q.taken(), 5)
+
+        # Skipped once it has been missing long enough.
+        q.mc.incr(q.last_added)
+        w.put_many(self._results(7, 1))
+        self.assertEqual(q.get_many(10), [])
+        q.MISSING_WAIT = 0
+        self.assertEqual([r.timestamp for r in q.get_many(10)], [7])
+        self.assertEqual(len(q), 0)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -182,6 +415,83 @@ class TestIfRefPersister(TestCase):
 
         self.assertTrue(ifrefs[1].end_time < max_datetime)
 
+    def test_persister_bulk(self):
+        """The number of queries doesn't depend on the number of rows."""
+        def ifref_result(n, alias):
+            data = dict(ifName=[], ipAdEntIfIndex=[], ifAlias=[])
+            for i in range(1, n + 1):
+                data['ifName'].append(['ifName.%d' % i, 'xe-0/0/%d' % i])
+                data['ifAlias'].append(['ifAlias.%d' % i, alias])
+            return dict(oidset_name='IfRefPoll', device_name='rtr_d',
+                    timestamp=1345125600, oid_name='', data=data)
+
+        def run_queries(results):
+            q = TestPersistQueue(results)
+            p = IfRefPollPersister(MockConfig(), "test", persistq=q)
+            with CaptureQueriesContext(connection) as ctx:
+                p.run()
+            return len(ctx)
+
+        run_queries([ifref_result(2, 'one')])
+        # Both of these end some rows and add some rows.
+        small = run_queries([ifref_result(2, 'two')])
+        big = run_queries([ifref_result(50, 'three')])
+        self.assertEqual(small, big)
+
+        ifrefs = IfRef.objects.filter(device__name="rtr_d")
+        self.assertEqual(ifrefs.count(), 54)
+        self.assertEqual(IfRef.objects.active().filter(
+            device__name="rtr_d").count(), 50)
+
+    def test_persister_digest(self):
+        """An unchanged result is skipped without any queries."""
+        results = json.loads(ifref_test_data)
+        q = TestPersistQueue([results[0]])
+        config = MockConfig()
+        config.persister_history_digests = True
+        p = IfRefPollPersister(config, "test", persistq=q)
+        p.run()
+        self.assertEqual(HistoryTableDigest.objects.filter(
+            device_name="rtr_d").count(), 1)
+
+        q.data = [results[0]]
+        with CaptureQueriesContext(connection) as ctx:
+            p.run()
+        self.assertEqual(len(ctx), 0)
+
+        # a new persister picks the digest up from the table
+        p = IfRefPollPersister(config, "test",
+                persistq=TestPersistQueue([results[0]]))
+        with CaptureQueriesContext(connection) as ctx:
+            p.run()
+        self.assertEqual(len(ctx), 1)
+
+        # and a changed result is applied
+        p.persistq = TestPersistQueue([results[1]])
+        p.run()
+        ifrefs = IfRef.objects.filter(device__name="rtr_d", ifName="Vlan1")
+        self.assertEqual(ifrefs.count(), 2)
+
+    def test_persister_digest_handoff(self):
+        """The digests are dropped when devices move to another worker."""
+        results = json.loads(ifref_test_data)
+        a = IfRefPollPersister(MockConfig(), "test_1",
+                persistq=TestPersistQueue([results[0]]))
+        a.run()
+
+        # rtr_d moves to b, which applies a change, and back again.
+        a.handoff = FakeHandoffWatcher(1)
+        a.run()
+        b = IfRefPollPersister(MockConfig(), "test_2",
+                persistq=TestPersistQueue([results[1]]))
+        b.run()
+
+        a.persistq.data = [dict(results[0], timestamp=1345125720)]
+        a.run()
+        ifrefs = IfRef.objects.filter(device__name="rtr_d", ifName="Vlan1")
+        self.assertEqual(ifrefs.count(), 3)
+        self.assertEqual(ifrefs.filter(end_time=max_datetime).count(), 1)
+
 
 alu_sap_test_data = """
 [
@@ -877,6 +1187,158 @@ class TestCassandraPollPersister(TestCase):
         p.db.flush()
         p.db.close()
 
+    def test_persister_batch_store(self):
+        """The batch store path should produce the same results."""
+        start_time = self.ctr.begin*1000
+        end_time = self.ctr.end*1000
+        path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','fxp0.0']
+
+        config = get_config(get_config_path())
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        config.db_clear_on_testing = True
+        config.persister_batch_store = True
+
+        q = TestPersistQueue(test_data)
+        p = CassandraPollPersister(config, "test", persistq=q)
+        p.run()
+        p.db.flush()
+
+        ret = p.db.query_baserate_timerange(path=path, freq=30*1000,
+                ts_min=start_time, ts_max=end_time)
+
+        self.assertEqual(len(ret), self.ctr.expected_results)
+        self.assertEqual(ret[0]['val'], self.ctr.base_rate_val_first)
+        self.assertEqual(ret[self.ctr.expected_results-1]['val'],
+                self.ctr.base_rate_val_last)
+
+        for cf, val in (('average', self.ctr.agg_avg),
+                ('min', self.ctr.agg_min), ('max', self.ctr.agg_max)):
+            ret = p.db.query_aggregation_timerange(path=path,
+                ts_min=start_time - 3600*1000, ts_max=end_time,
+                freq=self.ctr.agg_freq*1000, cf=cf)
+
+            self.assertEqual(ret[0]['cf'], cf)
+            self.assertEqual(ret[0]['val'], val)
+            self.assertEqual(ret[0]['ts'], self.ctr.agg_ts*1000)
+
+        p.db.close()
+        config.persister_batch_store = False
+
+    def test_prefetch_metadata(self):
+        """Prefetch seeds the metadata cache for a set of paths at once."""
+        config = get_config(get_config_path())
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        config.db_clear_on_testing = True
+
+        q = TestPersistQueue(test_data)
+        p = CassandraPollPersister(config, "test", persistq=q)
+        p.run()
+        p.db.flush()
+        p.db.close()
+
+        config.db_clear_on_testing = False
+        db = CASSANDRA_DB(config)
+
+        path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','fxp0.0']
+        new_path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','xe-9/9/9']
+        ts = self.ctr.raw_ts_last*1000 + 1
+
+        found = db.prefetch_metadata([path, new_path], 30*1000, ts, 90*1000)
+        self.assertEqual(found, 1)
+
+        meta = db.metadata_cache[':'.join(path + ['30000'])]
+        self.assertEqual(meta['last_update'], self.ctr.raw_ts_last*1000)
+        self.assertEqual(meta['last_val'], self.ctr.raw_val_last)
+
+        new_key = ':'.join(new_path + ['30000'])
+        self.assertFalse(db.metadata_cache.has_key(new_key))
+        self.assertTrue(db.metadata_absent.has_key(new_key))
+
+        db.close()
+
+    def test_rate_aggregation_buffer(self):
+        """Rate aggregation increments are combined per bin."""
+        config = get_config(get_config_path())
+        config.db_clear_on_testing = True
+        db = CASSANDRA_DB(config)
+        config.db_clear_on_testing = False
+
+        path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','xe-1/1/1']
+        agg_freq = 3600
+        bin_ts = self.ctr.agg_ts
+
+        for i in range(4):
+            ts = bin_ts + i*30
+            raw_data = RawRateData(path=path, ts=ts*1000, val=10, freq=30*1000)
+            db.update_rate_aggregation(raw_data, 
+                    datetime.datetime.utcfromtimestamp(bin_ts), agg_freq*1000)
+
+        self.assertEqual(len(db.agg_buffer), 1)
+        buf = db.agg_buffer.values()[0]
+        self.assertEqual(buf[0], bin_ts*1000)
+        self.assertEqual(buf[2], 40)
+        self.assertEqual(buf[3], 4)
+
+        # A value for the next bin writes out the previous one.
+        raw_data = RawRateData(path=path, ts=(bin_ts + agg_freq)*1000, val=5,
+                freq=30*1000)
+        db.update_rate_aggregation(raw_data, 
+                datetime.datetime.utcfromtimestamp(bin_ts + agg_freq),
+                agg_freq*1000)
+        self.assertEqual(db.agg_buffer.values()[0][2], 5)
+
+        db.flush()
+        self.assertEqual(len(db.agg_buffer), 0)
+
+        ret = db.query_aggregation_timerange(path=path,
+            ts_min=bin_ts*1000, ts_max=(bin_ts + agg_freq)*1000,
+            freq=agg_freq*1000, cf='raw')
+
+        self.assertEqual(len(ret), 2)
+        self.assertEqual(ret[0]['val'], 40)
+        self.assertEqual(ret[1]['val'], 5)
+
+        db.close()
+
+    def test_stat_aggregation_deferred(self):
+        """Stat aggregations are only written when the bin is flushed."""
+        config = get_config(get_config_path())
+        config.db_clear_on_testing = True
+        db = CASSANDRA_DB(config)
+        config.db_clear_on_testing = False
+
+        path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','xe-1/1/2']
+        agg_freq = 3600
+        bin_ts = self.ctr.agg_ts
+
+        for i, val in enumerate((10, 3, 25, 7)):
+            ts = bin_ts + i*30
+            raw_data = RawRateData(path=path, ts=ts*1000, val=val, freq=30*1000)
+            db.update_stat_aggregation(raw_data, 
+                    datetime.datetime.utcfromtimestamp(bin_ts), agg_freq*1000)
+
+        self.assertEqual(len(db.stat_dirty), 1)
+
+        ret = db.query_aggregation_timerange(path=path,
+            ts_min=bin_ts*1000, ts_max=bin_ts*1000,
+            freq=agg_freq*1000, cf='max')
+        self.assertEqual(len(ret), 0)
+
+        db.flush()
+        self.assertEqual(len(db.stat_dirty), 0)
+
+        ret = db.query_aggregation_timerange(path=path,
+            ts_min=bin_ts*1000, ts_max=bin_ts*1000,
+            freq=agg_freq*1000, cf='min')
+        self.assertEqual(ret[0]['val'], 3)
+
+        ret = db.query_aggregation_timerange(path=path,
+            ts_min=bin_ts*1000, ts_max=bin_ts*1000,
+            freq=agg_freq*1000, cf='max')
+        self.assertEqual(ret[0]['val'], 25)
+
+        db.close()
+
 
 class BaseTestCase(TestCase):
     def setUp(self):
@@ -1615,6 +2077,330 @@ class TestFitToBins(TestCase):
         self.assertEqual({1386369690000: 249747233}, r)
         self.assertLess(time.time()-t0, 0.5)
 
+        # a long gap spreads the remainder over thousands of bins
+        t0 = time.time()
+        r = fit_to_bins(30, 7, 0, 86407 + 7, 2880 * 1000 + 2000)
+        self.assertEqual(2880 * 1000 + 2000, sum(r.values()))
+        self.assertEqual(2881, len(r))
+        self.assertLess(time.time()-t0, 0.5)
+
+    def test_fit_to_bins_series(self):
+        freq = 30
+        timestamps = [0]
+        vals = [0]
+        for i in xrange(1, 500):
+            timestamps.append(timestamps[-1] + (i * 7919) % 97 + 1)
+            vals.append(vals[-1] + (i * 104729) % 10007)
+
+        bins, incrs = fit_to_bins_series(freq, timestamps, vals)
+        self.assertEqual(len(bins), len(incrs))
+
+        expected = []
+        for i in xrange(1, len(timestamps)):
+            r = fit_to_bins(freq, timestamps[i-1], vals[i-1], timestamps[i],
+                    vals[i])
+            expected.extend(sorted(r.items()))
+
+        self.assertEqual(expected, zip(bins, incrs))
+
+class TestLatencyStats(TestCase):
+    def test_stats_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config = MockConfig()
+            config.persist_stats_dir = tmpdir
+            config.persist_queues = {'cassandra': ['CassandraPollPersister', 2]}
+
+            now = time.time()
+            results = [dict(oidset_name='FastPollHC', device_name='rtr_d',
+                    oid_name='', timestamp=now - 10, data=[],
+                    metadata={}, enqueue_ts=now - 1)] * 10
+            for i in (1, 2):
+                p = PollPersister(config, "cassandra_%d" % i,
+                        persistq=TestPersistQueue(list(results)))
+                p.run()
+                p.write_stats(60, 10)
+
+            rows = latency_stats(config)
+            self.assertEqual([r[0] for r in rows],
+                    ['cassandra', 'cassandra_1', 'cassandra_2'])
+            name, rate, hists = rows[0]
+            self.assertEqual(hists['queue_latency'].count, 20)
+            self.assertTrue(1.0 <= hists['queue_latency'].percentile(50) < 1.2)
+            self.assertTrue(9.0 <= hists['poll_delay'].percentile(99) < 10.7)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+class RecordingQueue(object):
+    def __init__(self, qname, uri):
+        self.qname = qname
+        self.results = []
+
+    def put_many(self, results):
+        self.results.extend(results)
+
+class FakeQueueStats(object):
+    def __init__(self, last_added, flushed):
+        self.last_added = [last_added, 0]
+        self.flushed = flushed
+
+    def update_stats(self):
+        pass
+
+    def get_stats(self):
+        return ('q', self.last_added[0] - self.flushed, 0, 0, 0,
+                self.last_added[0])
+
+    def get_flushed(self):
+        return self.flushed
+
+class TestHandoff(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'cassandra.balance')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _results(self, n, t):
+        return [PollResult('FastPollHC', 'rtr_%d' % i, 'x', t, [], {})
+                    for i in range(n)]
+
+    def _reload(self, mwq, mtime):
+        os.utime(self.filename, (mtime, mtime))
+        mwq.last_balance_check = 0
+
+    def test_hold(self):
+        now = time.time()
+        write_balance_file(self.filename, {1: 1.0, 2: 1.0, 3: 1.0}, {})
+        os.utime(self.filename, (now - 10, now - 10))
+        mwq = MultiWorkerQueue('cassandra', RecordingQueue, None, 3,
+                balance_dir=self.tmpdir)
+
+        # Worker 3 is retired, its keys move to 1 and 2.
+        set_active_workers(self.filename, 3, 2, now=now)
+        self._reload(mwq, now)
+        mwq.put_many(self._results(100, 1))
+
+        old = HashRing({1: 1.0, 2: 1.0, 3: 1.0})
+        moving = set('rtr_%d' % i for i in range(100)
+                        if old.get_worker('FastPollHC:rtr_%d' % i) == 3)
+        self.assertTrue(moving)
+        self.assertEqual(set(r.device_name for r in mwq.held), moving)
+        sent = mwq.queues['cassandra_1'].results + \
+                mwq.queues['cassandra_2'].results
+        self.assertEqual(len(sent), 100 - len(moving))
+        self.assertEqual(mwq.queues['cassandra_3'].results, [])
+
+        # Once the handoff is done the held results go out first.
+        weights, overrides = read_balance_file(self.filename)
+        write_balance_file(self.filename, weights, overrides)
+        self._reload(mwq, now + 1)
+        mwq.put_many(self._results(100, 2))
+        self.assertEqual(mwq.held, [])
+        for q in mwq.queues.itervalues():
+            ts = [r.timestamp for r in q.results
+                    if r.device_name in moving]
+            self.assertEqual(ts, sorted(ts))
+        self.assertEqual(sum(len(q.results) for q in mwq.queues.values()),
+                200)
+
+    def test_advance(self):
+        manager = PersistManager.__new__(PersistManager)
+        manager.config = MockConfig()
+        manager.config.persist_balance_dir = self.tmpdir
+        manager.config.persist_queues = {'cassandra': (None, 2)}
+        manager.log = logging.getLogger('test')
+        manager.processes = {}
+        manager.handoffs = set()
+        stats = {'cassandra_1': FakeQueueStats(100, 90),
+                 'cassandra_2': FakeQueueStats(50, 50)}
+        manager.queue_stats = stats
+
+        set_active_workers(self.filename, 2, 1, now=1000)
+        manager.advance_handoff('cassandra', 1000 + 1)
+        self.assertEqual(manager.handoffs, set(['cassandra']))
+        self.assertEqual(read_balance(self.filename)[2]['fences'], {})
+
+        # Once the pollers have all seen the change the fences are set.
+        manager.advance_handoff('cassandra', 1000 + manager.RETIRE_GRACE)
+        self.assertEqual(read_balance(self.filename)[2]['fences'], {1: 100})
+
+        manager.advance_handoff('cassandra', 1000 + manager.RETIRE_GRACE + 1)
+        self.assertIsNotNone(read_balance(self.filename)[2])
+
+        # Done once worker 1 has written up to its fence.
+        stats['cassandra_1'].flushed = 100
+        manager.advance_handoff('cassandra', 1000 + manager.RETIRE_GRACE + 2)
+        self.assertIsNone(read_balance(self.filename)[2])
+        self.assertEqual(manager.handoffs, set())
+
+class TestWorkerScaler(TestCase):
+    def test_scaling(self):
+        scaler = WorkerScaler(2, 4, 1000, 8)
+        self.assertEqual(scaler.active, 4)
+
+        # Idle for long enough to retire down to the minimum.
+        changes = [scaler.update(0) for i in range(3 * scaler.SHRINK_CHECKS)]
+        self.assertEqual(changes.count(-1), 2)
+        self.assertEqual(scaler.active, 2)
+
+        # A single busy check isn't enough to add a worker.
+        self.assertEqual(scaler.update(5000), 0)
+        self.assertEqual(scaler.update(0), 0)
+        self.assertEqual(scaler.update(5000), 0)
+        self.assertEqual(scaler.update(5000), 1)
+        self.assertEqual(scaler.active, 3)
+
+        # A backlog within the limits doesn't change anything.
+        for i in range(3 * scaler.SHRINK_CHECKS):
+            self.assertEqual(scaler.update(3 * 500), 0)
+
+        for i in range(10):
+            scaler.update(100000)
+        self.assertEqual(scaler.active, 4)
+
+class FlakyColumnFamily(object):
+    """Column family with a batch() that fails the first failures sends."""
+    column_family = 'flaky'
+
+    def __init__(self, failures, error=MaximumRetryException):
+        self.failures = failures
+        self.error = error
+        self.sent = []
+
+    def batch(self, queue_size):
+        return FlakyMutator(self)
+
+class FlakyMutator(object):
+    def __init__(self, cf):
+        self.cf = cf
+        self.mutations = []
+
+    def insert(self, key, columns, ttl=None):
+        self.mutations.append((key, columns))
+
+    def send(self):
+        if self.cf.failures:
+            self.cf.failures -= 1
+            raise self.cf.error("flaky")
+        self.cf.sent.extend(self.mutations)
+
+class TestMutationBatcher(TestCase):
+    def setUp(self):
+        self.log = logging.getLogger('test')
+        self.log.addHandler(logging.NullHandler())
+
+    def test_retry(self):
+        cf = FlakyColumnFamily(3)
+        b = MutationBatcher(cf, 100, self.log)
+        b.RETRY_MIN_DELAY = b.RETRY_MAX_DELAY = 0.001
+
+        for i in range(100):
+            b.insert('k', {i: 'v'})
+        # A failure shrinks the batches.
+        self.assertEqual(b.batch_size, 50)
+
+        for i in range(100, 1000):
+            b.insert('k', {i: 'v'})
+        b.send(wait=True)
+
+        self.assertEqual(len(b.pending), 0)
+        # Nothing is lost and the order is kept.
+        self.assertEqual([c.keys()[0] for k, c in cf.sent], range(1000))
+
+    def test_backpressure(self):
+        cf = FlakyColumnFamily(20)
+        b = MutationBatcher(cf, 1, self.log, retries=None)
+        b.RETRY_MIN_DELAY = b.RETRY_MAX_DELAY = 0.001
+
+        for i in range(b.MAX_PENDING_BATCHES + 5):
+            b.insert('k', {i: 'v'})
+            self.assertTrue(len(b.pending) < b.MAX_PENDING_BATCHES)
+
+    def test_give_up(self):
+        cf = FlakyColumnFamily(10)
+        b = MutationBatcher(cf, 10, self.log, retries=2)
+        b.RETRY_MIN_DELAY = b.RETRY_MAX_DELAY = 0.001
+
+        for i in range(10):
+            b.insert('k', {i: 'v'})
+        self.assertRaises(MaximumRetryException, b.send, wait=True)
+        # The batch is dropped, the next one is written.
+        self.assertEqual(len(b.pending), 0)
+        cf.failures = 0
+        b.insert('k', {10: 'v'})
+        b.send(wait=True)
+        self.assertEqual([c.keys()[0] for k, c in cf.sent], [10])
+
+        pipeline = WritePipeline(1, 4, self.log)
+        cf = FlakyColumnFamily(10)
+        b = MutationBatcher(cf, 10, self.log, pipeline, retries=2)
+        b.RETRY_MIN_DELAY = b.RETRY_MAX_DELAY = 0.001
+        for i in range(10):
+            b.insert('k', {i: 'v'})
+        self.assertRaises(MaximumRetryException, b.send, wait=True)
+        pipeline.close()
+
+    def test_counters(self):
+        # A counter batch that timed out may have been applied.
+        cf = FlakyColumnFamily(1, TimedOutException)
+        b = MutationBatcher(cf, 10, self.log, retries=None, counters=True)
+        for i in range(10):
+            b.insert('k', {i: 1})
+        b.send(wait=True)
+        self.assertEqual(cf.sent, [])
+        self.assertEqual(b.dropped, 10)
+
+        # One that couldn't be sent wasn't.
+        cf = FlakyColumnFamily(1, AllServersUnavailable)
+        b = MutationBatcher(cf, 10, self.log, retries=None, counters=True)
+        b.RETRY_MIN_DELAY = b.RETRY_MAX_DELAY = 0.001
+        for i in range(10):
+            b.insert('k', {i: 1})
+        b.send(wait=True)
+        self.assertEqual(len(cf.sent), 10)
+        self.assertEqual(b.dropped, 0)
+
+    def test_pipeline(self):
+        pipeline = WritePipeline(3, 4, self.log)
+        ordered = FlakyColumnFamily(2)
+        counters = FlakyColumnFamily(2)
+        b1 = MutationBatcher(ordered, 30, self.log, pipeline, ordered=True)
+        b2 = MutationBatcher(counters, 30, self.log, pipeline)
+        for b in (b1, b2):
+            b.RETRY_MIN_DELAY = b.RETRY_MAX_DELAY = 0.001
+
+        for i in range(1000):
+            b1.insert('k', {i: 'v'})
+            b2.insert('k', {i: 1})
+        b1.send(wait=True)
+        b2.send(wait=True)
+
+        self.assertEqual([c.keys()[0] for k, c in ordered.sent], range(1000))
+        self.assertEqual(sorted(c.keys()[0] for k, c in counters.sent),
+                range(1000))
+        pipeline.close()
+
+    def test_adapt(self):
+        cf = FlakyColumnFamily(0)
+        b = MutationBatcher(cf, MutationBatcher.MIN_BATCH_SIZE, self.log)
+        for i in range(10000):
+            b.insert('k', {i: 'v'})
+        self.assertTrue(b.batch_size > MutationBatcher.MIN_BATCH_SIZE)
+
+    def test_metrics(self):
+        metrics = DatabaseMetrics(sample_every=1)
+        b = MutationBatcher(FlakyColumnFamily(0), 100, logging.getLogger('test'),
+                metrics=metrics)
+        for i in range(250):
+            b.insert('k', {i: 'v'})
+        b.send(wait=True)
+
+        stats = metrics.snapshot()
+        self.assertEqual(stats['batch_write']['calls'], 3)
+        self.assertEqual(stats['batch_write']['items'], 250)
+
 class TestCassandraApiQueriesALU(BaseTestCase):
     fixtures = ['oidsets.json']
 
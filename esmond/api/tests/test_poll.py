@@ -0,0 +1,268 @@
+import bisect
+import datetime
+import time
+
+from django.test import TestCase
+from django.utils.timezone import utc
+
+from esmond.api.models import DeviceLease
+from esmond.lease import LeaseManager
+from esmond.poll import Poller, device_shard, PollRequest, WalkColumn, \
+                            SessionTuning
+
+class MockOIDSet(object):
+    def __init__(self, name, frequency):
+        self.name = name
+        self.frequency = frequency
+        self.poller_args = None
+        self.oids = self
+
+    def all(self):
+        return []
+
+class MockDevice(object):
+    def __init__(self, name):
+        self.name = name
+
+class MockPoller(Poller):
+    def begin(self):
+        pass
+
+    def collect(self):
+        pass
+
+class TestPollerSchedule(TestCase):
+    def test_stagger(self):
+        now = 1400000000.5
+        firsts = []
+        for i in range(100):
+            p = MockPoller(None, MockDevice('router%d' % i),
+                    MockOIDSet('FastPoll', 30), None, None)
+            p.stagger(now)
+            self.assertTrue(now <= p.next_poll < now + 30)
+            firsts.append(p.next_poll)
+
+            # the same offset in the interval every time
+            p.stagger(now + 1000)
+            self.assertEqual((p.next_poll - firsts[-1]) % 30, 0)
+
+        # spread over the interval
+        self.assertTrue(max(firsts) - min(firsts) > 20)
+        self.assertTrue(len(set(int(t) for t in firsts)) > 20)
+
+    def test_run_once(self):
+        p = MockPoller(None, MockDevice('router'),
+                MockOIDSet('FastPoll', 30), None, None)
+        p.next_poll = time.time() - 1
+        due = p.next_poll
+
+        self.assertTrue(p.run_once())
+        self.assertEqual(p.next_poll, due + 30)
+        self.assertFalse(p.run_once())
+
+        # missed polls are skipped, keeping the offset
+        p.next_poll = due - 95
+        self.assertTrue(p.run_once())
+        self.assertEqual(p.next_poll, due + 25)
+
+class TestDeviceShard(TestCase):
+    def test_device_shard(self):
+        counts = [0] * 4
+        for i in range(400):
+            shard = device_shard('router%d' % i, 4)
+            self.assertTrue(1 <= shard <= 4)
+            self.assertEqual(shard, device_shard(u'router%d' % i, 4))
+            counts[shard - 1] += 1
+
+        self.assertTrue(min(counts) > 60)
+
+class MockAgent(object):
+    """Answers GETBULKs from a sorted list of (oid, value)."""
+    def __init__(self, data, max_varbinds):
+        self.data = sorted(data)
+        self.oids = [x[0] for x in self.data]
+        self.max_varbinds = max_varbinds
+        self.requests = 0
+
+    def getbulk(self, maxrepetitions, oids):
+        self.requests += 1
+        positions = [bisect.bisect(self.oids, oid) for oid in oids]
+        r = []
+        for rep in range(maxrepetitions):
+            for i in positions:
+                if i + rep < len(self.data):
+                    r.append(self.data[i + rep])
+        # a response that would be too big is cut short
+        return r[:self.max_varbinds]
+
+class TestBulkWalk(TestCase):
+    def walk(self, agent, columns, window):
+        req = PollRequest('bulkwalk', None, None,
+                columns=[WalkColumn(c, c) for c in columns])
+        oids = req.next_walk(window)
+        while oids:
+            req.add_bulk(agent.getbulk(10, oids))
+            oids = req.next_walk(window)
+        return req.results()
+
+    def test_walk_columns(self):
+        data = [((1, 3, 6, c, row), c * row)
+                for c in range(1, 7) for row in range(1, 40 + c)]
+        data.append(((1, 3, 7), 0))
+        columns = [(1, 3, 6, c) for c in (2, 1, 5, 6, 3)]
+
+        agent = MockAgent(data, 64)
+        expected = self.walk(agent, columns, 1)
+        serial = agent.requests
+        self.assertEqual(len(expected), sum(39 + c for c in (2, 1, 5, 6, 3)))
+
+        for window in (2, 3, 5, 10):
+            agent = MockAgent(data, 64)
+            self.assertEqual(self.walk(agent, columns, window), expected)
+            self.assertTrue(agent.requests < serial)
+
+    def test_short_responses(self):
+        data = [((1, 3, 6, c, row), row) for c in range(1, 4)
+                for row in range(1, 30)]
+        data.append(((1, 3, 7), 0))
+        columns = [(1, 3, 6, c) for c in range(1, 4)]
+        expected = self.walk(MockAgent(data, 1000), columns, 1)
+
+        # fewer varbinds than repeaters
+        self.assertEqual(self.walk(MockAgent(data, 2), columns, 3), expected)
+
+class TestSessionTuning(TestCase):
+    def test_repetitions(self):
+        t = SessionTuning(25, 2, 8)
+
+        # quick full responses
+        for i in range(20):
+            t.response(0.05, t.maxrepetitions, 2, 2 * t.maxrepetitions, False)
+        self.assertEqual(t.maxrepetitions, SessionTuning.MAX_REPETITIONS)
+        self.assertEqual(t.timeout, 2)
+
+        # the agent only fits 30 rows of 2 columns
+        t.response(0.05, t.maxrepetitions, 2, 60, True)
+        self.assertEqual(t.maxrepetitions, 30)
+
+        # and no more after that
+        t.response(0.05, 30, 2, 60, False)
+        self.assertEqual(t.maxrepetitions, 30)
+        t.response(0.05, 30, 1, 30, False)
+        self.assertEqual(t.maxrepetitions, 45)
+        t.response(0.05, 45, 1, 45, False)
+        self.assertEqual(t.maxrepetitions, 60)
+
+        # a full response that is too slow doesn't grow it
+        t.maxrepetitions = 30
+        t.response(1.0, 30, 1, 30, False)
+        self.assertEqual(t.maxrepetitions, 30)
+
+        t.timed_out()
+        self.assertEqual(t.maxrepetitions, 15)
+        for i in range(5):
+            t.timed_out()
+        self.assertEqual(t.maxrepetitions, SessionTuning.MIN_REPETITIONS)
+        self.assertEqual(t.timeout, 8)
+
+    def test_timeout(self):
+        t = SessionTuning(25, 2, 8)
+        t.response(1.0, 25, 1, 10, False)
+        self.assertEqual(t.timeout, 3)
+        for i in range(50):
+            t.response(10.0, 25, 1, 10, False)
+        self.assertEqual(t.timeout, 8)
+        for i in range(100):
+            t.response(0.01, 25, 1, 10, False)
+        self.assertEqual(t.timeout, 2)
+
+        t2 = SessionTuning(25, 1, 4)
+        t2.update(dict(maxrepetitions=500, timeout=6, srtt=0.5, rttvar=0.1))
+        self.assertEqual(t2.maxrepetitions, SessionTuning.MAX_REPETITIONS)
+        self.assertEqual(t2.timeout, 4)
+        self.assertEqual(t2.srtt, 0.5)
+
+    def test_no_rtt(self):
+        t = SessionTuning(25, 2, 8)
+        t.response(1.0, 25, 1, 25, False)
+        t.timed_out()
+        self.assertEqual(t.timeout, 6)
+
+        # A response to a retry keeps the backed off timeout.
+        t.response(None, 12, 1, 12, False)
+        self.assertEqual(t.timeout, 6)
+        self.assertEqual(t.srtt, 1.0)
+        self.assertEqual(t.maxrepetitions, 12)
+        t.response(None, 12, 2, 10, True)
+        self.assertEqual(t.maxrepetitions, SessionTuning.MIN_REPETITIONS)
+
+    def test_update(self):
+        t = SessionTuning(25, 1, 4)
+        t.update(dict(timeout=3))
+        self.assertEqual(t.maxrepetitions, 25)
+        self.assertEqual(t.timeout, 3)
+        self.assertIsNone(t.srtt)
+        t.update(dict(srtt=0.5))
+        self.assertIsNone(t.srtt)
+
+        self.assertRaises(ValueError, t.update, dict(maxrepetitions='x'))
+        self.assertRaises(TypeError, t.update, dict(timeout=None))
+        self.assertRaises(AttributeError, t.update, [])
+        self.assertEqual(t.timeout, 3)
+
+class TestLeaseManager(TestCase):
+    """Several espolld instances on different hosts, simulated by a
+    LeaseManager per instance and a clock that is moved by hand."""
+
+    devices = ['router%d' % i for i in range(60)]
+
+    def claim_all(self, managers, now):
+        held = {}
+        for m in managers:
+            held[m.instance] = m.claim(self.devices, now=now)
+
+        # no device is ever polled by two instances
+        leased = [d for names in held.values() for d in names]
+        self.assertEqual(len(leased), len(set(leased)))
+        return held
+
+    def test_leases(self):
+        now = datetime.datetime(2014, 1, 1, tzinfo=utc)
+        step = datetime.timedelta(seconds=10)
+        a, b, c = [LeaseManager(name, 60) for name in ('a', 'b', 'c')]
+
+        # Until the others have sent a heartbeat the first instance takes
+        # all of the devices, the others get them once it lets them go.
+        held = self.claim_all([a, b, c], now)
+        self.assertEqual(len(held['a']), len(self.devices))
+
+        for i in range(2):
+            now += step
+            held = self.claim_all([a, b, c], now)
+        self.assertEqual(set.union(*held.values()), set(self.devices))
+        for names in held.values():
+            self.assertTrue(len(names) > 5)
+
+        # c stops without giving up its leases, its devices are taken over
+        # once the leases have expired.
+        c_devices = held['c']
+        for i in range(5):
+            now += step
+            held = self.claim_all([a, b], now)
+            self.assertFalse(c_devices & (held['a'] | held['b']))
+
+        for i in range(3):
+            now += step
+            held = self.claim_all([a, b], now)
+        self.assertEqual(held['a'] | held['b'], set(self.devices))
+
+        # b shuts down cleanly, a takes over right away.
+        b.release()
+        now += step
+        held = self.claim_all([a], now)
+        self.assertEqual(held['a'], set(self.devices))
+
+        # Devices that go away are given up.
+        self.assertEqual(a.claim(self.devices[:10], now=now),
+                set(self.devices[:10]))
+        self.assertEqual(DeviceLease.objects.count(), 10)
@@ -0,0 +1,79 @@
+import json
+import marshal
+
+from django.test import TestCase
+
+from esmond import pollcodec
+from esmond.persist import PollResult
+
+class TestPollCodec(TestCase):
+    def test_round_trip(self):
+        results = [
+            PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 1343955624,
+                [[['ifHCInOctets', 'xe-0/0/%d' % i], 2**64 - i]
+                    for i in range(10)], {'tsdb_flags': 1}),
+            PollResult('SentryPoll', 'sentry', '', 1343955624.5,
+                [[['outletLoadValue', 'AA1'], 1.5],
+                 [['outletLoadValue', u'\xe9', 'x'], -3]], {}),
+            PollResult('IfRefPoll', 'rtr_d', '', 1343955624,
+                {'ifDescr': [['ifDescr.1', 'xe-0/0/0']],
+                 'ifSpeed': [['ifSpeed.1', None]]}, {}),
+        ]
+
+        for result in results:
+            expected = json.loads(result.json())
+            self.assertEqual(pollcodec.decode(pollcodec.encode(result)),
+                    expected)
+            self.assertEqual(pollcodec.decode(result.json()), expected)
+
+        self.assertTrue(len(pollcodec.encode(results[0])) <
+                len(results[0].json()))
+
+        results[0].enqueue_ts = 1343955625.25
+        self.assertEqual(pollcodec.decode(pollcodec.encode(results[0])),
+                json.loads(results[0].json()))
+
+    def test_strings(self):
+        # Compared with unicode from the database, so the types matter too.
+        results = [
+            PollResult('IfRefPoll', 'rtr_d', '', 1343955624,
+                {'ifName': [('ifName.1', 'xe-0/0/0')],
+                 'ifAlias': [('ifAlias.1', u'caf\xe9'.encode('utf-8'))]},
+                {'names': ('a', 'b')}),
+            PollResult('SentryPoll', 'sentry', '', 1343955624,
+                [[['outletName', 'AA1'], u'\xe9'.encode('utf-8')],
+                 [['outletName', 'AA2'], ('a', 1)]], {}),
+        ]
+
+        def check(a, b):
+            self.assertEqual(type(a), type(b))
+            if isinstance(a, dict):
+                self.assertEqual(sorted(a), sorted(b))
+                for k in a:
+                    check(a[k], b[k])
+            elif isinstance(a, list):
+                self.assertEqual(len(a), len(b))
+                for x, y in zip(a, b):
+                    check(x, y)
+            else:
+                self.assertEqual(a, b)
+
+        for result in results:
+            check(pollcodec.decode(pollcodec.encode(result)),
+                    json.loads(result.json()))
+
+        self.assertRaises(pollcodec.CodecError, pollcodec.encode,
+                PollResult('IfRefPoll', 'rtr_d', '', 0,
+                    {'ifAlias': [['ifAlias.1', '\xff']]}, {}))
+
+    def test_version_1(self):
+        data = pollcodec.MAGIC + chr(1) + marshal.dumps((u'FastPollHC',
+            u'rtr_d', u'x', 0, {}, pollcodec.DATA_RAW, [1]), 2)
+        self.assertEqual(pollcodec.decode(data), dict(oidset_name='FastPollHC',
+            device_name='rtr_d', oid_name='x', timestamp=0, metadata={},
+            data=[1], enqueue_ts=None))
+
+    def test_bad_data(self):
+        data = pollcodec.encode(PollResult('FastPollHC', 'rtr_d', 'x', 0,
+            [[['a', 'b'], 1]], {}))
+        self.assertRaises(pollcodec.CodecError, pollcodec.decode, data[:-4])
@@ -0,0 +1,38 @@
+import logging
+
+from django.test import TestCase
+
+from esmond.cassandra import RawRateData
+from esmond.reprocess import ReplayPersister, windows
+
+class TestReprocess(TestCase):
+    def test_windows(self):
+        w = list(windows(86400 + 100, 86400 * 20 - 100, [3600, 86400]))
+        self.assertEqual(w[0][0], 86400 * 1000)
+        self.assertEqual(w[-1][1], 86400 * 20 * 1000)
+        for (s1, e1), (s2, e2) in zip(w, w[1:]):
+            self.assertEqual(e1, s2)
+        for s, e in w:
+            self.assertEqual(s % (86400 * 1000), 0)
+
+    def test_replay(self):
+        log = logging.getLogger('test')
+        log.addHandler(logging.NullHandler())
+        p = ReplayPersister(log)
+        path = ['snmp', 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'xe-0_0_0']
+
+        for ts, val in ((1343955600000, 0), (1343955630000, 300),
+                (1343955660000, 900)):
+            data = RawRateData(path=path, ts=ts, val=val, freq=30000)
+            delta_v = p.aggregate_base_rate(data)
+            if delta_v is not None:
+                data.val = delta_v
+                p.generate_aggregations(data, [3600])
+
+        rates = p.db.rates.values()[0]
+        self.assertEqual(sum(b['val'] for b in rates.values()), 900)
+        aggs = p.db.aggs.values()[0]
+        self.assertEqual(aggs.values()[0], {'val': 900, '30000': 2})
+        stats = p.db.stats.values()[0]
+        self.assertEqual((stats.values()[0]['min'], stats.values()[0]['max']),
+                (300, 600))
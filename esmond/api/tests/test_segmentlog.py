@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from esmond.persist import PollResult, SegmentLogPersistQueue
+
+class TestSegmentLogPersistQueue(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _result(self, i):
+        return PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 1000 + i,
+                [[['ifHCInOctets', 'xe-0/0/%d' % i], i * 100]], {})
+
+    def test_put_get(self):
+        q = SegmentLogPersistQueue('test', self.tmpdir)
+        q.slog.segment_size = 1024
+
+        for i in range(50):
+            q.put(self._result(i))
+
+        self.assertEqual(len(q), 50)
+
+        r = SegmentLogPersistQueue('test', self.tmpdir)
+        for i in range(50):
+            result = r.get()
+            self.assertEqual(result.timestamp, 1000 + i)
+            self.assertEqual(result.data[0][1], i * 100)
+        self.assertIsNone(r.get())
+        # Items count as queued until they're committed.
+        self.assertEqual(len(r), 50)
+        r.commit()
+        self.assertEqual(len(r), 0)
+
+        # finished segments are recycled
+        self.assertTrue(len(os.listdir(os.path.join(self.tmpdir, 'test'))) < 10)
+
+    def test_replay_uncommitted(self):
+        q = SegmentLogPersistQueue('test', self.tmpdir)
+        for i in range(3):
+            q.put(self._result(i))
+
+        r = SegmentLogPersistQueue('test', self.tmpdir)
+        self.assertEqual(r.get().timestamp, 1000)
+        r.commit()
+        self.assertEqual(r.get().timestamp, 1001)
+
+        # The second item was never committed so a new reader gets it again.
+        r = SegmentLogPersistQueue('test', self.tmpdir)
+        self.assertEqual(r.get().timestamp, 1001)
+
+    def test_commit_position(self):
+        q = SegmentLogPersistQueue('test', self.tmpdir)
+        q.slog.segment_size = 1024
+        for i in range(50):
+            q.put(self._result(i))
+
+        r = SegmentLogPersistQueue('test', self.tmpdir)
+        r.get_many(20)
+        position = r.position()
+        r.get_many(20)
+        # Only the items before position have been written.
+        r.commit(position)
+
+        r = SegmentLogPersistQueue('test', self.tmpdir)
+        self.assertEqual(r.get().timestamp, 1020)
@@ -0,0 +1,223 @@
+"""
+On-disk snapshots of the CASSANDRA_DB metadata and aggregation caches.
+
+A persister that restarts with empty caches has to go back to Cassandra for
+the previous value of every path it sees and for the current min/max of
+every aggregation bin.  Snapshotting the caches to disk lets a restarted
+worker skip most of those reads.
+
+The file is a fixed header followed by fixed size records, each one
+followed by its row key, so it can be read straight out of a mmap with
+struct.unpack_from()::
+
+    header:  magic, version, flags, time written, metadata count,
+             aggregation count, crc32 of everything after the header
+    metadata record:  key length, last_update, min_ts, last_val, key
+    aggregation record:  key length, agg_ts, min_ts, max_ts, min, max, key
+
+Timestamps are JavaScript timestamps (ms).  Values are stored with a one
+byte type tag so that counters, deltas and floats all round trip.
+"""
+
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from esmond.cassandra import jstime, _split_rowkey
+from esmond.error import EsmondError
+
+MAGIC = 'ESCS'
+VERSION = 1
+
+FLAG_CLEAN = 0x1
+
+HEADER = struct.Struct('<4sHHdIII')
+META_RECORD = struct.Struct('<HqqB8s')
+AGG_RECORD = struct.Struct('<HqqqB8sB8s')
+
+VAL_INT = 0
+VAL_UINT = 1
+VAL_FLOAT = 2
+
+_val_formats = {
+    VAL_INT: struct.Struct('<q'),
+    VAL_UINT: struct.Struct('<Q'),
+    VAL_FLOAT: struct.Struct('<d'),
+}
+
+class SnapshotError(EsmondError):
+    """Unable to read a cache snapshot."""
+    pass
+
+class CacheSnapshot(object):
+    """
+    The contents of a snapshot file.
+
+    metadata maps metadata row keys to metadata cache entries and
+    aggregation maps stat aggregation row keys to {agg_ts: {...}} just like
+    the caches in CASSANDRA_DB, the keys are utf-8 encoded strs there too.
+    clean is True if the snapshot was written
+    by a persister that was shutting down after flushing all of its writes.
+    """
+    def __init__(self, written, clean, metadata, aggregation):
+        self.written = written
+        self.clean = clean
+        self.metadata = metadata
+        self.aggregation = aggregation
+
+def _pack_val(val):
+    if isinstance(val, float):
+        tag = VAL_FLOAT
+    elif val < 0:
+        tag = VAL_INT
+    else:
+        tag = VAL_UINT
+
+    return tag, _val_formats[tag].pack(val)
+
+def _unpack_val(tag, data):
+    try:
+        return _val_formats[tag].unpack(data)[0]
+    except KeyError:
+        raise SnapshotError("unknown value type %d" % tag)
+
+def _encode_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return key
+
+def write_snapshot(filename, metadata_cache, aggregation_cache, clean=False):
+    """
+    Write the caches to filename.  The file is written to a temporary file
+    and renamed into place so a reader never sees a partial snapshot.
+
+    Entries that can't be represented (non-numeric values for example) are
+    skipped, they will just be looked up in Cassandra again.
+    """
+
+    body = []
+    n_meta = 0
+    n_agg = 0
+
+    for key, meta_d in metadata_cache.iteritems():
+        try:
+            tag, val = _pack_val(meta_d['last_val'])
+            rec = META_RECORD.pack(len(_encode_key(key)),
+                    jstime(meta_d['last_update']), jstime(meta_d['min_ts']),
+                    tag, val)
+        except (TypeError, ValueError, struct.error):
+            continue
+        body.append(rec)
+        body.append(_encode_key(key))
+        n_meta += 1
+
+    for key, bins in aggregation_cache.iteritems():
+        for agg_ts, stat in bins.iteritems():
+            try:
+                min_tag, min_val = _pack_val(stat['min'])
+                max_tag, max_val = _pack_val(stat['max'])
+                rec = AGG_RECORD.pack(len(_encode_key(key)), agg_ts,
+                        stat['min_ts'], stat['max_ts'], min_tag, min_val,
+                        max_tag, max_val)
+            except (KeyError, TypeError, ValueError, struct.error):
+                continue
+            body.append(rec)
+            body.append(_encode_key(key))
+            n_agg += 1
+
+    body = ''.join(body)
+
+    flags = 0
+    if clean:
+        flags |= FLAG_CLEAN
+
+    header = HEADER.pack(MAGIC, VERSION, flags, time.time(), n_meta, n_agg,
+            zlib.crc32(body) & 0xffffffff)
+
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+    os.rename(tmp, filename)
+
+def read_snapshot(filename):
+    """
+    Read a snapshot written by write_snapshot() and return a CacheSnapshot
+    or None if there is no snapshot.  Raises SnapshotError if the file is
+    not a valid snapshot.
+    """
+
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise SnapshotError("%s: truncated header" % filename)
+
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+    try:
+        return _parse(filename, m, size)
+    finally:
+        m.close()
+
+def _parse(filename, m, size):
+    magic, version, flags, written, n_meta, n_agg, crc = \
+            HEADER.unpack_from(m, 0)
+
+    if magic != MAGIC:
+        raise SnapshotError("%s: not a cache snapshot" % filename)
+    if version != VERSION:
+        raise SnapshotError("%s: unsupported version %d" % (filename, version))
+    if zlib.crc32(m[HEADER.size:size]) & 0xffffffff != crc:
+        raise SnapshotError("%s: checksum mismatch" % filename)
+
+    metadata = {}
+    aggregation = {}
+    offset = HEADER.size
+
+    try:
+        for i in xrange(n_meta):
+            key_len, last_update, min_ts, tag, val = \
+                    META_RECORD.unpack_from(m, offset)
+            offset += META_RECORD.size
+            key = m[offset:offset+key_len]
+            offset += key_len
+
+            # The metadata key is the path followed by the frequency.
+            path = _split_rowkey(key)
+            metadata[key] = dict(path=path[:-1], freq=int(path[-1]),
+                last_update=last_update, min_ts=min_ts,
+                last_val=_unpack_val(tag, val))
+
+        for i in xrange(n_agg):
+            key_len, agg_ts, min_ts, max_ts, min_tag, min_val, max_tag, \
+                max_val = AGG_RECORD.unpack_from(m, offset)
+            offset += AGG_RECORD.size
+            key = m[offset:offset+key_len]
+            offset += key_len
+
+            aggregation.setdefault(key, {})[agg_ts] = {
+                'min': _unpack_val(min_tag, min_val),
+                'max': _unpack_val(max_tag, max_val),
+                'min_ts': min_ts,
+                'max_ts': max_ts,
+            }
+    except (struct.error, ValueError), e:
+        raise SnapshotError("%s: corrupt record: %s" % (filename, e))
+
+    return CacheSnapshot(written, bool(flags & FLAG_CLEAN), metadata,
+            aggregation)
@@ -51,16 +51,21 @@ import json
 import logging
 import os
 import pprint
+import Queue
+import random
 import sys
+import threading
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from esmond.util import get_logger
+from esmond.metrics import LogHistogram
 
 # Third party
 from pycassa import PycassaLogger
 from pycassa.pool import ConnectionPool, AllServersUnavailable, MaximumRetryException
 from pycassa.columnfamily import ColumnFamily, NotFoundException
+from pycassa.cassandra.ttypes import TimedOutException, UnavailableException
 from pycassa.system_manager import *
 
 from thrift.transport.TTransport import TTransportException
@@ -79,6 +84,296 @@ class ConnectionException(CassandraException):
     def __str__(self):
         return repr(self.value)
         
+# Errors that mean a batch didn't make it to the cluster but might if it is
+# sent again later.
+RETRYABLE_ERRORS = (MaximumRetryException, AllServersUnavailable,
+        TimedOutException, UnavailableException, TTransportException)
+
+# Errors that mean none of a batch was applied.  With the others a batch may
+# have been applied even though the write failed, so a counter batch isn't
+# retried after them.
+NOT_APPLIED_ERRORS = (AllServersUnavailable, UnavailableException)
+
+def _mutation_size(columns):
+    """Rough size in bytes of the columns of a mutation."""
+    n = 0
+    for name, val in columns.iteritems():
+        if isinstance(val, dict):
+            n += _mutation_size(val)
+        elif isinstance(val, basestring):
+            n += len(val)
+        else:
+            n += 8
+        if isinstance(name, basestring):
+            n += len(name)
+        else:
+            n += 8
+    return n
+
+class MutationBatcher(object):
+    """
+    Batches the mutations for a column family, in place of a pycassa 
+    Mutator.
+
+    The batch size adapts to the cluster: it grows while full batches are
+    written quickly and shrinks when a batch is slow or fails.  A batch is
+    also sent once it reaches MAX_BATCH_BYTES.
+
+    If there is a WritePipeline the full batches are handed to its threads,
+    otherwise they are written by the caller.  Either way a batch that fails
+    is retried with a jittered exponential backoff and later batches are
+    queued behind it so that the mutations are applied in order.  After
+    retries failed retries the error is raised and the batch is dropped,
+    with retries=None a batch is retried until it is written.  Once
+    MAX_PENDING_BATCHES are waiting (or the pipeline has as many batches in
+    flight as it allows) send() blocks, which stops the persister from
+    taking more work off of its queue rather than dropping data.
+
+    A batch that timed out may have been applied anyway, so for a counters
+    batcher only errors in NOT_APPLIED_ERRORS are retried.  Otherwise the
+    batch is dropped and logged rather than risk counting it twice.
+
+    Batches for an ordered batcher are always written by the same pipeline
+    thread, one after the other.  That is needed for column families that
+    are overwritten rather than incremented.
+    """
+
+    MIN_BATCH_SIZE = 25
+    MAX_BATCH_SIZE = 5000
+    MAX_BATCH_BYTES = 2 * 1024 * 1024
+    # Full batches that take less than this many seconds to write make the
+    # batch size grow, batches that take more than twice as long shrink it.
+    TARGET_LATENCY = 0.1
+    MAX_PENDING_BATCHES = 10
+    RETRY_MIN_DELAY = 0.1
+    RETRY_MAX_DELAY = 30
+    DEFAULT_RETRIES = 3
+
+    def __init__(self, column_family, batch_size, log, pipeline=None,
+            ordered=False, metrics=None, retries=DEFAULT_RETRIES,
+            counters=False):
+        self._column_family = column_family
+        self.batch_size = batch_size
+        self.log = log
+        self.pipeline = pipeline
+        self.ordered = ordered
+        self.retries = retries
+        self.counters = counters
+        # A DatabaseMetrics to report the batch writes to.
+        self.metrics = metrics
+
+        self.mutations = []
+        self.bytes = 0
+
+        # Batches that have not been written yet, oldest first.  Only used
+        # without a pipeline.
+        self.pending = deque()
+        self.attempts = 0
+        self.retry_at = 0
+
+        # The error of the last failed write and the number of mutations
+        # in counter batches that were dropped because they may have been
+        # applied.
+        self.last_error = None
+        self.dropped = 0
+
+    def insert(self, key, columns, ttl=None):
+        self._add(('insert', key, columns, dict(ttl=ttl)),
+                len(key) + _mutation_size(columns))
+
+    def remove(self, key, columns=None, super_column=None):
+        self._add(('remove', key, columns, dict(super_column=super_column)),
+                len(key) + 8 * len(columns or ()))
+
+    def _add(self, mutation, nbytes):
+        self.mutations.append(mutation)
+        self.bytes += nbytes
+
+        if len(self.mutations) >= self.batch_size or \
+                self.bytes >= self.MAX_BATCH_BYTES:
+            self.send()
+
+    def send(self, wait=False):
+        """
+        Send the mutations queued so far along with any failed batches 
+        that are due to be retried.  Blocks while there are too many
+        pending batches, or until all of them have been written if wait is
+        True.
+        """
+        if self.mutations:
+            batch = (self.mutations, self.bytes)
+            self.mutations = []
+            self.bytes = 0
+            if self.pipeline:
+                self.pipeline.submit(self, batch)
+            else:
+                self.pending.append(batch)
+
+        if self.pipeline:
+            if wait:
+                self.pipeline.wait()
+            return
+
+        self._send_pending()
+
+        limit = 1 if wait else self.MAX_PENDING_BATCHES
+        while len(self.pending) >= limit:
+            time.sleep(max(0, self.retry_at - time.time()))
+            self._send_pending()
+
+    def _send_pending(self):
+        while self.pending and time.time() >= self.retry_at:
+            if not self._write(*self.pending[0]):
+                self.attempts += 1
+                if self._give_up(self.attempts, self.pending[0]):
+                    self.pending.popleft()
+                    self.attempts = 0
+                    raise self.last_error
+                self.retry_at = time.time() + self._retry_delay(self.attempts)
+                return
+
+            self.pending.popleft()
+            self.attempts = 0
+
+    def write(self, batch):
+        """Write a batch, retrying until it succeeds or the retries run out.
+        Used by the WritePipeline threads."""
+        attempts = 0
+        while not self._write(*batch):
+            attempts += 1
+            if self._give_up(attempts, batch):
+                raise self.last_error
+            time.sleep(self._retry_delay(attempts))
+
+    def _give_up(self, attempts, batch):
+        if self.retries is None or attempts <= self.retries:
+            return False
+        self.log.error("%s batch of %d dropped after %d attempts: %s" % (
+            self._column_family.column_family, len(batch[0]), attempts,
+            self.last_error.__class__.__name__))
+        return True
+
+    def _write(self, mutations, nbytes):
+        t = time.time()
+
+        # A pycassa Mutator big enough to not send anything on its own.
+        b = self._column_family.batch(len(mutations) + 1)
+        for op, key, columns, kw in mutations:
+            getattr(b, op)(key, columns, **kw)
+
+        try:
+            b.send()
+        except RETRYABLE_ERRORS, e:
+            self.batch_size = max(self.MIN_BATCH_SIZE, self.batch_size / 2)
+            self.last_error = e
+            if self.counters and not isinstance(e, NOT_APPLIED_ERRORS):
+                self.dropped += len(mutations)
+                self.log.error("%s counter batch of %d failed and may have "
+                        "been applied, not retrying: %s" % (
+                            self._column_family.column_family,
+                            len(mutations), e.__class__.__name__))
+                return True
+            self.log.warn("%s batch of %d failed: %s" % (
+                self._column_family.column_family, len(mutations),
+                e.__class__.__name__))
+            return False
+
+        latency = time.time() - t
+        if self.metrics:
+            self.metrics.batch_write(latency, len(mutations))
+
+        if latency > 2 * self.TARGET_LATENCY:
+            self.batch_size = max(self.MIN_BATCH_SIZE, self.batch_size * 3 / 4)
+        elif latency < self.TARGET_LATENCY and (
+                len(mutations) >= self.batch_size or
+                nbytes >= self.MAX_BATCH_BYTES):
+            self.batch_size = min(self.MAX_BATCH_SIZE,
+                    self.batch_size + max(1, self.batch_size / 4))
+
+        return True
+
+    def _retry_delay(self, attempts):
+        delay = min(self.RETRY_MAX_DELAY, self.RETRY_MIN_DELAY * 2 ** attempts)
+        delay = random.uniform(delay / 2, delay)
+        self.log.warn("retrying %s batch in %.1f seconds" % (
+            self._column_family.column_family, delay))
+        return delay
+
+class WritePipeline(object):
+    """
+    A small pool of threads that write the batches of the MutationBatchers
+    of a CASSANDRA_DB while the persister carries on.
+
+    At most max_inflight batches are queued or being written, submit()
+    blocks until one is done after that.  wait() is a barrier: it returns
+    once everything submitted so far has been written.  Errors in the
+    threads, including batches that ran out of retries, are raised by the
+    next submit() or wait().
+    """
+
+    def __init__(self, threads, max_inflight, log):
+        self.log = log
+        self.inflight = threading.Semaphore(max_inflight)
+        self.queues = [Queue.Queue() for i in range(threads)]
+        self.next_queue = 0
+        self.error = None
+
+        self.threads = []
+        for q in self.queues:
+            t = threading.Thread(target=self._run, args=(q,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _check_error(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def submit(self, batcher, batch):
+        self._check_error()
+        self.inflight.acquire()
+
+        if batcher.ordered:
+            q = self.queues[hash(batcher._column_family.column_family) %
+                    len(self.queues)]
+        else:
+            q = self.queues[self.next_queue]
+            self.next_queue = (self.next_queue + 1) % len(self.queues)
+
+        q.put((batcher, batch))
+
+    def wait(self):
+        for q in self.queues:
+            q.join()
+        self._check_error()
+
+    def close(self):
+        self.wait()
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+
+            batcher, batch = item
+            try:
+                batcher.write(batch)
+            except Exception, e:
+                self.log.exception("write of %s batch failed" %
+                        batcher._column_family.column_family)
+                self.error = e
+            finally:
+                self.inflight.release()
+                q.task_done()
+
 class CASSANDRA_DB(object):
     
     raw_cf = 'raw_data'
@@ -88,7 +383,8 @@ class CASSANDRA_DB(object):
     
     _queue_size = 200
     
-    def __init__(self, config, qname=None, timeout=30):
+    def __init__(self, config, qname=None, timeout=30,
+            write_retries=MutationBatcher.DEFAULT_RETRIES, write_threads=0):
         """
         Class contains all the relevent cassandra logic.  This includes:
         
@@ -97,6 +393,11 @@ class CASSANDRA_DB(object):
         * generating the metadata cache of last val/ts information,
         * store data/update the rate/aggregaion bins,
         * and execute queries to return data to the REST interface.
+
+        A failed batch write is retried write_retries times before the
+        error is raised, write_retries=None retries until it is written.
+        If write_threads is set the batches are written by a WritePipeline
+        with that many threads, call close() to stop them.
         """
         
         # Configure logging - if a qname has been passed in, hook
@@ -229,10 +530,41 @@ class CASSANDRA_DB(object):
         self.log.info('Connected to %s' % config.cassandra_servers)
         
         # Define column family connections for the code to use.
-        self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
-        self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
-        self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
-        self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
+        # The batches are written by a pool of threads if there is one, 
+        # the pool size leaves connections for the persister's reads.
+        self.pipeline = None
+        if write_threads:
+            self.pipeline = WritePipeline(write_threads,
+                    config.cassandra_max_inflight_batches, self.log)
+
+        # Timing - this turns the database call timing code on and off.
+        # db_profile_on_testing sums up the time spent in each kind of call
+        # and prints it at the end of a run of test data, which is useful
+        # for timing specific database calls in development.
+        # cassandra_metrics_sample keeps sampled latency histograms instead,
+        # which is cheap enough for production.
+        profiling = False
+        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
+            profiling = True
+        self.stats = DatabaseMetrics(profiling=profiling,
+                sample_every=config.cassandra_metrics_sample)
+        self.profiling = self.stats.enabled
+        metrics = None
+        if self.profiling:
+            metrics = self.stats
+
+        self.raw_data = MutationBatcher(ColumnFamily(self.pool, self.raw_cf),
+                self._queue_size, self.log, self.pipeline, metrics=metrics,
+                retries=write_retries)
+        self.rates    = MutationBatcher(ColumnFamily(self.pool, self.rate_cf),
+                self._queue_size, self.log, self.pipeline, metrics=metrics,
+                retries=write_retries, counters=True)
+        self.aggs     = MutationBatcher(ColumnFamily(self.pool, self.agg_cf),
+                self._queue_size, self.log, self.pipeline, metrics=metrics,
+                retries=write_retries, counters=True)
+        self.stat_agg = MutationBatcher(ColumnFamily(self.pool, self.stat_cf),
+                self._queue_size, self.log, self.pipeline, ordered=True,
+                metrics=metrics, retries=write_retries)
 
         # Used when a cf needs to be selected on the fly.
         self.cf_map = {
@@ -242,37 +574,95 @@ class CASSANDRA_DB(object):
             'stat': self.stat_agg
         }
         
-        # Timing - this turns the database call profiling code on and off.
-        # This is not really meant to be used in production and generally 
-        # just spits out statistics at the end of a run of test data.  Mostly
-        # useful for timing specific database calls to aid in development.
-        self.profiling = False
-        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
-            self.profiling = True
-        self.stats = DatabaseMetrics(profiling=self.profiling)
-        
         # Class members
         # Just the dict for the metadata cache.
         self.metadata_cache = {}
         self.aggregation_cache = {}
+        # Metadata loaded from a cache snapshot that hasn't been used yet.
+        self.snapshot_metadata = {}
+        self.snapshot_heartbeat = None
+        # Keys a metadata prefetch found no raw data for.
+        self.metadata_absent = {}
+        # Write-combining buffer for the rate aggregation counters, see
+        # update_rate_aggregation().
+        self.agg_buffer = {}
+        self.agg_flush_interval = config.cassandra_agg_flush_interval
+        self.last_checkpoint = time.time()
+        # Stat aggregation bins that have been updated in the aggregation 
+        # cache but not written, see update_stat_aggregation().
+        self.stat_dirty = {}
+        self.stat_flush_interval = config.cassandra_stat_flush_interval
+        self.last_stat_checkpoint = time.time()
         
     def flush(self):
         """
         Calling this will explicity flush all the batches to the 
-        server.  Generally only used in testing/dev scripts and not
+        server, including everything in the rate aggregation buffer.
+        Generally only used in testing/dev scripts and on shutdown, not
         in production when the batches will be self-flushing.
         """
         self.log.debug('Flush called')
-        self.raw_data.send()
-        self.rates.send()
-        self.aggs.send()
-        self.stat_agg.send()
+        self.flush_aggregations()
+        self.flush_stat_aggregations()
+        self.send(wait=True)
+
+    def send(self, wait=False):
+        """
+        Send all of the batches to the server.  Unlike flush() this does 
+        not write the rate aggregation buffer.  If wait is True this 
+        doesn't return until batches that failed have been written.
+        """
+        self.raw_data.send(wait)
+        self.rates.send(wait)
+        self.aggs.send(wait)
+        self.stat_agg.send(wait)
+
+    def checkpoint(self, wait=False):
+        """
+        Called by the persister when it is idle.  Writes the rate 
+        aggregation bins that have been buffered for longer than 
+        agg_flush_interval seconds and the stat aggregation bins that have 
+        been dirty for longer than stat_flush_interval seconds (so a crash 
+        loses at most that much aggregation data) and sends all of the 
+        batches.
+
+        Returns the Unix time before which everything that was stored has
+        been written, if wait is True.
+        """
+        now = time.time()
+        self.flush_aggregations(now - self.agg_flush_interval)
+        self.flush_stat_aggregations(now - self.stat_flush_interval)
+        self.send(wait)
+        return now - max(self.agg_flush_interval, self.stat_flush_interval)
+
+    def flush_aggregations(self, older_than=None):
+        """
+        Write the buffered rate aggregation bins that were started before
+        older_than (a Unix timestamp) or all of them.
+        """
+        t = time.time()
+        n = 0
+
+        for key, buf in self.agg_buffer.items():
+            if older_than is None or buf[4] <= older_than:
+                self._write_rate_aggregation(key, buf)
+                del self.agg_buffer[key]
+                n += 1
+
+        self.last_checkpoint = time.time()
+
+        if n:
+            self.log.debug('Wrote %d of %d buffered aggregations in %f seconds' 
+                    % (n, n + len(self.agg_buffer), self.last_checkpoint - t))
         
     def close(self):
         """
         Explicitly close the connection pool.
         """
         self.log.debug('Close/dispose called')
+        if self.pipeline:
+            self.pipeline.close()
+            self.pipeline = None
         self.pool.dispose()
         
     def set_raw_data(self, raw_data, ttl=None):
@@ -294,6 +684,24 @@ class CASSANDRA_DB(object):
             {raw_data.ts_to_jstime(): json.dumps(raw_data.val)}, **_kw)
         
         if self.profiling: self.stats.raw_insert(time.time() - t)
+
+    def set_raw_data_batch(self, rows, ttl=None):
+        """
+        Batch version of set_raw_data() used by the persister when storing
+        a whole poll result at once.
+
+        The rows arg is a list of (row_key, jstime, val) tuples.
+        """
+        _kw = {}
+        if ttl:
+            _kw['ttl'] = ttl
+
+        t = time.time()
+
+        for key, ts, val in rows:
+            self.raw_data.insert(key, {ts: json.dumps(val)}, **_kw)
+
+        if self.profiling: self.stats.raw_insert(time.time() - t, len(rows))
         
     def set_metadata(self, k, meta_d):
         """
@@ -309,6 +717,9 @@ class CASSANDRA_DB(object):
         as far back as SEEK_BACK_THRESHOLD to find the previous value.  If found,
         This is seeded to the cache and returned.  If not, this is presumed to be
         new, and the cache is seeded with the value that is passed in.
+
+        If a cache snapshot was loaded the value from the snapshot is used
+        instead of looking in the raw data, see load_cache_snapshot().
         
         The raw_data arg passes in is an instance of the RawData class defined
         in this module.
@@ -320,11 +731,28 @@ class CASSANDRA_DB(object):
         meta_d = None
         
         if not self.metadata_cache.has_key(raw_data.get_meta_key()):
+            snap_d, trusted = self._get_snapshot_metadata(
+                    raw_data.get_meta_key(), raw_data.ts_to_jstime(),
+                    raw_data.freq)
+            if trusted:
+                self.metadata_cache[raw_data.get_meta_key()] = snap_d
+                return Metadata(**snap_d)
+
+            if self._is_absent(raw_data.get_meta_key(), raw_data.ts_to_jstime()):
+                # A prefetch already looked, this is new.
+                meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
+                    min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
+                self.set_metadata(raw_data.get_meta_key(), meta_d)
+                return meta_d
+
             # Didn't find a value in the metadata cache.  First look
             # back through the raw data for SEEK_BACK_THRESHOLD seconds
-            # to see if we can find the last processed value.
+            # (or to the snapshot value if there is one) to see if we 
+            # can find the last processed value.
             ts_max = raw_data.ts_to_jstime() - 1 # -1ms to look at older vals
             ts_min = ts_max - SEEK_BACK_THRESHOLD
+            if snap_d:
+                ts_min = min(jstime(snap_d['last_update']), ts_max)
             ret = self.raw_data._column_family.multiget(
                     self._get_row_keys(raw_data.path, raw_data.freq,
                         ts_min, ts_max),
@@ -345,6 +773,9 @@ class CASSANDRA_DB(object):
                     freq=raw_data.freq, path=raw_data.path)
                 self.log.debug('Metadata lookup from raw_data for: %s' %
                         (raw_data.get_meta_key()))
+            elif snap_d:
+                # Nothing newer than the snapshot value.
+                meta_d = Metadata(**snap_d)
             else:
                 # No previous value was found (or at least not one in the defined
                 # time range) so seed/return the current value.
@@ -357,6 +788,245 @@ class CASSANDRA_DB(object):
             meta_d = Metadata(**self.metadata_cache[raw_data.get_meta_key()])
         
         return meta_d
+
+    def get_metadata_batch(self, paths, meta_keys, freq, ts, vals):
+        """
+        Batch version of get_metadata() for a set of measurements that were
+        all taken at the same time with the same frequency (ie: all of the
+        vars in one poll result).
+
+        The paths, meta_keys and vals args are parallel lists, ts is the
+        JavaScript timestamp of the measurements.  Anything not found in the 
+        metadata cache (or a trusted snapshot) is looked up in the raw data
+        with a single multiget and seeded to the cache the same way 
+        get_metadata() does it.
+
+        The return value is a list of the metadata cache entries (dicts)
+        parallel to the args.  The timestamps in an entry may be either 
+        datetime objects or JavaScript timestamps, use jstime() to read 
+        them and refresh_metadata() to update them.
+        """
+        entries = [self.metadata_cache.get(k) for k in meta_keys]
+
+        # Maps the index of a missing entry to its untrusted snapshot value
+        # (or None).
+        missing = {}
+
+        for i, e in enumerate(entries):
+            if e is not None:
+                continue
+            snap_d, trusted = self._get_snapshot_metadata(meta_keys[i], ts,
+                    freq)
+            if trusted:
+                self.metadata_cache[meta_keys[i]] = entries[i] = snap_d
+            elif snap_d is None and self._is_absent(meta_keys[i], ts):
+                self.metadata_cache[meta_keys[i]] = entries[i] = dict(
+                    path=paths[i], freq=freq, last_update=ts,
+                    last_val=vals[i], min_ts=ts)
+            else:
+                missing[i] = snap_d
+
+        if not missing:
+            return entries
+
+        t = time.time()
+
+        ts_max = ts - 1 # -1ms to look at older vals
+
+        # Keys with a snapshot value only need to look back as far as that
+        # value so look them up separately.
+        found = self._seek_back([meta_keys[i] for i, d in missing.iteritems()
+                if d is None], ts_max, ts_max - SEEK_BACK_THRESHOLD)
+
+        hinted = [i for i, d in missing.iteritems() if d is not None]
+        if hinted:
+            ts_min = min([jstime(missing[i]['last_update']) for i in hinted])
+            found.update(self._seek_back([meta_keys[i] for i in hinted],
+                ts_max, min(ts_min, ts_max)))
+
+        if self.profiling: self.stats.meta_fetch((time.time() - t), len(missing))
+
+        for i, snap_d in missing.iteritems():
+            if meta_keys[i] in found:
+                last_ts, last_val = found[meta_keys[i]]
+                meta_d = dict(path=paths[i], freq=freq, last_update=last_ts,
+                    last_val=last_val, min_ts=last_ts)
+            elif snap_d is not None:
+                meta_d = snap_d
+            else:
+                meta_d = dict(path=paths[i], freq=freq, last_update=ts,
+                    last_val=vals[i], min_ts=ts)
+
+            self.metadata_cache[meta_keys[i]] = entries[i] = meta_d
+
+        self.log.debug('Metadata lookup for %d keys, %d found in raw_data' %
+                (len(missing), len(found)))
+
+        return entries
+
+    def _seek_back(self, meta_keys, ts_max, ts_min):
+        """
+        Find the most recent raw value between ts_min and ts_max for each of
+        the metadata keys with one multiget.  The row keys are the same ones
+        _get_row_keys() would generate for each path.
+
+        Returns a dict mapping metadata keys to (ts, val) tuples.
+        """
+        if not meta_keys:
+            return {}
+
+        years = range(datetime.datetime.utcfromtimestamp(ts_min/1000.0).year,
+                datetime.datetime.utcfromtimestamp(ts_max/1000.0).year + 1)
+        row_keys = []
+        for k in meta_keys:
+            for year in years:
+                row_keys.append('%s%s%s' % (k, KEY_DELIMITER, year))
+
+        ret = self.raw_data._column_family.multiget(row_keys,
+                # Note: ts_max and ts_min appear to be reversed here - 
+                # that's because this is a reversed range query.
+                column_start=ts_max, column_finish=ts_min,
+                column_count=1, column_reversed=True)
+
+        found = {}
+        for k in meta_keys:
+            # Most recent year first.
+            for year in reversed(years):
+                cols = ret.get('%s%s%s' % (k, KEY_DELIMITER, year))
+                if cols:
+                    last_ts, last_val = cols.items()[0]
+                    found[k] = (last_ts, json.loads(last_val))
+                    break
+
+        return found
+
+    def prefetch_metadata(self, paths, freq, ts, max_age):
+        """
+        Seed the metadata cache for a set of paths with one multiget rather
+        than letting get_metadata() look them up one at a time.  Called by
+        the persister the first time it sees a device.
+
+        Paths that have no raw data are remembered so that get_metadata()
+        doesn't look for them again, as long as they show up no more than
+        max_age ms after ts.  Paths that are already cached (or in a 
+        snapshot) are skipped.
+
+        Returns the number of paths that were found.
+        """
+        t = time.time()
+
+        keys = []
+        for path in paths:
+            k = get_rowkey(path, freq=freq)
+            if not self.metadata_cache.has_key(k) and \
+                    not self.snapshot_metadata.has_key(k):
+                keys.append((k, path))
+
+        if not keys:
+            return 0
+
+        ts_max = ts - 1 # -1ms to look at older vals
+        found = self._seek_back([k for k, path in keys], ts_max,
+                ts_max - SEEK_BACK_THRESHOLD)
+
+        for k, path in keys:
+            if found.has_key(k):
+                last_ts, last_val = found[k]
+                self.metadata_cache[k] = dict(path=path, freq=freq,
+                    last_update=last_ts, last_val=last_val, min_ts=last_ts)
+            else:
+                self.metadata_absent[k] = (ts, max_age)
+
+        if self.profiling: self.stats.meta_fetch((time.time() - t), len(keys))
+
+        self.log.debug('Metadata prefetch for %d keys, %d found in raw_data' %
+                (len(keys), len(found)))
+
+        return len(found)
+
+    def _is_absent(self, k, ts):
+        """
+        True if a prefetch found no raw data for k recently enough to 
+        trust it for a measurement at ts.  Only good for one lookup.
+        """
+        if not self.metadata_absent:
+            return False
+
+        absent = self.metadata_absent.pop(k, None)
+        if absent is None:
+            return False
+
+        prefetch_ts, max_age = absent
+        return prefetch_ts <= ts <= prefetch_ts + max_age
+
+    def load_cache_snapshot(self, snapshot, heartbeat):
+        """
+        Seed the caches from a CacheSnapshot (see esmond.cache_snapshot).
+
+        Snapshot metadata is not put in the metadata cache directly.  The 
+        first time a key is looked up the snapshot value is only used if it
+        is no older than heartbeat times the frequency of the data, anything
+        older may have been superseded by another worker and is looked up 
+        as usual.  Values from a clean snapshot (written after all the 
+        batches were flushed on shutdown) are used as is.  Values from a
+        periodic snapshot may be behind the raw data if the worker died, so
+        they only narrow the raw data lookup.
+
+        The aggregation cache is only seeded from clean snapshots and only
+        with bins that are still open.
+        """
+        self.snapshot_heartbeat = heartbeat
+
+        for k, meta_d in snapshot.metadata.iteritems():
+            if not self.metadata_cache.has_key(k):
+                self.snapshot_metadata[k] = (meta_d, snapshot.clean)
+
+        n_agg = 0
+        if snapshot.clean:
+            now = time.time() * 1000
+            for k, bins in snapshot.aggregation.iteritems():
+                # The stat aggregation row key is the path followed by the
+                # aggregation frequency and year.
+                agg_freq = int(_split_rowkey(k)[-2])
+                bins = dict([(agg_ts, stat) for agg_ts, stat in 
+                    bins.iteritems() if agg_ts + agg_freq > now])
+                if bins and not self.aggregation_cache.get(k):
+                    self.aggregation_cache[k] = bins
+                    n_agg += 1
+
+        self.log.info('Loaded %s cache snapshot: %d metadata, %d aggregations' %
+                (snapshot.clean and 'clean' or 'periodic',
+                    len(self.snapshot_metadata), n_agg))
+
+    def _get_snapshot_metadata(self, k, ts, freq):
+        """
+        Return the snapshot metadata for k and whether or not it can be 
+        used as is.  The snapshot value is discarded once it's been looked 
+        at, from then on the metadata cache is authoritative.
+        """
+        if not self.snapshot_metadata:
+            return None, False
+
+        snap = self.snapshot_metadata.pop(k, None)
+        if snap is None:
+            return None, False
+
+        meta_d, clean = snap
+        if ts - jstime(meta_d['last_update']) > freq * self.snapshot_heartbeat:
+            return None, False
+
+        return meta_d, clean
+
+    def refresh_metadata(self, meta_d, ts, val):
+        """
+        Update a metadata cache entry returned by get_metadata_batch() with
+        a new value and JavaScript timestamp.  This is the batch equivalent
+        of Metadata.refresh_from_raw() and update_metadata().
+        """
+        if jstime(meta_d['min_ts']) > ts:
+            meta_d['min_ts'] = ts
+        meta_d['last_update'] = ts
+        meta_d['last_val'] = val
         
     def update_metadata(self, k, metadata):
         """
@@ -380,13 +1050,24 @@ class CASSANDRA_DB(object):
         
         t = time.time()
         # A super column insert.  Both val and is_valid are counter types.
-        try:
-            self.rates.insert(ratebin.get_key(),
-                {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
-        except MaximumRetryException:
-            self.log.warn("update_rate_bin failed. MaximumRetryException")
+        self.rates.insert(ratebin.get_key(),
+            {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
 
         if self.profiling: self.stats.baserate_update((time.time() - t))
+
+    def update_rate_bins(self, rows):
+        """
+        Batch version of update_rate_bin().
+
+        The rows arg is a list of (row_key, jstime, val, is_valid) tuples.
+        """
+
+        t = time.time()
+
+        for key, ts, val, is_valid in rows:
+            self.rates.insert(key, {ts: {'val': val, 'is_valid': is_valid}})
+
+        if self.profiling: self.stats.baserate_update((time.time() - t), len(rows))
         
     def update_rate_aggregation(self, raw_data, agg_ts, freq):
         """
@@ -394,6 +1075,11 @@ class CASSANDRA_DB(object):
         
         The args are a RawData object, the "compressed" aggregation timestamp
         and the frequency of the rollups in seconds.
+
+        The increments are not written right away.  They are summed in
+        agg_buffer for each row key and bin and the bin is written when 
+        a value for the next bin arrives, when it's been buffered for 
+        agg_flush_interval seconds or when flush() is called.
         """
         
         t = time.time()
@@ -403,16 +1089,56 @@ class CASSANDRA_DB(object):
             min=raw_data.val, max=raw_data.val, path=raw_data.path
         )
         
+        self._buffer_rate_aggregation(agg.get_key(), agg.ts_to_jstime(),
+                agg.val, str(agg.base_freq), t)
+
+        if t > self.last_checkpoint + self.agg_flush_interval:
+            self.flush_aggregations(t - self.agg_flush_interval)
+
+        if self.profiling: self.stats.aggregation_update((time.time() - t))
+
+    def update_rate_aggregations(self, rows):
+        """
+        Batch version of update_rate_aggregation().
+
+        The rows arg is a list of (row_key, agg_jstime, val, base_freq) 
+        tuples.
+        """
+
+        t = time.time()
+
+        for key, ts, val, base_freq in rows:
+            self._buffer_rate_aggregation(key, ts, val, str(base_freq), t)
+
+        if t > self.last_checkpoint + self.agg_flush_interval:
+            self.flush_aggregations(t - self.agg_flush_interval)
+
+        if self.profiling: self.stats.aggregation_update((time.time() - t), len(rows))
+
+    def _buffer_rate_aggregation(self, key, ts, val, base_freq, now):
+        """
+        Add an increment to the buffered bin for key.  The buffer holds 
+        one bin per row key as [ts, base_freq, val, count, time started].
+        """
+        buf = self.agg_buffer.get(key)
+
+        if buf is not None:
+            if buf[0] == ts and buf[1] == base_freq:
+                buf[2] += val
+                buf[3] += 1
+                return
+            # A new bin has been started, so the buffered one is done.
+            self._write_rate_aggregation(key, buf)
+
+        self.agg_buffer[key] = [ts, base_freq, val, 1, now]
+
+    def _write_rate_aggregation(self, key, buf):
+        ts, base_freq, val, count, started = buf
+
         # Super column update.  The base rate frequency is stored as the column
         # name key that is not 'val' - this will be used by the query interface
         # to generate the averages.  Both values are counter types.
-        try:
-            self.aggs.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): 1}})
-        except MaximumRetryException:
-            self.log.warn("update_rate_aggregation failed. MaximumRetryException")
-
-        if self.profiling: self.stats.aggregation_update((time.time() - t))
+        self.aggs.insert(key, {ts: {'val': val, base_freq: count}})
 
     def get_agg_from_cache(self, agg, raw_data):
         """
@@ -459,13 +1185,14 @@ class CASSANDRA_DB(object):
 
 
         if not self.aggregation_cache[agg.get_key()].get(agg.ts_to_jstime(), None):
-            # a new bin is being started, so blow away previous 
-            # timestamped key for this row and start again so as to 
-            # not be leaking memory.
+            # a new bin is being started, so write out the previous bin
+            # then blow away previous timestamped key for this row and 
+            # start again so as to not be leaking memory.
+            self._close_stat_bins(agg.get_key())
             self.aggregation_cache[agg.get_key()] = dict()
             # and update with the new aggregation bin values.  do not
-            # return a value so update_stat_aggregations will do the 
-            # initial insert().
+            # return a value so update_stat_aggregations will mark the 
+            # new bin dirty.
             self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()] = \
                 {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}
         else:
@@ -486,10 +1213,11 @@ class CASSANDRA_DB(object):
         Called by the persister to update the stat aggregations (ie: min/max).
         
         Unlike the other update code, this has to read from the appropriate bin 
-        to see if the min or max needs to be updated.  The update is done if 
-        need be, and the updated boolean is set to true and returned to the
-        calling code to flush the batch if need be.  Done that way to flush 
-        more than one batch update rather than doing it each time.
+        to see if the min or max needs to be updated.  The update is only 
+        made to the aggregation cache and the bin is marked dirty, dirty 
+        bins are written when the bin is finished, when they've been dirty
+        for stat_flush_interval seconds or when flush() is called.  Returns
+        True if the bin was updated.
         
         The args are a RawData object, the "compressed" aggregation timestamp
         and the frequency of the rollups in seconds.
@@ -510,31 +1238,122 @@ class CASSANDRA_DB(object):
         if self.profiling: self.stats.stat_fetch((time.time() - t))
         
         t = time.time()
+
+        updated = self._update_stat_bin(agg.get_key(), agg.ts_to_jstime(),
+                agg.val, raw_data.ts_to_jstime(), ret, t)
+
+        if t > self.last_stat_checkpoint + self.stat_flush_interval:
+            self.flush_stat_aggregations(t - self.stat_flush_interval)
+        
+        if self.profiling: self.stats.stat_update((time.time() - t))
         
+        return updated
+
+    def _update_stat_bin(self, key, agg_ts, val, ts, ret, now):
+        """
+        Update the min/max for an aggregation bin in the cache if need be.
+        The ret arg is the current cache entry for the bin as returned by
+        get_agg_from_cache() (None for a new bin, which the cache has 
+        already been seeded for).  Returns True if the bin was updated.
+        """
         if not ret:
-            # Bin does not exist, so initialize min and max with the same val.
-            # self.stat_agg.insert(agg.get_key(),
-            #     {agg.ts_to_jstime(): {'min': agg.val, 'max': agg.val}})
-            self.stat_agg.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}})
-            updated = True
-        elif agg.val > ret['max']:
+            # Bin does not exist, the cache already has min and max
+            # initialized with the same val.
+            pass
+        elif val > ret['max']:
             # Update max.
-            self.update_agg_cache(agg, raw_data, 'max')
-            self.stat_agg.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'max': agg.val, 'max_ts': raw_data.ts_to_jstime()}})
-            updated = True
-        elif agg.val < ret['min']:
-            self.update_agg_cache(agg, raw_data, 'min')
+            ret['max'] = val
+            ret['max_ts'] = ts
+        elif val < ret['min']:
             # Update min.
-            self.stat_agg.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'min': agg.val, 'min_ts': raw_data.ts_to_jstime()}})
-            updated = True
+            ret['min'] = val
+            ret['min_ts'] = ts
         else:
-            pass
-        
-        if self.profiling: self.stats.stat_update((time.time() - t))
-        
+            return False
+
+        self.stat_dirty.setdefault((key, agg_ts), now)
+
+        return True
+
+    def _close_stat_bins(self, key):
+        """Write out any dirty bins in the cache for key."""
+        for agg_ts, stat in self.aggregation_cache.get(key, {}).iteritems():
+            if self.stat_dirty.pop((key, agg_ts), None) is not None:
+                self._write_stat_bin(key, agg_ts, stat)
+
+    def _write_stat_bin(self, key, agg_ts, stat):
+        # Stat aggregations are not counters so the whole bin is just 
+        # written over whatever is there.
+        self.stat_agg.insert(key, {agg_ts: dict([(k, stat[k]) for k in
+            ('min', 'max', 'min_ts', 'max_ts') if stat.has_key(k)])})
+
+    def flush_stat_aggregations(self, older_than=None):
+        """
+        Write the dirty stat aggregation bins that were first updated 
+        before older_than (a Unix timestamp) or all of them.
+        """
+        n = 0
+
+        for (key, agg_ts), since in self.stat_dirty.items():
+            if older_than is None or since <= older_than:
+                stat = self.aggregation_cache.get(key, {}).get(agg_ts)
+                if stat:
+                    self._write_stat_bin(key, agg_ts, stat)
+                del self.stat_dirty[(key, agg_ts)]
+                n += 1
+
+        self.last_stat_checkpoint = time.time()
+
+        if n:
+            self.log.debug('Wrote %d dirty stat aggregations' % n)
+
+    def update_stat_aggregations(self, rows):
+        """
+        Batch version of update_stat_aggregation().  
+
+        The rows arg is a list of (row_key, agg_jstime, val, jstime) tuples.
+        Row keys that are not in the aggregation cache yet are looked up 
+        with one multiget per aggregation bin rather than one get each.
+        Returns True if any bin was updated.
+        """
+
+        t = time.time()
+
+        # Group the uncached row keys by bin so they can be looked up 
+        # together.
+        uncached = {}
+        for key, agg_ts, val, ts in rows:
+            if not self.aggregation_cache.get(key, None):
+                self.aggregation_cache[key] = dict()
+                uncached.setdefault(agg_ts, []).append(key)
+
+        for agg_ts, keys in uncached.iteritems():
+            ret = self.stat_agg._column_family.multiget(keys, 
+                        super_column=agg_ts)
+            for key, lookup in ret.iteritems():
+                self.aggregation_cache[key][agg_ts] = dict(lookup)
+
+        if self.profiling: self.stats.stat_fetch((time.time() - t), len(rows))
+
+        t = time.time()
+
+        updated = False
+
+        for key, agg_ts, val, ts in rows:
+            ret = self.aggregation_cache[key].get(agg_ts, None)
+            if not ret:
+                # A new bin, see get_agg_from_cache().
+                self._close_stat_bins(key)
+                self.aggregation_cache[key] = {agg_ts: 
+                    {'min': val, 'max': val, 'min_ts': ts, 'max_ts': ts}}
+            if self._update_stat_bin(key, agg_ts, val, ts, ret, t):
+                updated = True
+
+        if t > self.last_stat_checkpoint + self.stat_flush_interval:
+            self.flush_stat_aggregations(t - self.stat_flush_interval)
+
+        if self.profiling: self.stats.stat_update((time.time() - t), len(rows))
+
         return updated
         
     def _get_row_keys(self, path, freq, ts_min, ts_max):
@@ -587,6 +1406,8 @@ class CASSANDRA_DB(object):
         Query interface method to retrieve the base rates (generally average 
         but could be delta as well).
         """
+        t = time.time()
+
         cols = column_count
         if cols is None:
             ret_count = self.rates._column_family.multiget_count(
@@ -617,6 +1438,8 @@ class CASSANDRA_DB(object):
             for kk,vv in v.items():
                 results.append({'ts': kk, 'val': float(vv['val']) / value_divisors[cf], 
                                         'is_valid': vv['is_valid']})
+
+        if self.profiling: self.stats.query_baserate((time.time() - t), len(results))
             
         return results
 
@@ -627,6 +1450,7 @@ class CASSANDRA_DB(object):
         be average/min/max.  Different column families will be queried 
         depending on what value "cf" is set to.
         """
+        t = time.time()
                 
         if cf not in AGG_TYPES:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
@@ -697,6 +1521,8 @@ class CASSANDRA_DB(object):
                     else:
                         datum = {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
                         results.append(datum)
+
+        if self.profiling: self.stats.query_aggregation((time.time() - t), len(results))
         
         return results
             
@@ -705,6 +1531,8 @@ class CASSANDRA_DB(object):
         """
         Query interface to query the raw data.
         """
+        t = time.time()
+
         cols = column_count
         if cols is None:
             ret_count = self.raw_data._column_family.multiget_count(
@@ -726,6 +1554,8 @@ class CASSANDRA_DB(object):
         for k,v in ret.items():
             for kk,vv in v.items():
                 results.append({'ts': kk, 'val': json.loads(vv)})
+
+        if self.profiling: self.stats.query_raw((time.time() - t), len(results))
         
         return results
 
@@ -733,6 +1563,7 @@ class CASSANDRA_DB(object):
         """
         Query interface to query the raw data.
         """
+        t = time.time()
         key = get_rowkey(path,freq,year)
         ret = self.raw_data._column_family.get(
                 key,
@@ -743,12 +1574,14 @@ class CASSANDRA_DB(object):
         results=[]
         for k,v in ret.items():
             results.append({'ts': k, 'val': json.loads(v)})
+        if self.profiling: self.stats.query_raw_first((time.time() - t), len(results))
         return results
 
     def query_raw_last(self, path=None, freq=None, year=None):
         """
         Query interface to query the raw data.
         """
+        t = time.time()
         key = get_rowkey(path,freq,year)
         ret = self.raw_data._column_family.get(
                 key,
@@ -760,6 +1593,7 @@ class CASSANDRA_DB(object):
         results=[]
         for k,v in ret.items():
             results.append({'ts': k, 'val': json.loads(v)})
+        if self.profiling: self.stats.query_raw_last((time.time() - t), len(results))
         return results
 
     def __del__(self):
@@ -770,8 +1604,16 @@ class CASSANDRA_DB(object):
 class DatabaseMetrics(object):
     """
     Code to handle calculating timing statistics for discrete database
-    calls in the CASSANDRA_DB module.  Generally only used in development 
-    to produce statistics when pushing runs of test data through it.
+    calls in the CASSANDRA_DB module.
+
+    When profiling the time spent in and the number of items handled by
+    every call are summed up, report() prints them at the end of a run of
+    test data.  With a sample_every of N the latency of about one in N 
+    calls of each kind is also counted in a LogHistogram, so the memory
+    used is fixed and most calls only cost a few counter updates.  That is
+    meant for production, snapshot() returns the histograms along with the
+    number of calls and items.  The batch writes are reported from the
+    WritePipeline threads as well, so the sampled numbers are approximate.
     """
     
     # List of attributes to generate/method names.
@@ -782,13 +1624,31 @@ class DatabaseMetrics(object):
         'meta_fetch',
         'stat_fetch', 
         'stat_update',
+        'batch_write',
+        'query_baserate',
+        'query_aggregation',
+        'query_raw',
+        'query_raw_first',
+        'query_raw_last',
     ]
     _all_metrics = _individual_metrics + ['total', 'all']
     
-    def __init__(self, profiling=False):
+    def __init__(self, profiling=False, sample_every=0):
         
         self.profiling = profiling
-        
+        self.sample_every = sample_every
+        self.enabled = bool(profiling or sample_every)
+
+        if self.sample_every:
+            self.calls = dict((m, 0) for m in self._individual_metrics)
+            self.items = dict((m, 0) for m in self._individual_metrics)
+            self.histograms = dict((m, LogHistogram())
+                    for m in self._individual_metrics)
+            # Calls left until the next sample, randomized so that calls
+            # made in a regular pattern don't skew the samples.
+            self.countdown = dict((m, self._next_sample())
+                    for m in self._individual_metrics)
+
         if not self.profiling:
             return
         
@@ -796,34 +1656,95 @@ class DatabaseMetrics(object):
         for im in self._individual_metrics:
             setattr(self, '%s_time' % im, 0)
             setattr(self, '%s_count' % im, 0)
+
+    def _next_sample(self):
+        return random.randint(1, 2 * self.sample_every - 1)
         
-    def _increment(self, m, t):
+    def _increment(self, m, t, count=1):
         """
         Actual logic called by named wrapper methods.  Increments
-        the time sums and counts for the various db calls.
+        the time sums and counts for the various db calls.  The batch
+        calls pass in the number of items they handled as count.
         """
+        if self.sample_every:
+            self.calls[m] += 1
+            self.items[m] += count
+            self.countdown[m] -= 1
+            if self.countdown[m] <= 0:
+                self.countdown[m] = self._next_sample()
+                self.histograms[m].add(t)
+
+        if not self.profiling:
+            return
+
         setattr(self, '%s_time' % m, getattr(self, '%s_time' % m) + t)
-        setattr(self, '%s_count' % m, getattr(self, '%s_count' % m) + 1)
+        setattr(self, '%s_count' % m, getattr(self, '%s_count' % m) + count)
         
     # These are all wrapper methods that call _increment()
 
-    def raw_insert(self, t):
-        self._increment('raw_insert', t)
+    def raw_insert(self, t, count=1):
+        self._increment('raw_insert', t, count)
 
-    def baserate_update(self, t):
-        self._increment('baserate_update', t)
+    def baserate_update(self, t, count=1):
+        self._increment('baserate_update', t, count)
 
-    def aggregation_update(self, t):
-        self._increment('aggregation_update', t)
+    def aggregation_update(self, t, count=1):
+        self._increment('aggregation_update', t, count)
         
-    def meta_fetch(self, t):
-        self._increment('meta_fetch', t)
+    def meta_fetch(self, t, count=1):
+        self._increment('meta_fetch', t, count)
         
-    def stat_fetch(self, t):
-        self._increment('stat_fetch', t)
+    def stat_fetch(self, t, count=1):
+        self._increment('stat_fetch', t, count)
+
+    def stat_update(self, t, count=1):
+        self._increment('stat_update', t, count)
+
+    def batch_write(self, t, count=1):
+        self._increment('batch_write', t, count)
+
+    def query_baserate(self, t, count=1):
+        self._increment('query_baserate', t, count)
 
-    def stat_update(self, t):
-        self._increment('stat_update', t)
+    def query_aggregation(self, t, count=1):
+        self._increment('query_aggregation', t, count)
+
+    def query_raw(self, t, count=1):
+        self._increment('query_raw', t, count)
+
+    def query_raw_first(self, t, count=1):
+        self._increment('query_raw_first', t, count)
+
+    def query_raw_last(self, t, count=1):
+        self._increment('query_raw_last', t, count)
+
+    def snapshot(self, reset=False):
+        """
+        The statistics for each kind of database call that has been made,
+        as a dict.  When profiling it has the time spent and the number of
+        items handled so far, when sampling the number of calls and items
+        and the latency histogram since the last reset.  Empty if neither.
+        """
+        stats = {}
+
+        if self.profiling:
+            for m in self._individual_metrics:
+                stats[m] = dict(time=getattr(self, '%s_time' % m),
+                        count=getattr(self, '%s_count' % m))
+
+        if self.sample_every:
+            for m in self._individual_metrics:
+                if not self.calls[m]:
+                    continue
+                stats.setdefault(m, {}).update(calls=self.calls[m],
+                        items=self.items[m],
+                        latency=self.histograms[m].to_dict())
+                if reset:
+                    self.calls[m] = 0
+                    self.items[m] = 0
+                    self.histograms[m].reset()
+
+        return stats
         
     def report(self, metric='all'):
         """
@@ -843,7 +1764,7 @@ class DatabaseMetrics(object):
         time = count = 0
             
         if metric in self._individual_metrics:
-            datatype, action = metric.split('_')
+            datatype, action = metric.split('_', 1)
             action = action.title()
             time = getattr(self, '%s_time' % metric)
             count = getattr(self, '%s_count' % metric)
@@ -1105,6 +2026,16 @@ class AggregationBin(BaseRateBin):
     def average(self):
         return self.val / (self.count * (self.base_freq/1000.0))
 
+def jstime(d):
+    """
+    Return a JavaScript timestamp given either a datetime object or a 
+    JavaScript timestamp (the metadata cache can hold either).
+    """
+    if type(d) == datetime.datetime:
+        return calendar.timegm(d.utctimetuple()) * 1000
+    else:
+        return int(d)
+
 def escape_path(path):
     escaped = []
     for step in path:
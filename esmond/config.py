@@ -5,6 +5,7 @@ from logging.handlers import SysLogHandler
 import ConfigParser
 
 from esmond.error import ConfigError
+from esmond.pollcodec import FORMATS as POLL_RESULT_FORMATS
 
 def get_config_path():
     if os.environ.has_key('ESMOND_CONF'):
@@ -53,11 +54,16 @@ class EsmondConfig(object):
         self.api_throttle_at = None
         self.api_throttle_timeframe = None
         self.api_throttle_expiration = None
+        self.cassandra_agg_flush_interval = 900
         self.cassandra_keyspace = 'esmond'
+        self.cassandra_max_inflight_batches = 8
+        self.cassandra_metrics_sample = 0
         self.cassandra_pass = None
         self.cassandra_servers = []
+        self.cassandra_stat_flush_interval = 300
         self.cassandra_user = None
         self.cassandra_replicas = 1
+        self.cassandra_write_threads = 4
         # Leave this here so testing code can explicitly set but remove
         # from config file parsing.
         self.db_clear_on_testing = False
@@ -72,9 +78,27 @@ class EsmondConfig(object):
         self.htpasswd_file = None
         self.mib_dirs = []
         self.mibs = []
+        self.persist_autoscale_backlog = 1000
+        self.persist_autoscale_interval = 60
+        self.persist_balance_dir = None
+        self.persist_flush_threshold = 0
+        self.persist_idle_flush = 1.0
+        self.persist_queue_dir = None
+        self.persist_stats_dir = None
+        self.persister_batch_store = False
+        self.persister_history_digests = False
+        self.persister_snapshot_dir = None
+        self.persister_snapshot_interval = 300
         self.pid_dir = None
+        self.poll_adaptive = False
+        self.poll_instance = None
+        self.poll_lease_time = 60
+        self.poll_leases = False
+        self.poll_processes = 1
         self.poll_retries = 5
         self.poll_timeout = 2
+        self.poll_tuning_dir = None
+        self.poll_walk_columns = 1
         self.profile_persister = False
         self.reload_interval = 1*10
         self.rrd_path = None
@@ -114,9 +138,14 @@ class EsmondConfig(object):
                 'api_throttle_at',
                 'api_throttle_timeframe',
                 'api_throttle_expiration',
+                'cassandra_agg_flush_interval',
+                'cassandra_max_inflight_batches',
+                'cassandra_metrics_sample',
                 'cassandra_pass',
                 'cassandra_servers',
+                'cassandra_stat_flush_interval',
                 'cassandra_user',
+                'cassandra_write_threads',
                 'db_profile_on_testing',
                 'db_uri',
                 'debug',
@@ -129,9 +158,27 @@ class EsmondConfig(object):
                 'htpasswd_file',
                 'mib_dirs',
                 'mibs',
+                'persist_autoscale_backlog',
+                'persist_autoscale_interval',
+                'persist_balance_dir',
+                'persist_flush_threshold',
+                'persist_idle_flush',
+                'persist_queue_dir',
+                'persist_stats_dir',
+                'persister_batch_store',
+                'persister_history_digests',
+                'persister_snapshot_dir',
+                'persister_snapshot_interval',
                 'pid_dir',
+                'poll_adaptive',
+                'poll_instance',
+                'poll_lease_time',
+                'poll_leases',
+                'poll_processes',
                 'poll_retries',
                 'poll_timeout',
+                'poll_tuning_dir',
+                'poll_walk_columns',
                 'profile_persister',
                 'reload_interval',
                 'rrd_path',
@@ -153,6 +200,10 @@ class EsmondConfig(object):
 
         boolean_options = (
             'db_profile_on_testing',
+            'persister_batch_store',
+            'persister_history_digests',
+            'poll_adaptive',
+            'poll_leases',
             'profile_persister',
             'debug',
         )
@@ -172,6 +223,34 @@ class EsmondConfig(object):
             self.persist_queues[key] = val.split(':', 1)
             self.persist_queues[key][1] = int(self.persist_queues[key][1])
 
+        self.persist_autoscale = {}
+        if cfg.has_section("persist_autoscale"):
+            for key, val in cfg.items("persist_autoscale"):
+                if key == 'esmond_root': continue
+                if key not in self.persist_queues:
+                    raise ConfigError("persist_autoscale: unknown queue: %s"
+                            % key)
+                try:
+                    min_workers = int(val)
+                except ValueError:
+                    raise ConfigError("persist_autoscale: bad minimum for %s: %s"
+                            % (key, val))
+                if not 1 <= min_workers <= self.persist_queues[key][1]:
+                    raise ConfigError("persist_autoscale: minimum for %s must be between 1 and %d"
+                            % (key, self.persist_queues[key][1]))
+                self.persist_autoscale[key] = min_workers
+
+            if self.persist_autoscale and not self.persist_balance_dir:
+                raise ConfigError("persist_autoscale requires persist_balance_dir")
+
+        self.persist_formats = {}
+        if cfg.has_section("persist_formats"):
+            for key, val in cfg.items("persist_formats"):
+                if key == 'esmond_root': continue
+                if val not in POLL_RESULT_FORMATS:
+                    raise ConfigError("unknown format for %s: %s" % (key, val))
+                self.persist_formats[key] = val
+
         if self.espoll_persist_uri:
             self.espoll_persist_uri = \
                 self.espoll_persist_uri.replace(' ', '').split(',')
@@ -189,12 +268,38 @@ class EsmondConfig(object):
             self.mibs = map(str.strip, self.mibs.split(','))
         if self.cassandra_servers:
             self.cassandra_servers = map(str.strip, self.cassandra_servers.split(','))
+        if self.cassandra_agg_flush_interval:
+            self.cassandra_agg_flush_interval = int(self.cassandra_agg_flush_interval)
+        if self.cassandra_stat_flush_interval:
+            self.cassandra_stat_flush_interval = int(self.cassandra_stat_flush_interval)
+        if self.cassandra_write_threads:
+            self.cassandra_write_threads = int(self.cassandra_write_threads)
+        if self.cassandra_max_inflight_batches:
+            self.cassandra_max_inflight_batches = int(self.cassandra_max_inflight_batches)
+        if self.cassandra_metrics_sample:
+            self.cassandra_metrics_sample = int(self.cassandra_metrics_sample)
+        if self.persist_flush_threshold:
+            self.persist_flush_threshold = int(self.persist_flush_threshold)
+        if self.persist_idle_flush:
+            self.persist_idle_flush = float(self.persist_idle_flush)
+        if self.persist_autoscale_backlog:
+            self.persist_autoscale_backlog = int(self.persist_autoscale_backlog)
+        if self.persist_autoscale_interval:
+            self.persist_autoscale_interval = int(self.persist_autoscale_interval)
         if self.poll_timeout:
             self.poll_timeout = int(self.poll_timeout)
+        if self.poll_lease_time:
+            self.poll_lease_time = int(self.poll_lease_time)
+        if self.poll_processes:
+            self.poll_processes = int(self.poll_processes)
         if self.poll_retries:
             self.poll_retries = int(self.poll_retries)
+        if self.poll_walk_columns:
+            self.poll_walk_columns = int(self.poll_walk_columns)
         if self.reload_interval:
             self.reload_interval = int(self.reload_interval)
+        if self.persister_snapshot_interval:
+            self.persister_snapshot_interval = int(self.persister_snapshot_interval)
         if self.api_anon_limit:
             self.api_anon_limit = int(self.api_anon_limit)
         if self.api_throttle_at:
@@ -204,6 +309,8 @@ class EsmondConfig(object):
         if self.api_throttle_expiration:
             self.api_throttle_expiration = int(self.api_throttle_expiration)
 
+        if self.poll_leases and self.poll_lease_time <= self.reload_interval:
+            raise ConfigError("invalid config: poll_lease_time must be longer than reload_interval")
 
 
         if self.error_email_to is not None \
@@ -0,0 +1,208 @@
+"""
+Consistent hashing of poll result keys onto persister workers.
+
+Each worker gets a number of points on the ring proportional to its weight
+and a key belongs to the worker with the first point at or after the hash of
+the key.  The assignment only depends on the workers and their weights so
+every poller computes the same one, and adding a worker only moves the keys
+that land on its points.
+
+The weights and any keys that have been moved off of the worker the ring
+gives them (overrides) are kept in a balance file shared by the pollers.
+plan_moves() uses the measured cost of each key to pick keys to move from
+the busiest workers to the least busy ones.  set_active_workers() gives the
+workers past the active ones a weight of 0, which is how espersistd retires
+workers when it scales a queue down.
+
+A key must not be stored by two workers at once, so when the assignment
+changes the balance file also gets a handoff: the weights and overrides the
+keys are moving from, the time of the change and, once every poller has
+seen the change, a fence for each worker.  The pollers hold the results for
+the keys that are moving until the handoff is removed, which espersistd
+does once every worker has written everything that was queued for it
+before its fence.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import time
+
+POINTS_PER_WORKER = 100
+
+def hash_key(s):
+    """A stable 64 bit hash of the str s, the same in every process."""
+    return int(hashlib.md5(s).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    A ring of workers.  weights maps each worker to its weight (1.0 being
+    normal), a worker with a weight of 0 gets no keys.
+    """
+    def __init__(self, weights):
+        self.weights = weights
+        points = []
+
+        for worker, weight in weights.iteritems():
+            for i in xrange(int(round(POINTS_PER_WORKER * weight))):
+                points.append((hash_key('%s-%d' % (worker, i)), worker))
+
+        if not points:
+            raise ValueError("a HashRing needs at least one weighted worker")
+
+        points.sort()
+        self.hashes = [p[0] for p in points]
+        self.workers = [p[1] for p in points]
+
+    def get_worker(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        i = bisect.bisect(self.hashes, hash_key(key))
+        if i == len(self.hashes):
+            i = 0
+        return self.workers[i]
+
+def plan_moves(costs, workers, tolerance=0.1):
+    """
+    costs maps each worker to a dict of {key: cost} for the keys it handled.
+    Returns a list of (key, from_worker, to_worker) moves that even out the
+    total cost per worker to within tolerance (a fraction of the average
+    cost per worker).
+
+    Keys are moved greedily from the busiest worker to the least busy one,
+    picking the costliest key that doesn't overshoot.
+    """
+    load = dict((w, 0.0) for w in workers)
+    keys = dict((w, {}) for w in workers)
+
+    for worker, worker_costs in costs.iteritems():
+        if worker not in load:
+            continue
+        for key, cost in worker_costs.iteritems():
+            load[worker] += cost
+            keys[worker][key] = cost
+
+    if not load:
+        return []
+
+    limit = tolerance * sum(load.values()) / len(load)
+    moves = []
+
+    while True:
+        busiest = max(load, key=lambda w: load[w])
+        idlest = min(load, key=lambda w: load[w])
+        gap = load[busiest] - load[idlest]
+        if gap <= limit:
+            break
+
+        # The costliest key that makes the gap smaller.
+        candidates = [(cost, key) for key, cost in keys[busiest].iteritems()
+                        if cost < gap]
+        if not candidates:
+            break
+        cost, key = max(candidates)
+
+        del keys[busiest][key]
+        keys[idlest][key] = cost
+        load[busiest] -= cost
+        load[idlest] += cost
+        moves.append((key, busiest, idlest))
+
+    return moves
+
+def _read_weights(balance):
+    weights = dict((int(w), float(weight))
+                    for w, weight in balance.get('weights', {}).iteritems())
+    overrides = dict((k, int(w))
+                    for k, w in balance.get('overrides', {}).iteritems())
+    return weights, overrides
+
+def read_balance(filename):
+    """
+    Read the worker weights, key overrides and the handoff in progress (or
+    None) written by write_balance_file().  Returns empty dicts and None if
+    there is no file.
+    """
+    try:
+        f = open(filename)
+    except IOError:
+        return {}, {}, None
+
+    try:
+        balance = json.load(f)
+    finally:
+        f.close()
+
+    weights, overrides = _read_weights(balance)
+
+    handoff = balance.get('handoff')
+    if handoff:
+        prev_weights, prev_overrides = _read_weights(handoff)
+        handoff = dict(weights=prev_weights, overrides=prev_overrides,
+                since=float(handoff['since']),
+                fences=dict((int(w), int(seq)) for w, seq in
+                    handoff.get('fences', {}).iteritems()))
+
+    return weights, overrides, handoff
+
+def read_balance_file(filename):
+    """
+    Read the worker weights and key overrides written by
+    write_balance_file().  Returns empty dicts if there is no file.
+    """
+    weights, overrides, handoff = read_balance(filename)
+    return weights, overrides
+
+def write_balance_file(filename, weights, overrides, handoff=None):
+    """Atomically replace filename with the given weights, overrides and
+    handoff."""
+    balance = dict(weights=weights, overrides=overrides)
+    if handoff:
+        balance['handoff'] = handoff
+
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmp, 'w')
+    try:
+        json.dump(balance, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+def start_handoff(handoff, weights, overrides, now=None):
+    """
+    The handoff to record when the assignment is changed from weights and
+    overrides.  If a handoff is already in progress the keys are still
+    moving from its assignment, it starts over with no fences.
+    """
+    if now is None:
+        now = time.time()
+    if handoff:
+        weights = handoff['weights']
+        overrides = handoff['overrides']
+    return dict(weights=weights, overrides=overrides, since=now, fences={})
+
+def set_active_workers(filename, num_workers, active, now=None):
+    """
+    Update the balance file so that only workers 1 through active of
+    num_workers get keys.  Workers that become active again get a weight of
+    1.0 unless they had a weight of their own, overrides pointing to
+    retired workers are dropped.  Starts a handoff if anything changed.
+    """
+    weights, overrides, handoff = read_balance(filename)
+    new_weights = dict(weights)
+
+    for w in xrange(1, num_workers + 1):
+        if w > active:
+            new_weights[w] = 0.0
+        elif not new_weights.get(w, 1.0):
+            new_weights[w] = 1.0
+
+    new_overrides = dict((k, w) for k, w in overrides.iteritems()
+                            if w <= active)
+
+    if new_weights == weights and new_overrides == overrides:
+        return
+
+    write_balance_file(filename, new_weights, new_overrides,
+            start_handoff(handoff, weights, overrides, now))
@@ -0,0 +1,97 @@
+"""
+Leases that divide the devices between espolld instances on several hosts.
+
+Each instance records a heartbeat in the PollerInstance table when it
+reloads.  The active devices are assigned to the live instances, those with
+a heartbeat in the last poll_lease_time seconds, with a HashRing so every
+instance computes the same assignment and only the devices of an instance
+that comes or goes are moved.
+
+An instance only polls a device while it holds the DeviceLease for it, and
+renews its leases on every reload.  It gives up the leases of devices that
+are assigned to another instance.  The lease of an instance that has
+stopped expires after poll_lease_time seconds and the device is taken over
+by the instance it is assigned to now.  A device is never leased to two
+instances at once, even while they disagree about which instances are
+live.
+"""
+
+import datetime
+
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now as tz_now
+
+from esmond.api.models import DeviceLease, PollerInstance
+from esmond.hashring import HashRing
+
+class LeaseManager(object):
+    """Leases devices for the espolld instance called instance."""
+
+    def __init__(self, instance, lease_time):
+        self.instance = instance
+        self.lease_time = datetime.timedelta(seconds=lease_time)
+
+    def heartbeat(self, now):
+        PollerInstance.objects.update_or_create(name=self.instance,
+                defaults=dict(heartbeat=now))
+
+    def live_instances(self, now):
+        return sorted(PollerInstance.objects.filter(
+                heartbeat__gt=now - self.lease_time).values_list('name',
+                    flat=True))
+
+    def assign(self, device_names, instances):
+        """The names in device_names that are assigned to this instance."""
+        ring = HashRing(dict((i.encode('utf-8'), 1.0) for i in instances))
+        return set(name for name in device_names
+                if ring.get_worker(name) == self.instance)
+
+    def claim(self, device_names, now=None):
+        """
+        Record a heartbeat, renew and take the leases of the devices in
+        device_names that are assigned to this instance and give up the
+        rest.  Returns the set of device names this instance holds the
+        lease for.
+        """
+        if now is None:
+            now = tz_now()
+        expires = now + self.lease_time
+
+        self.heartbeat(now)
+        instances = self.live_instances(now)
+        if self.instance not in instances:
+            instances.append(self.instance)
+        assigned = self.assign(device_names, instances)
+
+        mine = DeviceLease.objects.filter(owner=self.instance)
+        held = set(mine.values_list('device_name', flat=True))
+
+        moved = held - assigned
+        if moved:
+            mine.filter(device_name__in=list(moved)).delete()
+            held -= moved
+        mine.update(expires=expires)
+
+        for name in assigned - held:
+            # expired (or not there)
+            if DeviceLease.objects.filter(device_name=name,
+                    expires__lte=now).update(owner=self.instance,
+                            expires=expires):
+                held.add(name)
+                continue
+
+            try:
+                with transaction.atomic():
+                    DeviceLease.objects.create(device_name=name,
+                            owner=self.instance, expires=expires)
+            except IntegrityError:
+                # still leased to another instance
+                continue
+            held.add(name)
+
+        return held
+
+    def release(self):
+        """Give up all leases so other instances can take over right away."""
+        DeviceLease.objects.filter(owner=self.instance).delete()
+        PollerInstance.objects.filter(name=self.instance).delete()
@@ -0,0 +1,146 @@
+"""
+Fixed memory latency histograms and the stats files they are reported in.
+
+A LogHistogram counts values in buckets that grow by a constant ratio, four
+per doubling, from MIN_VALUE up.  That keeps the relative error of a
+percentile under 10% whatever the scale of the values with a fixed number of
+buckets, so adding a value is just a log() and an increment and two
+histograms can be merged by adding up their counts.
+
+The persisters write their histograms to a JSON stats file per worker queue
+in persist_stats_dir, espersistq reads them with read_stats_files().
+"""
+
+import json
+import math
+import os
+import time
+
+MIN_VALUE = 1e-6
+BUCKETS_PER_DOUBLING = 4
+NUM_BUCKETS = 128
+
+_LOG_RATIO = math.log(2) / BUCKETS_PER_DOUBLING
+
+class LogHistogram(object):
+    """A histogram of positive values, such as latencies in seconds."""
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value, n=1):
+        """Count value n times."""
+        if value > MIN_VALUE:
+            i = int(math.log(value / MIN_VALUE) / _LOG_RATIO) + 1
+            if i >= NUM_BUCKETS:
+                i = NUM_BUCKETS - 1
+        else:
+            i = 0
+
+        self.counts[i] += n
+        self.count += n
+        self.sum += value * n
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            if n:
+                self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def percentile(self, p):
+        """
+        The value that p percent of the values are at or below, rounded up to
+        the upper bound of its bucket (but never more than the largest value
+        seen).  0 if the histogram is empty.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+
+        return min(MIN_VALUE * math.exp(i * _LOG_RATIO), self.max)
+
+    def to_dict(self):
+        """A JSON friendly form of the histogram, see from_dict()."""
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                counts=dict((str(i), n) for i, n in enumerate(self.counts) if n))
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls()
+        for i, n in d['counts'].iteritems():
+            h.counts[int(i)] = n
+        h.count = d['count']
+        h.sum = d['sum']
+        h.max = d['max']
+        return h
+
+def write_stats_file(filename, stats):
+    """
+    Atomically replace filename with stats, a JSON friendly dict.  The time
+    it was written is added as 'written'.
+    """
+    stats = dict(stats, written=time.time())
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmp, 'w')
+    try:
+        json.dump(stats, f)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+def read_stats_files(directory, max_age=None):
+    """
+    Read the stats files in directory.  Returns a dict mapping each worker
+    queue name to its stats, leaving out files written more than max_age
+    seconds ago.
+    """
+    stats = {}
+    now = time.time()
+
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return stats
+
+    for name in names:
+        if not name.endswith('.stats'):
+            continue
+
+        try:
+            f = open(os.path.join(directory, name))
+            try:
+                s = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            continue
+
+        if max_age is not None and now - s.get('written', 0) > max_age:
+            continue
+
+        stats[name[:-len('.stats')]] = s
+
+    return stats
@@ -5,6 +5,7 @@ import os
 import os.path
 import sys
 import time
+import calendar
 import signal
 import errno
 import datetime
@@ -12,14 +13,17 @@ import cProfile
 import pstats
 import __main__
 
+from collections import deque
 from math import floor, ceil
 from subprocess import Popen, PIPE, STDOUT
 
 import cPickle as pickle
 
 import json
+import hashlib
 
 import django
+from django.db import transaction
 from django.utils.timezone import now, utc, make_aware
 
 try:
@@ -35,12 +39,20 @@ from esmond.util import setproctitle, init_logging, get_logger, \
 from esmond.util import daemonize, setup_exc_handler, max_datetime
 from esmond.config import get_opt_parser, get_config, get_config_path
 from esmond.error import ConfigError
-from esmond.api.dataseries import fit_to_bins
+from esmond.api.dataseries import fit_to_bins, bin_layout, fit_delta_to_bins
 
 from esmond.api.models import Device, OIDSet, IfRef, ALUSAPRef, LSPOpStatus, \
-                              OutletRef
+                              OutletRef, HistoryTableDigest
 
-from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin, AggregationBin, MaximumRetryException
+from esmond.cache_snapshot import read_snapshot, write_snapshot, SnapshotError
+from esmond.segmentlog import SegmentLog
+from esmond.metrics import LogHistogram, write_stats_file, read_stats_files
+from esmond import pollcodec
+from esmond.hashring import HashRing, plan_moves, read_balance, \
+     read_balance_file, write_balance_file, set_active_workers, start_handoff
+from esmond.pollcodec import CodecError
+from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin, AggregationBin, MaximumRetryException, \
+        KEY_DELIMITER, escape_path, jstime
 
 
 try:
@@ -52,6 +64,7 @@ except ImportError:
         raise Exception('no memcache library found')
 
 PERSIST_SLEEP_TIME = 1
+PERSIST_MIN_SLEEP_TIME = 0.01
 HEARTBEAT_FREQ_MULTIPLIER = 3
 
 class PollResult(object):
@@ -75,15 +88,19 @@ class PollResult(object):
     ``metadata``
         a dict of additional data about this data.  some PollPersisters require
         specific keys to exist in the ``metadata`` dict.
+    ``enqueue_ts``
+        the time the result was put on a persist queue, set by the
+        ``PersistHandler``.
     """
     def __init__(self, oidset_name, device_name, oid_name, timestamp, data,
-            metadata, **kwargs):
+            metadata, enqueue_ts=None, **kwargs):
         self.oidset_name = oidset_name
         self.device_name = device_name
         self.oid_name = oid_name
         self.timestamp = timestamp
         self.data = data
         self.metadata = metadata
+        self.enqueue_ts = enqueue_ts
 
     def __str__(self):
         return '%s.%s %d' % (self.device_name, self.oidset_name,
@@ -103,7 +120,8 @@ class PollResult(object):
             oid_name=self.oid_name,
             timestamp=self.timestamp,
             data=self.data,
-            metadata=self.metadata))
+            metadata=self.metadata,
+            enqueue_ts=self.enqueue_ts))
 
 class PersistQueueEmpty:
     pass
@@ -111,6 +129,10 @@ class PersistQueueEmpty:
 class PollPersister(object):
     """A PollPersister implements a storage method for PollResults."""
     STATS_INTERVAL = 60
+    GET_BATCH_SIZE = 100
+    # flush() at least this often while the queue is busy so its committed
+    # position keeps up.
+    MAX_FLUSH_INTERVAL = 60
 
     def __init__(self, config, qname, persistq):
         self.log = get_logger("espersistd.%s" % qname)
@@ -121,20 +143,151 @@ class PollPersister(object):
 
         if persistq:
             self.persistq = persistq
+        elif config.persist_queue_dir:
+            self.persistq = SegmentLogPersistQueue(qname,
+                    config.persist_queue_dir)
         else:
             self.persistq = MemcachedPersistQueue(qname, config.espersistd_uri)
 
         self.data_count = 0
         self.last_stats = time.time()
 
+        # Records stored since the last flush().
+        self.unflushed = 0
+        self.last_flush = time.time()
+        # (time stored, queue position) after each batch taken off of the
+        # queue that hasn't been committed yet, see _flush().
+        self.read_marks = deque()
+        # A HandoffWatcher if this is one of several workers for a queue.
+        self.handoff = None
+
+        # Time spent storing each oidset:device since the last cost report,
+        # see write_costs().
+        self.costs = None
+        if config.persist_balance_dir:
+            self.costs = {}
+
+        # Latency histograms since the last stats report, see write_stats():
+        # poll_delay is from the poll to the enqueue, queue_latency from the
+        # enqueue to the end of store() and store_time is the time in store().
+        self.histograms = None
+        if config.persist_stats_dir:
+            self.histograms = dict((k, LogHistogram()) for k in
+                    ('poll_delay', 'queue_latency', 'store_time'))
+
     def store(self, result):
         pass
 
-    def flush(self):
+    def flush(self, full=False):
         """Can be overridden in subclasses if one wishes to perform
-        some maintenance during a sleep state."""
+        some maintenance during a sleep state.  full is True when
+        everything has to be written, e.g. when the persister is stopping.
+
+        Returns None if everything stored so far has been written, 
+        otherwise the Unix time before which everything stored has been.
+        The queue is only committed up to that point."""
+        return None
+
+    def handed_off(self):
+        """Called once keys may have moved off of this worker, after
+        everything taken off of the queue before has been written.  Can be
+        overridden in subclasses that keep state about the keys they store,
+        which another worker may change from now on."""
         pass
 
+    def _flush(self, full=False):
+        written = self.flush(full)
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+        if written is None:
+            self.read_marks.clear()
+            self.persistq.commit()
+            return
+
+        position = None
+        while self.read_marks and self.read_marks[0][0] <= written:
+            position = self.read_marks.popleft()[1]
+        if position is not None:
+            self.persistq.commit(position)
+
+    def write_costs(self, interval):
+        """
+        Report the time spent storing each oidset:device key over the last
+        interval seconds to the balance dir for espersistd -r rebalance.
+        """
+        filename = os.path.join(self.config.persist_balance_dir,
+                '%s.cost' % self.qname)
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+
+        try:
+            f = open(tmp, 'w')
+            try:
+                json.dump(dict(written=time.time(), interval=interval,
+                    costs=self.costs), f)
+            finally:
+                f.close()
+            os.rename(tmp, filename)
+        except (IOError, OSError), e:
+            self.log.error("unable to write costs to %s: %s" % (filename, e))
+
+        self.costs = {}
+
+    def db_stats(self):
+        """
+        Can be overridden in subclasses to report the timings of their
+        database calls since the last report, see DatabaseMetrics.
+        """
+        return {}
+
+    def log_db_stats(self, db_stats):
+        """Log the latencies of the sampled database calls."""
+        latencies = []
+        for m, s in sorted(db_stats.iteritems()):
+            if 'latency' not in s:
+                continue
+            h = LogHistogram.from_dict(s['latency'])
+            latencies.append("%s %d calls p50 %.1fms p99 %.1fms max %.1fms" % (
+                m, s['calls'], 1000 * h.percentile(50),
+                1000 * h.percentile(99), 1000 * h.max))
+
+        if latencies:
+            self.log.info("db: %s" % ", ".join(latencies))
+
+    def write_stats(self, interval, records, db_stats=None):
+        """
+        Write the latency histograms and the number of records stored over
+        the last interval seconds to the stats dir for espersistq.
+        """
+        filename = os.path.join(self.config.persist_stats_dir,
+                '%s.stats' % self.qname)
+        stats = dict(interval=interval, records=records, pid=os.getpid(),
+                queue_length=len(self.persistq), db=db_stats or {})
+        for k, h in self.histograms.iteritems():
+            stats[k] = h.to_dict()
+
+        try:
+            write_stats_file(filename, stats)
+        except (IOError, OSError, TypeError), e:
+            self.log.error("unable to write stats to %s: %s" % (filename, e))
+
+        for h in self.histograms.itervalues():
+            h.reset()
+
+    def report_stats(self, now):
+        interval = now - self.last_stats
+        if self.data_count:
+            self.log.info("%d records written, %f records/sec" % \
+                    (self.data_count, float(self.data_count) / interval))
+        if self.costs is not None:
+            self.write_costs(interval)
+        db_stats = self.db_stats()
+        self.log_db_stats(db_stats)
+        if self.histograms is not None:
+            self.write_stats(interval, self.data_count, db_stats)
+        self.data_count = 0
+        self.last_stats = now
+
     def stop(self, x, y):
         self.log.debug("stop")
         self.running = False
@@ -149,37 +302,84 @@ class PollPersister(object):
             pr = cProfile.Profile()
             pr.enable()
 
+        # When the queue is empty wait for more data, starting with a short
+        # wait and backing off to PERSIST_SLEEP_TIME.  flush() is called
+        # once the queue has been idle for persist_idle_flush seconds or
+        # after persist_flush_threshold records even if it never is.
+        wait = PERSIST_MIN_SLEEP_TIME
+        last_task = time.time()
+
         while self.running:
+            if self.handoff:
+                # Keys are moving off of this worker, write everything
+                # queued before the fence so they can move.
+                fence = self.handoff.fence(time.time())
+                if fence is not None and self.persistq.taken() >= fence:
+                    self._flush(full=True)
+                    self.handoff.passed(fence)
+                if self.handoff.moved:
+                    self.handoff.moved = False
+                    self.handed_off()
+
             try:
-                task = self.persistq.get()
+                tasks = self.persistq.get_many(self.GET_BATCH_SIZE)
             except PersistQueueEmpty:
                 break
 
-            # XXX(jdugan): task can be None for two reasons here:
-            # 1. there was no result
-            # 2. the result was None
-            # this means that Nones are consumed very slowly, this should be
-            # revisited.
-
-            if task:
-                self.store(task)
-                self.data_count += len(task.data)
+            # The whole batch has been taken off of the queue so it is 
+            # stored even if we've been told to stop.
+            if tasks:
+                for task in tasks:
+                    if self.costs is None and self.histograms is None:
+                        self.store(task)
+                    else:
+                        t = time.time()
+                        self.store(task)
+                        done = time.time()
+                        if self.costs is not None:
+                            k = ":".join((task.oidset_name, task.device_name))
+                            self.costs[k] = self.costs.get(k, 0) + done - t
+                        if self.histograms is not None:
+                            self.histograms['store_time'].add(done - t)
+                            enqueue_ts = getattr(task, 'enqueue_ts', None)
+                            if enqueue_ts:
+                                self.histograms['queue_latency'].add(
+                                        done - enqueue_ts)
+                                self.histograms['poll_delay'].add(
+                                        enqueue_ts - task.timestamp)
+                    self.data_count += len(task.data)
+                    self.unflushed += len(task.data)
                 now = time.time()
+                self.read_marks.append((now, self.persistq.position()))
                 if now > self.last_stats + self.STATS_INTERVAL:
-                    self.log.info("%d records written, %f records/sec" % \
-                            (self.data_count,
-                                float(self.data_count) / self.STATS_INTERVAL))
-                    self.data_count = 0
-                    self.last_stats = now
-                del task
+                    self.report_stats(now)
+                del task, tasks
                 self.sleeping = False
+                wait = PERSIST_MIN_SLEEP_TIME
+                last_task = now
+
+                if self.config.persist_flush_threshold and \
+                        self.unflushed >= self.config.persist_flush_threshold:
+                    self._flush()
+                elif now >= self.last_flush + self.MAX_FLUSH_INTERVAL:
+                    self._flush()
             else:
-                if not self.sleeping:
-                    self.flush()
+                if not self.sleeping and time.time() >= \
+                        last_task + self.config.persist_idle_flush:
+                    self._flush()
                     self.sleeping = True
                     if self.config.debug:
                         django.db.reset_queries()
-                time.sleep(PERSIST_SLEEP_TIME)
+                self.persistq.wait(wait)
+                wait = min(wait * 2, PERSIST_SLEEP_TIME)
+
+                # Keep the stats file current while idle.
+                now = time.time()
+                if self.histograms is not None and \
+                        now > self.last_stats + self.STATS_INTERVAL:
+                    self.report_stats(now)
+
+        self._flush(full=True)
 
         if self.config.profile_persister:
             pr.disable()
@@ -403,7 +603,9 @@ class CassandraPollPersister(PollPersister):
         # testing env var is set will result in the target keyspace
         # and all of its data being deleted and rebuilt.
         self.log.debug("connecting to cassandra")
-        self.db = CASSANDRA_DB(config, qname=qname)
+        # The persister would rather wait for cassandra than lose data.
+        self.db = CASSANDRA_DB(config, qname=qname, write_retries=None,
+                write_threads=config.cassandra_write_threads)
         self.log.debug("connected to cassandra")
 
         self.ns = "snmp"
@@ -411,6 +613,7 @@ class CassandraPollPersister(PollPersister):
         self.oidsets = {}
         self.poller_args = {}
         self.oids = {}
+        self.oidset_oids = {}
 
         oidsets = OIDSet.objects.all()
 
@@ -423,17 +626,89 @@ class CassandraPollPersister(PollPersister):
                     d[k] = v
                 self.poller_args[oidset.name] = d
 
+            self.oidset_oids[oidset.name] = []
             for oid in oidset.oids.all():
                 self.oids[oid.name] = oid
+                self.oidset_oids[oidset.name].append(oid)
+
+        # (device, oidset) pairs the metadata has been prefetched for.
+        self.prefetched = set()
 
-    def flush(self):
+        self.snapshot_file = None
+        if config.persister_snapshot_dir:
+            self.snapshot_file = os.path.join(config.persister_snapshot_dir,
+                    '%s.cache' % qname)
+            self.load_snapshot()
+        self.last_snapshot = time.time()
+
+    def flush(self, full=False):
         self.log.debug('flush state called.')
         try:
-            self.db.flush()
+            if full:
+                self.db.flush()
+                return None
+            return self.db.checkpoint(wait=True)
         except MaximumRetryException:
             self.log.warn("flush failed. MaximumRetryException")
+            return 0
+
+    def db_stats(self):
+        return self.db.stats.snapshot(reset=True)
+
+    def load_snapshot(self):
+        """Seed the db caches from the snapshot file if there is one."""
+        try:
+            snapshot = read_snapshot(self.snapshot_file)
+        except SnapshotError, e:
+            self.log.error("ignoring cache snapshot: %s" % e)
+            return
+
+        if snapshot:
+            self.db.load_cache_snapshot(snapshot, HEARTBEAT_FREQ_MULTIPLIER)
+
+    def write_snapshot(self, clean=False):
+        """
+        Write the db caches to the snapshot file.  A clean snapshot is only 
+        written on shutdown after everything has been flushed.
+        """
+        t0 = time.time()
+
+        metadata = self.db.metadata_cache
+        if self.db.snapshot_metadata:
+            # Carry forward snapshot values that haven't been used yet.
+            metadata = dict([(k, meta_d) for k, (meta_d, trusted) in
+                self.db.snapshot_metadata.iteritems() if trusted or not clean])
+            metadata.update(self.db.metadata_cache)
+
+        try:
+            write_snapshot(self.snapshot_file, metadata,
+                    self.db.aggregation_cache, clean=clean)
+        except (IOError, OSError), e:
+            self.log.error("unable to write cache snapshot: %s" % e)
+            return
+
+        self.last_snapshot = time.time()
+        self.log.debug("wrote cache snapshot in %f seconds" % 
+                (self.last_snapshot - t0))
+
+    def _check_snapshot(self):
+        if self.snapshot_file and \
+                time.time() > self.last_snapshot + \
+                    self.config.persister_snapshot_interval:
+            # Flush first so the snapshot is no further ahead of the db
+            # than it has to be.
+            self.flush()
+            self.write_snapshot()
 
     def store(self, result):
+        self._check_snapshot()
+
+        if (result.device_name, result.oidset_name) not in self.prefetched:
+            self.prefetch_metadata(result)
+
+        if self.config.persister_batch_store and self.store_batch(result):
+            return
+
         oidset = self.oidsets[result.oidset_name]
         set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
         basepath = [self.ns, result.device_name, set_name]
@@ -479,6 +754,135 @@ class CassandraPollPersister(PollPersister):
         self.log.debug("stored %d vars in %f seconds: %s" % (nvar,
             time.time() - t0, result))
 
+    def prefetch_metadata(self, result):
+        """
+        The first time a device/oidset is seen, look up the previous values
+        for all of the device's active interfaces in one go instead of one
+        at a time as the results for each oid arrive.
+
+        This only applies to oidsets whose vars are named by the ifName 
+        correlators, since those are the only ones where the var names 
+        can be worked out from IfRef.
+        """
+        self.prefetched.add((result.device_name, result.oidset_name))
+
+        oidset = self.oidsets[result.oidset_name]
+        poller_args = self.poller_args.get(oidset.name, {})
+        correlator = poller_args.get('correlator')
+        if correlator not in ('IfNameCorrelator', 'InfIfNameCorrelator'):
+            return
+
+        oids = [oid for oid in self.oidset_oids[oidset.name] if oid.aggregate]
+        if not oids:
+            return
+
+        t0 = time.time()
+
+        ifrefs = IfRef.objects.active().filter(device__name=result.device_name)
+        if correlator == 'IfNameCorrelator':
+            # IfNameCorrelator skips interfaces without an ifAlias.
+            ifrefs = ifrefs.exclude(ifAlias__isnull=True).exclude(ifAlias='')
+
+        ifnames = set()
+        for ifname in ifrefs.values_list('ifName', flat=True):
+            if correlator == 'InfIfNameCorrelator' and '=' in ifname:
+                ifname = ifname.split('=')[1]
+            ifnames.add(ifname)
+
+        set_name = poller_args.get('set_name', oidset.name)
+        basepath = [self.ns, result.device_name, set_name]
+        paths = [basepath + [oid.name, ifname] for oid in oids 
+                for ifname in ifnames]
+
+        if not paths:
+            return
+
+        try:
+            found = self.db.prefetch_metadata(paths, oidset.frequency_ms,
+                    int(result.timestamp) * 1000,
+                    oidset.frequency_ms * HEARTBEAT_FREQ_MULTIPLIER)
+        except MaximumRetryException:
+            self.log.warn("metadata prefetch failed. MaximumRetryException")
+            return
+
+        self.log.debug("prefetched metadata for %s %s: %d of %d in %f seconds"
+                % (result.device_name, oidset.name, found, len(paths),
+                    time.time() - t0))
+
+    def store_batch(self, result):
+        """
+        Batch version of store(), used if persister_batch_store is set.
+
+        Every var in a PollResult shares the same timestamp, frequency and 
+        oidset so rather than building the data encapsulation objects for
+        each var, this works on parallel lists of paths and values.  The 
+        previous values for the whole result are fetched in one go, the
+        bin layout is computed once per distinct previous timestamp and the
+        writes for each column family are handed to the db as one list.
+
+        Returns False without storing anything if the result can't be 
+        handled as a batch (ie: the same var appears twice and has to be
+        processed in order) in which case store() does it the slow way.
+        """
+        oidset = self.oidsets[result.oidset_name]
+        set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
+        basepath = [self.ns, result.device_name, set_name]
+        oid = self.oids[result.oid_name]
+        freq = oidset.frequency_ms
+
+        t0 = time.time()
+
+        paths = []
+        vals = []
+
+        for var, val in result.data:
+            if set_name == "SparkySet": # This is pure hack. A new row type should be created for floats
+                val = float(val) * 100
+
+            var_path = basepath + var
+
+            # This shouldn't happen.
+            if val is None:
+                self.log.error('Got a None value for %s' % (":".join(var_path)))
+                continue
+
+            paths.append(var_path)
+            vals.append(val)
+
+        # The escaped path is the common prefix of all the row keys and 
+        # the metadata key (see RawRateData.get_meta_key()) is the prefix
+        # of the raw data and base rate row keys.
+        prefixes = [KEY_DELIMITER.join(escape_path(p)) for p in paths]
+
+        if len(set(prefixes)) != len(prefixes):
+            return False
+
+        suffix = '%s%s' % (KEY_DELIMITER, freq)
+        meta_keys = [p + suffix for p in prefixes]
+
+        # Same conversion RawRateData does: the timestamps are truncated 
+        # to the second.
+        ts = datetime.datetime.utcfromtimestamp(
+                float(result.timestamp * 1000)/1000.0)
+        curr_ts = calendar.timegm(ts.utctimetuple()) * 1000
+
+        suffix = '%s%s' % (KEY_DELIMITER, ts.year)
+        self.db.set_raw_data_batch(
+            [(k + suffix, curr_ts, v) for k, v in zip(meta_keys, vals)],
+            ttl=oidset.ttl)
+
+        # Generate aggregations if apropos.
+        if oid.aggregate:
+            deltas = self.aggregate_base_rates(paths, meta_keys, vals,
+                    curr_ts, freq)
+            self.generate_aggregations_batch(prefixes, deltas, curr_ts, freq,
+                    oidset.aggregates)
+
+        self.log.debug("stored %d vars in %f seconds: %s" % (len(result.data),
+            time.time() - t0, result))
+
+        return True
+
     def aggregate_base_rate(self, data):
         """
         Given incoming data that is meant for aggregation, generate and 
@@ -590,6 +994,104 @@ class CassandraPollPersister(PollPersister):
         
         return delta_v
 
+    def aggregate_base_rates(self, paths, meta_keys, vals, curr_ts, freq):
+        """
+        Batch version of aggregate_base_rate() for the vars in one poll
+        result.  The paths, meta_keys and vals args are parallel lists,
+        curr_ts is the JavaScript timestamp of the result and freq the
+        frequency in ms.
+
+        Applies the same checks as aggregate_base_rate() to each var, 
+        updates the metadata cache and writes all of the base rate bins
+        at once.  Returns a list parallel to vals with the valid delta for
+        each var or None if no rollups should be generated for it.
+        """
+
+        metas = self.db.get_metadata_batch(paths, meta_keys, freq, curr_ts,
+                vals)
+
+        # XXX(jdugan): should compare to ifHighSpeed?  this is BAD:
+        max_rate = int(110e9)
+        heartbeat = freq * HEARTBEAT_FREQ_MULTIPLIER
+        curr_slot = curr_ts - (curr_ts % freq)
+
+        layouts = {}
+        # Maps a bin to its column name and the row key suffix for its year.
+        bins = {}
+        rows = []
+        deltas = []
+
+        def bin_col(b):
+            if b not in bins:
+                bins[b] = (b - (b % 1000), '%s%s' % (KEY_DELIMITER,
+                    datetime.datetime.utcfromtimestamp(b/1000.0).year))
+            return bins[b]
+
+        for path, meta_key, val, meta in zip(paths, meta_keys, vals, metas):
+            last_data_ts = jstime(meta['last_update'])
+            last_val = meta['last_val']
+
+            # This mimics logic in the tsdb persister - skip any further 
+            # processing of the rate aggregate if this is the first value
+            if val == last_val and curr_ts == last_data_ts:
+                deltas.append(None)
+                continue
+
+            delta_t = curr_ts - last_data_ts
+            delta_v = val - last_val
+
+            rate = float(delta_v) / float(delta_t)
+
+            if rate > max_rate:
+                self.log.error('max_rate_exceeded - %s - %s - %s' \
+                    % (rate, last_val, val))
+                deltas.append(None)
+                continue
+
+            if delta_v < 0:
+                self.log.error('delta_v < 0: %s vals: %s - %s path: %s' % \
+                    (delta_v, val, last_val, meta_key))
+                self.db.refresh_metadata(meta, curr_ts, val)
+                deltas.append(None)
+                continue
+
+            # See aggregate_base_rate() for the heartbeat logic.
+            if delta_t > heartbeat:
+                self.log.warning(
+                  'gap exceeds heartbeat for {0} from {1}({2}) to {3}({4})'.format(
+                        path,
+                        time.ctime(last_data_ts/1000),
+                        last_data_ts,
+                        time.ctime(curr_ts/1000),
+                        curr_ts)
+                )
+
+                curr_frac = int(delta_v * ((curr_ts - curr_slot)/float(delta_t)))
+                col, suffix = bin_col(curr_slot)
+                rows.append((meta_key + suffix, col, curr_frac, 1))
+
+                self.db.refresh_metadata(meta, curr_ts, val)
+                deltas.append(None)
+                continue
+
+            # The layout only depends on the timestamps so vars with the 
+            # same previous timestamp (usually all of them) share it.
+            layout = layouts.get(last_data_ts)
+            if layout is None:
+                layout = layouts[last_data_ts] = bin_layout(freq, 
+                        last_data_ts, curr_ts)
+
+            for bin_name, v in fit_delta_to_bins(layout, delta_v).iteritems():
+                col, suffix = bin_col(bin_name)
+                rows.append((meta_key + suffix, col, v, 1))
+
+            self.db.refresh_metadata(meta, curr_ts, val)
+            deltas.append(delta_v)
+
+        self.db.update_rate_bins(rows)
+
+        return deltas
+
     def _agg_timestamp(self, data, freq):
         """
         Utility method to generate the 'compressed' timestamp for an higher-level 
@@ -613,107 +1115,223 @@ class CassandraPollPersister(PollPersister):
         are being writtent to two different column families due to schema
         constraints.
         
-        Since the stat aggregations are read from/not just written to, 
-        track if a new value has been generated (min/max will only be updated
-        periodically), and if so, explicitly flush the stat_agg batch.
+        Both are kept in memory by the db until the bin is finished (or
+        a checkpoint) so nothing is sent here.
         """
-        stat_updated = False
 
         for freq in aggregate_freqs:
             self.db.update_rate_aggregation(data, self._agg_timestamp(data, freq), freq*1000)
-            updated = self.db.update_stat_aggregation(data, 
+            self.db.update_stat_aggregation(data, 
                                         self._agg_timestamp(data, freq), freq*1000)
-            if updated: stat_updated = True
-                                
-        if stat_updated:
-            self.db.stat_agg.send()
+
+    def generate_aggregations_batch(self, prefixes, deltas, curr_ts, base_freq,
+            aggregate_freqs):
+        """
+        Batch version of generate_aggregations().  The prefixes (the escaped
+        paths) and deltas args are parallel lists as returned by 
+        aggregate_base_rates(), vars with a delta of None are skipped.
+        """
+        rate_rows = []
+        stat_rows = []
+
+        for freq in aggregate_freqs:
+            # Same as _agg_timestamp(), in ms.
+            agg_ts = ((curr_ts / 1000) / freq) * freq * 1000
+            suffix = KEY_DELIMITER.join(['', str(freq*1000),
+                str(datetime.datetime.utcfromtimestamp(agg_ts/1000).year)])
+
+            for prefix, delta_v in zip(prefixes, deltas):
+                if delta_v is None:
+                    continue
+                key = prefix + suffix
+                rate_rows.append((key, agg_ts, delta_v, base_freq))
+                stat_rows.append((key, agg_ts, delta_v, curr_ts))
+
+        if not rate_rows:
+            return
+
+        self.db.update_rate_aggregations(rate_rows)
+        self.db.update_stat_aggregations(stat_rows)
 
     def stop(self, x, y):
         self.log.debug("flushing and stopping cassandra poll persister")
         self.db.flush()
         self.running = False
+
+    def run(self):
+        PollPersister.run(self)
+
+        # The run loop finishes the result it's working on before it 
+        # notices it's been stopped, so this is the point where the caches
+        # and the db agree.
+        try:
+            self.db.flush()
+        except MaximumRetryException:
+            self.log.warn("final flush failed. MaximumRetryException")
+            return
+
+        if self.snapshot_file:
+            self.write_snapshot(clean=True)
             
         
 
 class HistoryTablePersister(PollPersister):
-    """Provides common methods for table histories."""
+    """Provides common methods for table histories.
+
+    Subclasses set model to the history table model and key to the field
+    that identifies a row, and implement _build_objs() and
+    _new_row_from_obj().
+
+    Inventory tables rarely change, so the digest of the last result
+    applied for each device is kept and a result with the same digest is
+    skipped without touching the database.  The digests are also stored in
+    the HistoryTableDigest table if persister_history_digests is set so
+    they survive a restart.  They are dropped when devices move to another
+    worker, which may change the table before they move back."""
+
+    model = None
+    key = None
+
+    # Apply unchanged results anyway after this many seconds, in case the
+    # table has been changed by something else.
+    DIGEST_MAX_AGE = 3600
+
+    def __init__(self, config, qname, persistq=None):
+        PollPersister.__init__(self, config, qname, persistq)
+
+        # device name -> (digest, time) of the last result applied
+        self.digests = {}
+
+    def store(self, result):
+        t0 = time.time()
+        self.data = result.data
+
+        self.new_data = self._build_objs()
+        nvar = len(self.new_data)
+
+        # SNMP strings aren't necessarily utf-8, latin-1 can encode any str.
+        digest = hashlib.sha1(json.dumps(self.new_data, sort_keys=True,
+            encoding='latin-1')).hexdigest()
+        if self._unchanged(result.device_name, digest, t0):
+            self.log.debug("unchanged %d vars in %f seconds: %s" % (
+                nvar, time.time() - t0, result))
+            return
+
+        self.device = Device.objects.active().get(name=result.device_name)
+        self.old_data = self.model.objects.active().filter(device=self.device)
+
+        adds, changes, deletes = self.update_db()
+        self._save_digest(result.device_name, digest, t0)
+
+        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
+            nvar, adds, changes, deletes, time.time() - t0, result))
+
+    def _unchanged(self, device_name, digest, t):
+        """Is digest the same as that of the last result applied for
+        device_name?"""
+        if device_name not in self.digests and \
+                self.config.persister_history_digests:
+            try:
+                row = HistoryTableDigest.objects.get(device_name=device_name,
+                        table=self.model._meta.db_table)
+                self.digests[device_name] = (row.digest,
+                        calendar.timegm(row.updated.utctimetuple()))
+            except HistoryTableDigest.DoesNotExist:
+                pass
+
+        try:
+            last_digest, last_time = self.digests[device_name]
+        except KeyError:
+            return False
+
+        return last_digest == digest and t - last_time < self.DIGEST_MAX_AGE
+
+    def handed_off(self):
+        # Another worker may apply results for the devices that moved, so
+        # our digests may no longer match the table.  The ones in the
+        # HistoryTableDigest table are kept current by whoever applies.
+        self.digests.clear()
+
+    def _save_digest(self, device_name, digest, t):
+        self.digests[device_name] = (digest, t)
+
+        if self.config.persister_history_digests:
+            HistoryTableDigest.objects.update_or_create(
+                    device_name=device_name, table=self.model._meta.db_table,
+                    defaults=dict(digest=digest, updated=now()))
 
     def update_db(self):
         """Compare the database to the poll results and update.
 
         This assumes that the database object has a begin_time and end_time
         and that self.new_data has the dictionary representing the new data
-        and that self.old_data contains the database objects representing the
-        old data.  It uses _new_row_from_dict() to create a new object when
-        needed."""
+        and that self.old_data is the queryset of database objects
+        representing the old data.  It uses _new_row_from_obj() to create a
+        new object when needed.
+
+        The old rows are fetched once and compared in memory, then the rows
+        that ended are updated with a single UPDATE and the new rows are
+        inserted with a single bulk_create() in one transaction."""
 
         adds = 0
         changes = 0
         deletes = 0
 
+        ended = []
+        new_rows = []
+
         # iterate through what is currently in the database
         for old in self.old_data:
             # there is an entry in the new data: has anything changed?
             key = getattr(old, self.key)
-            if key in self.new_data:
-                new = self.new_data[key]
-                attrs = new.keys()
-                attrs.remove(self.key)
+            new = self.new_data.pop(key, None)
+            if new is not None:
                 changed = False
 
-                for attr in attrs:
+                for attr, val in new.iteritems():
+                    if attr == self.key:
+                        continue
+
                     if not hasattr(old, attr):
                         self.log.error("Field " + attr + " is not contained in the object: %s. Adding it." % str(old))
                         changed = True
                         break
 
-                    if getattr(old, attr) != new[attr]:
+                    if getattr(old, attr) != val:
                         changed = True
                         break
 
                 if changed:
-                    old.end_time = now()
-                    old.save()
-                    new_row = self._new_row_from_obj(new)
-                    new_row.save()
+                    ended.append(old.pk)
+                    new_rows.append(self._new_row_from_obj(new))
                     changes += 1
-
-                del self.new_data[key]
             # no entry in self.new_data: interface is gone, update db
             else:
-                old.end_time = now()
-                old.save()
+                ended.append(old.pk)
                 deletes += 1
 
         # anything left in self.new_data is something new
-        for new in self.new_data:
-            new_row = self._new_row_from_obj(self.new_data[new])
-            new_row.save()
+        for new in self.new_data.itervalues():
+            new_rows.append(self._new_row_from_obj(new))
             adds += 1
 
+        if ended or new_rows:
+            model = self.old_data.model
+            with transaction.atomic():
+                if ended:
+                    model.objects.filter(pk__in=ended).update(end_time=now())
+                if new_rows:
+                    model.objects.bulk_create(new_rows)
+
         return (adds, changes, deletes)
 
 
 class IfRefPollPersister(HistoryTablePersister):
+    model = IfRef
+    key = 'ifName'
     int_oids = ('ifSpeed', 'ifHighSpeed', 'ifMtu', 'ifType',
             'ifOperStatus', 'ifAdminStatus')
 
-    def store(self, result):
-        t0 = time.time()
-        self.data = result.data
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = IfRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'ifName'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
-
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
         obj['begin_time'] = now()
@@ -750,24 +1368,10 @@ class IfRefPollPersister(HistoryTablePersister):
         return ifref_objs
 
 class ALUSAPRefPersister(HistoryTablePersister):
+    model = ALUSAPRef
+    key = 'name'
     int_oids = ('sapIngressQosPolicyId', 'sapEgressQosPolicyId')
 
-    def store(self, result):
-        self.data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = ALUSAPRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'name'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
-
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
         obj['begin_time'] = now()
@@ -795,24 +1399,8 @@ class ALUSAPRefPersister(HistoryTablePersister):
         return objs
 
 class LSPOpStatusPersister(HistoryTablePersister):
-    def __init__(self, config, qname):
-        HistoryTablePersister.__init__(self, config, qname)
-
-    def store(self, result):
-        self.lsp_data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = LSPOpStatus.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'name'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
+    model = LSPOpStatus
+    key = 'name'
 
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
@@ -824,7 +1412,7 @@ class LSPOpStatusPersister(HistoryTablePersister):
     def _build_objs(self):
         lsp_objs = {}
 
-        for k, entries in self.lsp_data.iteritems():
+        for k, entries in self.data.iteritems():
             for name, val in entries:
                 name = name.split('.')[-1].replace("'", "")
 
@@ -878,24 +1466,10 @@ class InfIfRefPollPersister(IfRefPollPersister):
 
 class SentryOutletRefPollPersister(HistoryTablePersister):
     """Save information about outlets for a Sentry PDU."""
+    model = OutletRef
+    key = 'outletID'
     int_oids = ('outletStatus', 'outletControlState')
 
-    def store(self, result):
-        self.data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = OutletRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'outletID'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
-
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
         obj['begin_time'] = now()
@@ -928,9 +1502,13 @@ class SentryOutletRefPollPersister(HistoryTablePersister):
         return objs
 
 class PersistQueue(object):
-    """Abstract base class for a persistence queue."""
+    """Abstract base class for a persistence queue.
+
+    format is the encoding used by put(), 'json' or 'binary' (see
+    esmond.pollcodec).  Items in either format can be read."""
     def __init__(self, qname):
         self.qname = qname
+        self.format = 'json'
 
     def get(self, block=False):
         pass
@@ -938,8 +1516,51 @@ class PersistQueue(object):
     def put(self, val):
         pass
 
+    def get_many(self, n):
+        """Return a list of up to n items, subclasses should override this
+        if the queue can fetch several items at once."""
+        vals = []
+        while len(vals) < n:
+            val = self.get()
+            if not val:
+                break
+            vals.append(val)
+        return vals
+
+    def put_many(self, vals):
+        for val in vals:
+            self.put(val)
+
+    def position(self):
+        """The read position after the items gotten so far, to be passed
+        to commit() later.  Only meaningful for queues that can replay
+        items."""
+        return None
+
+    def taken(self):
+        """The sequence number of the items gotten so far, comparable with
+        the last_added of the queue's QueueStats."""
+        return None
+
+    def commit(self, position=None):
+        """Called when the consumer is done with everything it has gotten
+        (or everything before position).  Only meaningful for queues that
+        can replay items."""
+        pass
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for items to be added, subclasses 
+        that can tell when that happens should return early."""
+        time.sleep(timeout)
+
     def serialize(self, val):
         # return pickle.dumps(val)
+        if self.format == 'binary':
+            try:
+                return pollcodec.encode(val)
+            except CodecError as e:
+                if hasattr(self, 'log'):
+                    self.log.warning('%s, sending as json' % e)
         try:
             return val.json() # .dumps() is being called in the PollResult method
         except Exception as e:
@@ -953,7 +1574,7 @@ class PersistQueue(object):
 
     def deserialize(self, val):
         # return pickle.loads(val)
-        return json.loads(val)
+        return pollcodec.decode(val)
 
 class JsonSerializer(object):
     """This is passed to memcache.Client() to replace default use of 
@@ -983,6 +1604,10 @@ class MemcachedPersistQueue(PersistQueue):
 
     PREFIX = '_mcpq_'
 
+    # Writers reserve their qids before they set them, a qid that is
+    # missing is waited for this long before it's skipped, see get_many().
+    MISSING_WAIT = 10
+
     def __init__(self, qname, memcached_uri):
         super(MemcachedPersistQueue, self).__init__(qname)
 
@@ -1002,6 +1627,12 @@ class MemcachedPersistQueue(PersistQueue):
         if not lr:
             self.mc.set(self.last_read, 0)
 
+        # The last qid taken by this reader and written by its persister.
+        self.last_flushed = '%s_%s_last_flushed' % (self.PREFIX, self.qname)
+        self.claimed = int(lr or 0)
+        # (qid, time first found missing) of the qid being waited for.
+        self.missing = None
+
     def __str__(self):
         la = self.mc.get(self.last_added)
         lr = self.mc.get(self.last_read)
@@ -1019,26 +1650,74 @@ class MemcachedPersistQueue(PersistQueue):
             self.log.error("failed to serialize: %s" % str(val))
 
     def get(self, block=False):
-        if len(self) <= 0:
-            return None
+        vals = self.get_many(1)
+        if vals:
+            return vals[0]
+        return None
+
+    def put_many(self, vals):
+        sers = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                sers.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        if not sers:
+            return
 
-        errors = 0
+        # Reserve a block of qids with a single incr.
+        qid = self.mc.incr(self.last_added, len(sers)) - len(sers) + 1
+        mapping = {}
+        for ser in sers:
+            mapping['%s_%s_%d' % (self.PREFIX, self.qname, qid)] = ser
+            qid += 1
+
+        failed = self.mc.set_multi(mapping)
+        if failed:
+            self.log.error("memcache 'set_multi' failed for %d items! "
+                    "Polling data lost!" % len(failed))
+
+    def get_many(self, n):
+        n = min(n, len(self))
+        if n <= 0:
+            return []
+
+        # Claim a block of qids with a single incr.
+        last = self.mc.incr(self.last_read, n)
+        first = last - n + 1
+        keys = ['%s_%s_%d' % (self.PREFIX, self.qname, qid)
+                    for qid in range(first, last + 1)]
+
+        vals = self.mc.get_multi(keys)
+
+        # A missing qid may not have been set by its writer yet, stop there
+        # and give the rest of the block back.
+        for i, k in enumerate(keys):
+            if not vals.get(k) and self._wait_for(first + i):
+                self.mc.decr(self.last_read, n - i)
+                keys = keys[:i]
+                last = first + i - 1
+                break
+        self.claimed = last
 
-        qid = self.mc.incr(self.last_read)
-        while qid <= self.mc.get(self.last_added):
-            k = '%s_%s_%d' % (self.PREFIX, self.qname, qid)
-            val = self.mc.get(k)
-            if val:
-                self.mc.delete(k)
-                if errors:
-                    self.log.error("missing data: %d items missing (qids %d-%d)" %
-                            (errors, qid-errors, qid-1))
-                # return self.deserialize(val)
-                return PollResult(**self.deserialize(val))
+        found = [k for k in keys if vals.get(k)]
+        if found:
+            self.mc.delete_multi(found)
 
-            errors += 1
+        if len(found) < len(keys):
+            self.log.error("missing data: %d items missing (qids %d-%d)" %
+                    (len(keys) - len(found), first, last))
 
-            qid = self.mc.incr(self.last_read)
+        return [PollResult(**self.deserialize(vals[k])) for k in found]
+
+    def _wait_for(self, qid):
+        """Should the reader wait for the missing qid to be set?"""
+        now = time.time()
+        if self.missing is None or self.missing[0] != qid:
+            self.missing = (qid, now)
+        return now < self.missing[1] + self.MISSING_WAIT
 
     def __len__(self):
         n = self.mc.get(self.last_added) - self.mc.get(self.last_read)
@@ -1046,11 +1725,108 @@ class MemcachedPersistQueue(PersistQueue):
             n = 0
         return n
 
+    def position(self):
+        return self.claimed
+
+    def taken(self):
+        return self.claimed
+
+    def commit(self, position=None):
+        # Items can't be replayed, this only tells PersistManager how far
+        # the persister has got.
+        if position is None:
+            position = self.claimed
+        self.mc.set(self.last_flushed, position)
+
     def reset(self):
         self.mc.set(self.last_added, 0)
         self.mc.set(self.last_read, 0)
 
 
+class SegmentLogPersistQueue(PersistQueue):
+    """A queue stored in segment files on local disk, see esmond.segmentlog.
+
+    Each queue is a subdirectory of the directory given.  Items that have
+    been returned by get() are only committed when the persister calls
+    commit() once they have been written, so anything not yet written when
+    a persister dies is read again when it restarts.
+    """
+
+    def __init__(self, qname, directory):
+        super(SegmentLogPersistQueue, self).__init__(qname)
+
+        self.log = get_logger("SegmentLogPersistQueue_%s" % self.qname)
+        self.slog = SegmentLog(os.path.join(directory, qname))
+        self.corrupt = 0
+
+    def __str__(self):
+        return '<SegmentLogPersistQueue: %s last_added: %d, last_read: %d>' \
+                % (self.qname, self.slog.last_added, self.slog.last_read)
+
+    def put(self, val):
+        self.put_many([val])
+
+    def put_many(self, vals):
+        sers = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                sers.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        if sers:
+            self.slog.append(sers)
+
+    def get(self, block=False):
+        vals = self.get_many(1)
+        if vals:
+            return vals[0]
+        return None
+
+    def get_many(self, n):
+        vals = self.slog.read(n)
+
+        if self.slog.corrupt != self.corrupt:
+            self.log.error("corrupt data: %d items skipped" %
+                    (self.slog.corrupt - self.corrupt))
+            self.corrupt = self.slog.corrupt
+
+        return [PollResult(**self.deserialize(val)) for val in vals]
+
+    def position(self):
+        return self.slog.read_pos
+
+    def taken(self):
+        if self.slog.read_pos is None:
+            return self.slog.last_read
+        return self.slog.read_pos[2]
+
+    def commit(self, position=None):
+        self.slog.commit(position)
+        self.slog.sync()
+
+    def wait(self, timeout):
+        # Checking for new items is just a read of the mapped head file so
+        # check often, the caller's backoff only bounds the total wait.
+        last_added = self.slog.last_added
+        end = time.time() + timeout
+        while self.slog.last_added == last_added:
+            left = end - time.time()
+            if left <= 0:
+                break
+            time.sleep(min(left, PERSIST_MIN_SLEEP_TIME))
+
+    def __len__(self):
+        return len(self.slog)
+
+    def reset(self):
+        self.slog.commit()
+        seg, off, seq = self.slog.head.get()
+        self.slog.offset.set(seg, off, seq)
+        self.slog.read_pos = None
+
+
 class PersistClient(object):
     def __init__(self, name, config):
         self.config = config
@@ -1071,47 +1847,235 @@ class PersistClient(object):
         for sink in self.sinks:
             sink.put(result)
 
+    def put_many(self, results):
+        for sink in self.sinks:
+            sink.put_many(results)
+
 
 class MultiWorkerQueue(object):
-    def __init__(self, qprefix, qtype, uri, num_workers):
+    """Spreads results over the queues of several workers.
+
+    Each oidset:device key is assigned to a worker with a consistent hash
+    so that it always goes to the same worker, even across restarts.  If
+    balance_dir is given the worker weights and any keys that have been
+    moved by espersistd -r rebalance are read from the qprefix.balance file
+    in it.
+
+    While a handoff is in progress (see esmond.hashring) the results for
+    the keys that are moving are held and sent to their new worker once the
+    handoff is done, or after HANDOFF_TIMEOUT if it never is."""
+
+    BALANCE_CHECK_INTERVAL = 30
+    HANDOFF_TIMEOUT = 600
+
+    def __init__(self, qprefix, qtype, uri, num_workers, balance_dir=None):
         self.qprefix = qprefix
         self.qtype = qtype
         self.num_workers = num_workers
         self.queues = {}
         self.worker_map = {}
         self.log = get_logger('MultiWorkerQueue')
-        self.worker_load = []
 
         for i in range(1, num_workers + 1):
             name = "%s_%d" % (qprefix, i)
             self.queues[name] = qtype(name, uri)
-            self.worker_load.append([i, 0])
+
+        self.ring = HashRing(dict((i, 1.0) for i in range(1, num_workers + 1)))
+        self.overrides = {}
+
+        # The assignment keys are moving from, if a handoff is in progress,
+        # whether each key is moving and the results being held.
+        self.handoff = None
+        self.prev_ring = None
+        self.prev_overrides = {}
+        self.moving = {}
+        self.held = []
+
+        self.balance_file = None
+        if balance_dir:
+            self.balance_file = os.path.join(balance_dir,
+                    '%s.balance' % qprefix)
+        self.balance_mtime = None
+        self.load_balance()
+
+    def load_balance(self):
+        """Reload the balance file if it has changed."""
+        self.last_balance_check = time.time()
+
+        if not self.balance_file:
+            return
+
+        try:
+            mtime = os.stat(self.balance_file).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.balance_mtime:
+            return
+
+        try:
+            weights, overrides, handoff = read_balance(self.balance_file)
+            ring = HashRing(dict((i, weights.get(i, 1.0))
+                                for i in range(1, self.num_workers + 1)))
+            prev_ring = None
+            if handoff:
+                prev_ring = HashRing(dict((i, handoff['weights'].get(i, 1.0))
+                                for i in range(1, self.num_workers + 1)))
+        except (IOError, ValueError, KeyError), e:
+            self.log.error("unable to read %s: %s" % (self.balance_file, e))
+            return
+
+        self.balance_mtime = mtime
+        self.ring = ring
+        self.overrides = dict((k, w) for k, w in overrides.iteritems()
+                                if 1 <= w <= self.num_workers)
+        self.worker_map = {}
+
+        self.handoff = handoff
+        self.prev_ring = prev_ring
+        self.prev_overrides = handoff and handoff['overrides'] or {}
+        self.moving = {}
+
+        self.log.debug("loaded %s: %d overrides" % (self.balance_file,
+            len(self.overrides)))
 
     def get_worker(self, result):
+        if time.time() > self.last_balance_check + \
+                self.BALANCE_CHECK_INTERVAL:
+            self.load_balance()
+
         k = ":".join((result.oidset_name, result.device_name))
         try:
             w = self.worker_map[k]
         except KeyError:
-            work_size = len(result.data)
-            w = self.worker_load[0][0]
+            w = self.overrides.get(k)
+            if w is None:
+                w = self.ring.get_worker(k)
             self.worker_map[k] = w
 
-            self.worker_load[0][1] += work_size
+            self.log.debug("worker assigned: %s %d" % (k, w))
 
-            self.log.debug("worker assigned: %s %d load=%d" % (k, w,
-                self.worker_load[0][1]))
+        return '%s_%d' % (self.qprefix, w)
 
-            self.worker_load.sort(key=lambda x: x[1])
+    def is_moving(self, result):
+        """True if result has to be held because its key is being handed
+        off to another worker."""
+        if self.handoff is None:
+            return False
 
-        return '%s_%d' % (self.qprefix, w)
+        if time.time() > self.handoff['since'] + self.HANDOFF_TIMEOUT:
+            self.log.warning("%s: handoff not done after %d seconds, "
+                    "releasing %d results" % (self.qprefix,
+                        self.HANDOFF_TIMEOUT, len(self.held)))
+            self.handoff = None
+            return False
+
+        k = ":".join((result.oidset_name, result.device_name))
+        try:
+            return self.moving[k]
+        except KeyError:
+            w = self.prev_overrides.get(k)
+            if w is None:
+                w = self.prev_ring.get_worker(k)
+            moving = self.moving[k] = \
+                    self.get_worker(result) != '%s_%d' % (self.qprefix, w)
+            return moving
 
     def put(self, result):
-        workerqname = self.get_worker(result)
-        workerq = self.queues[workerqname]
-        workerq.put(result)
+        self.put_many([result])
+
+    def put_many(self, results):
+        # get_worker() reloads the balance file so route the new results
+        # first, then send any held results ahead of them.
+        routed = []
+        for result in results:
+            workerqname = self.get_worker(result)
+            if self.is_moving(result):
+                self.held.append(result)
+            else:
+                routed.append((workerqname, result))
+
+        batches = {}
+        if self.held and self.handoff is None:
+            released, self.held = self.held, []
+            self.log.debug("%s: handoff done, sending %d held results" % (
+                self.qprefix, len(released)))
+            for result in released:
+                batches.setdefault(self.get_worker(result), []).append(result)
+
+        for workerqname, result in routed:
+            batches.setdefault(workerqname, []).append(result)
+
+        for workerqname, batch in batches.iteritems():
+            self.queues[workerqname].put_many(batch)
+
+
+class HandoffWatcher(object):
+    """Watches the balance file of a queue for the handoff fence of one of
+    its workers.  The worker writes everything it has taken off of its
+    queue once it gets to the fence, so the keys moving off of it can be
+    handed to their new workers, see PersistManager.advance_handoffs()."""
+
+    CHECK_INTERVAL = 5
+
+    def __init__(self, balance_file, index):
+        self.balance_file = balance_file
+        self.index = index
+        self.log = get_logger("HandoffWatcher")
+        self.balance_mtime = None
+        self.next_check = 0
+        self.current = None
+        self.done = None
+        # Set when keys may have moved off of this worker.
+        self.moved = False
+
+    def fence(self, now):
+        """The fence to get to, or None."""
+        if now >= self.next_check:
+            self.next_check = now + self.CHECK_INTERVAL
+            self.load()
+
+        if self.current == self.done:
+            return None
+        return self.current
+
+    def passed(self, fence):
+        self.log.debug("%s: worker %d passed fence %d" % (self.balance_file,
+            self.index, fence))
+        self.done = fence
+        self.moved = True
 
+    def load(self):
+        try:
+            mtime = os.stat(self.balance_file).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.balance_mtime:
+            return
+
+        try:
+            weights, overrides, handoff = read_balance(self.balance_file)
+        except (IOError, ValueError, KeyError), e:
+            self.log.error("unable to read %s: %s" % (self.balance_file, e))
+            return
+
+        self.balance_mtime = mtime
+        current = handoff and handoff['fences'].get(self.index)
+        if self.current is not None and self.current != self.done and \
+                current != self.current:
+            # The handoff timed out, the keys moved anyway.
+            self.log.warn("%s: worker %d didn't get to fence %d" % (
+                self.balance_file, self.index, self.current))
+            self.moved = True
+        self.current = current
+
+
+class PersistHandler(object):
+    """Sends results to the queues given by persist_map.  Subclasses set
+    queue_class to the PersistQueue to use."""
+    queue_class = None
 
-class MemcachedPersistHandler(object):
     def __init__(self, name, config, uri):
         self.queues = {}
         self.config = config
@@ -1122,24 +2086,56 @@ class MemcachedPersistHandler(object):
             num_workers = self.config.persist_queues[qname][1]
             if num_workers > 1:
                 self.queues[qname] = MultiWorkerQueue(qname,
-                        MemcachedPersistQueue, uri, num_workers)
+                        self.queue_class, uri, num_workers,
+                        balance_dir=config.persist_balance_dir)
+            else:
+                self.queues[qname] = self.queue_class(qname, uri)
+
+            fmt = config.persist_formats.get(qname, 'json')
+            if num_workers > 1:
+                for q in self.queues[qname].queues.itervalues():
+                    q.format = fmt
             else:
-                self.queues[qname] = MemcachedPersistQueue(qname, uri)
+                self.queues[qname].format = fmt
 
     def put(self, result):
-        try:
-            qnames = self.config.persist_map[result.oidset_name.lower()]
-        except KeyError:
-            self.log.error("unknown oidset: %s" % result.oidset_name)
-            return
+        self.put_many([result])
+
+    def put_many(self, results):
+        batches = {}
+        now = time.time()
+        for result in results:
+            result.enqueue_ts = now
+            try:
+                qnames = self.config.persist_map[result.oidset_name.lower()]
+            except KeyError:
+                self.log.error("unknown oidset: %s" % result.oidset_name)
+                continue
 
-        for qname in qnames:
+            for qname in qnames:
+                batches.setdefault(qname, []).append(result)
+
+        for qname, batch in batches.iteritems():
             try:
                 q = self.queues[qname]
             except KeyError:
                 self.log.error("unknown queue: %s" % (qname,))
+                continue
+
+            q.put_many(batch)
+
 
-            q.put(result)
+class MemcachedPersistHandler(PersistHandler):
+    queue_class = MemcachedPersistQueue
+
+
+class SegmentLogPersistHandler(PersistHandler):
+    """The uri is the queue directory, persist_queue_dir if empty."""
+    queue_class = SegmentLogPersistQueue
+
+    def __init__(self, name, config, uri):
+        PersistHandler.__init__(self, name, config,
+                uri or config.persist_queue_dir)
 
 
 def do_profile(func_name, myglobals, mylocals):
@@ -1188,6 +2184,11 @@ class QueueStats:
                 self.warn = True
                 break
 
+    def get_flushed(self):
+        """The last item the persister has written everything up to."""
+        v = self.mc.get('%s_%s_last_flushed' % (self.prefix, self.qname))
+        return int(v or 0)
+
     def get_stats(self):
         pending = self.last_added[0] - self.last_read[0]
         new = self.last_added[0] - self.last_added[1]
@@ -1201,19 +2202,45 @@ class QueueStats:
                 self.last_added[0])
 
 
+class SegmentLogQueueStats(QueueStats):
+    def __init__(self, directory, qname):
+        QueueStats.__init__(self, None, qname)
+        self.slog = SegmentLog(os.path.join(directory, qname))
+
+    def update_stats(self):
+        for k in ('last_read', 'last_added'):
+            l = getattr(self, k)
+            l.pop()
+            l.insert(0, getattr(self.slog, k))
+
+    def get_flushed(self):
+        # The reader only commits what has been written.
+        return self.slog.last_read
+
+
+def queue_stats_factory(config):
+    """Returns a function that makes the QueueStats for a queue name."""
+    if config.persist_queue_dir:
+        return lambda qname: \
+                SegmentLogQueueStats(config.persist_queue_dir, qname)
+    else:
+        mc = memcache.Client(['127.0.0.1:11211'])
+        return lambda qname: QueueStats(mc, qname)
+
+
 def stats(name, config, opts):
     stats = {}
-    mc = memcache.Client(['127.0.0.1:11211'])
+    make_stats = queue_stats_factory(config)
 
     for qname, qinfo in config.persist_queues.iteritems():
         (qclass, nworkers) = qinfo
         if nworkers == 1:
-                stats[qname] = QueueStats(mc, qname)
+                stats[qname] = make_stats(qname)
                 stats[qname].update_stats()
         else:
             for i in range(1, nworkers + 1):
                 k = "%s_%d" % (qname, i)
-                stats[k] = QueueStats(mc, k)
+                stats[k] = make_stats(k)
                 stats[k].update_stats()
 
     keys = stats.keys()
@@ -1230,9 +2257,160 @@ def stats(name, config, opts):
         total.insert(0, "TOTAL")
         print "%20s % 8d % 8d % 8d % 8d" % tuple(total)
         print ""
+        if config.persist_stats_dir:
+            print_latency_stats(config)
+            print ""
         time.sleep(5)
 
 
+def latency_stats(config):
+    """
+    Read the stats files written by the workers.  Returns a sorted list of
+    (name, records/sec, histograms) for each worker queue and for each
+    queue with several workers, where histograms maps the name of each
+    latency histogram kept by PollPersister to a LogHistogram.
+    """
+    files = read_stats_files(config.persist_stats_dir,
+            max_age=3 * PollPersister.STATS_INTERVAL)
+    rows = {}
+
+    for wqname, s in files.iteritems():
+        hists = dict((k, LogHistogram.from_dict(s[k]))
+                    for k in ('poll_delay', 'queue_latency', 'store_time'))
+        rate = s['records'] / s['interval']
+        rows[wqname] = (rate, hists)
+
+        qname = wqname
+        if qname not in config.persist_queues:
+            qname = wqname.rsplit('_', 1)[0]
+        if qname == wqname:
+            continue
+
+        total_rate, total = rows.setdefault(qname, (0.0, dict(
+            (k, LogHistogram()) for k in hists)))
+        for k, h in hists.iteritems():
+            total[k].merge(h)
+        rows[qname] = (total_rate + rate, total)
+
+    return [(k, ) + rows[k] for k in sorted(rows)]
+
+
+def print_latency_stats(config):
+    print "%20s %8s %10s %10s %10s %10s %10s" % ("queue", "rec/sec",
+            "poll p99", "queue p50", "queue p99", "queue max", "store p99")
+    for name, rate, hists in latency_stats(config):
+        queue = hists['queue_latency']
+        print "%20s % 8d %10.3f %10.3f %10.3f %10.3f %10.3f" % (name, rate,
+                hists['poll_delay'].percentile(99), queue.percentile(50),
+                queue.percentile(99), queue.max,
+                hists['store_time'].percentile(99))
+
+
+def check_latency(config, warning, critical):
+    """
+    Nagios check of the 99th percentile enqueue to store latency of every
+    worker queue.  Returns the Nagios exit status.
+    """
+    if not config.persist_stats_dir:
+        print "PERSIST LATENCY UNKNOWN - persist_stats_dir is not set"
+        return 3
+
+    rows = latency_stats(config)
+    if not rows:
+        print "PERSIST LATENCY UNKNOWN - no recent stats in %s" % \
+                config.persist_stats_dir
+        return 3
+
+    p99 = [(hists['queue_latency'].percentile(99), name)
+            for name, rate, hists in rows]
+    worst, worst_name = max(p99)
+    perfdata = " ".join("%s=%.3fs;%s;%s" % (name, v, warning or '',
+        critical or '') for v, name in p99)
+
+    if critical is not None and worst >= critical:
+        status, code = "CRITICAL", 2
+    elif warning is not None and worst >= warning:
+        status, code = "WARNING", 1
+    else:
+        status, code = "OK", 0
+
+    print "PERSIST LATENCY %s - p99 %.3fs (%s) | %s" % (status, worst,
+            worst_name, perfdata)
+    return code
+
+
+def rebalance(name, config, opts):
+    """Move keys off of the busiest workers of each multi-worker queue.
+
+    Uses the costs reported by the workers to the balance dir and updates
+    the balance file read by the pollers."""
+
+    if not config.persist_balance_dir:
+        print >>sys.stderr, "persist_balance_dir is not set"
+        sys.exit(1)
+
+    now = time.time()
+
+    for qname, qinfo in config.persist_queues.iteritems():
+        (qclass, nworkers) = qinfo
+        if nworkers < 2 or (opts.qname and opts.qname != qname):
+            continue
+
+        balance_file = os.path.join(config.persist_balance_dir,
+                '%s.balance' % qname)
+        weights, overrides, handoff = read_balance(balance_file)
+        if handoff:
+            print "%s: a handoff is in progress, skipping" % qname
+            continue
+        ring = HashRing(dict((w, weights.get(w, 1.0))
+                            for w in range(1, nworkers + 1)))
+        prev_overrides = dict(overrides)
+
+        # Workers retired by the autoscaler have a weight of 0.
+        workers = [w for w in range(1, nworkers + 1) if weights.get(w, 1.0)]
+        costs = {}
+        for w in workers:
+            filename = os.path.join(config.persist_balance_dir,
+                    '%s_%d.cost' % (qname, w))
+            try:
+                report = json.load(open(filename))
+            except (IOError, ValueError):
+                continue
+
+            # Ignore workers that haven't reported recently.
+            if now - report['written'] > 3 * report['interval']:
+                continue
+
+            costs[w] = dict((k, v / report['interval'])
+                            for k, v in report['costs'].iteritems())
+
+        if len(costs) < len(workers):
+            print "%s: only %d of %d workers have reported costs, skipping" \
+                    % (qname, len(costs), len(workers))
+            continue
+
+        key_costs = {}
+        for worker_costs in costs.itervalues():
+            key_costs.update(worker_costs)
+
+        moves = plan_moves(costs, workers)
+        for key, src, dst in moves:
+            print "%s: moving %s from worker %d to %d (%.1f%% busy)" % (
+                    qname, key, src, dst, 100 * key_costs[key])
+            if ring.get_worker(key) == dst:
+                overrides.pop(key, None)
+            else:
+                overrides[key] = dst
+
+        if moves:
+            # espersistd hands the keys over once their old workers are
+            # done with them.
+            write_balance_file(balance_file, weights, overrides,
+                    start_handoff(None, weights, prev_overrides))
+        else:
+            print "%s: balanced" % qname
+
+
 def worker(name, config, opts):
     if not opts.debug:
         exc_handler = setup_exc_handler(name, config)
@@ -1240,7 +2418,8 @@ def worker(name, config, opts):
 
     os.umask(0022)
 
-    (qclass, nworkers) = config.persist_queues[opts.qname]
+    qprefix = opts.qname
+    (qclass, nworkers) = config.persist_queues[qprefix]
     if nworkers > 1:
         name += '_%s' % opts.number
         opts.qname += '_%s' % opts.number
@@ -1252,11 +2431,79 @@ def worker(name, config, opts):
     klass = eval(qclass)
     worker = klass(config, opts.qname, persistq=None)
 
+    if nworkers > 1 and config.persist_balance_dir:
+        worker.handoff = HandoffWatcher(os.path.join(
+            config.persist_balance_dir, '%s.balance' % qprefix),
+            int(opts.number))
+
     worker.run()
     # do_profile("worker.run()", globals(), locals())
 
 
+class WorkerScaler(object):
+    """Decides when to add or retire workers for a queue.
+
+    update() is called with the backlog of the active workers every
+    persist_autoscale_interval seconds.  A worker is added once the backlog
+    per worker has been over the limit for GROW_CHECKS checks in a row and
+    one is retired once it has been under a tenth of the limit for
+    SHRINK_CHECKS checks, so a queue grows quickly and shrinks slowly."""
+
+    GROW_CHECKS = 2
+    SHRINK_CHECKS = 10
+
+    def __init__(self, min_workers, max_workers, backlog, active):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.backlog = backlog
+        self.active = max(min_workers, min(active, max_workers))
+        self.high = 0
+        self.low = 0
+
+    def update(self, pending):
+        """Returns 1 to add a worker, -1 to retire one and 0 otherwise."""
+        per_worker = float(pending) / self.active
+
+        if per_worker > self.backlog:
+            self.high += 1
+            self.low = 0
+        elif per_worker < self.backlog / 10.0:
+            self.low += 1
+            self.high = 0
+        else:
+            self.high = 0
+            self.low = 0
+
+        if self.high >= self.GROW_CHECKS and self.active < self.max_workers:
+            self.active += 1
+            self.high = 0
+            return 1
+
+        if self.low >= self.SHRINK_CHECKS and self.active > self.min_workers:
+            self.active -= 1
+            self.low = 0
+            return -1
+
+        return 0
+
+
 class PersistManager(object):
+    """Starts the workers for each queue and restarts them if they die.
+
+    Queues listed in persist_autoscale start with the workers that are
+    active in their balance file and are scaled between the minimum given
+    there and the number of workers in persist_queues.  A retired worker
+    gets a weight of 0 so that the pollers stop sending it results, it is
+    stopped once its queue is empty.
+
+    The manager also finishes the handoffs started by scaling and by
+    espersistd -r rebalance, see advance_handoff(), and doesn't scale a
+    queue while one is in progress."""
+
+    # The pollers reload the balance file every BALANCE_CHECK_INTERVAL.
+    RETIRE_GRACE = 2 * MultiWorkerQueue.BALANCE_CHECK_INTERVAL
+    HANDOFF_CHECK_INTERVAL = 5
+
     def __init__(self, name, config, opts):
         self.name = name
         self.config = config
@@ -1264,6 +2511,12 @@ class PersistManager(object):
         self.runing = False
 
         self.processes = {}
+        self.scalers = {}
+        # (qname, index) -> time the worker was retired
+        self.draining = {}
+        self.queue_stats = {}
+        # queues with a handoff in progress
+        self.handoffs = set()
 
         if tsdb:
             if config.tsdb_root and not os.path.isdir(config.tsdb_root):
@@ -1293,10 +2546,103 @@ class PersistManager(object):
         signal.signal(signal.SIGINT, self.stop)
         signal.signal(signal.SIGTERM, self.stop)
 
+    def init_scalers(self):
+        for qname, min_workers in self.config.persist_autoscale.iteritems():
+            nworkers = self.config.persist_queues[qname][1]
+            if nworkers < 2:
+                continue
+
+            weights, overrides = read_balance_file(self.balance_file(qname))
+            active = len([w for w in range(1, nworkers + 1)
+                            if weights.get(w, 1.0)])
+            scaler = WorkerScaler(min_workers, nworkers,
+                    self.config.persist_autoscale_backlog, active)
+            set_active_workers(self.balance_file(qname), nworkers,
+                    scaler.active)
+
+            self.scalers[qname] = scaler
+            self.log.info("%s: autoscaling %d-%d workers, %d active" % (
+                qname, min_workers, nworkers, scaler.active))
+
+    def balance_file(self, qname):
+        return os.path.join(self.config.persist_balance_dir,
+                '%s.balance' % qname)
+
+    def get_queue_stats(self, qname, index):
+        wqname = '%s_%d' % (qname, index)
+        try:
+            qstats = self.queue_stats[wqname]
+        except KeyError:
+            qstats = self.queue_stats[wqname] = self.make_stats(wqname)
+
+        qstats.update_stats()
+        return qstats
+
+    def queue_backlog(self, qname, index):
+        return max(self.get_queue_stats(qname, index).get_stats()[1], 0)
+
+    def is_running(self, qname, index):
+        return any(pinfo[1] == qname and pinfo[3] == index
+                    for pinfo in self.processes.itervalues())
+
+    def advance_handoff(self, qname, now):
+        """
+        Move the handoff in progress for qname along.  Once every poller
+        has seen it (and is holding the results for the keys that are
+        moving) each worker gets a fence at the end of its queue.  Once
+        every worker has written everything up to its fence the handoff is
+        removed and the pollers send the held results to the new workers.
+        """
+        filename = self.balance_file(qname)
+        try:
+            weights, overrides, handoff = read_balance(filename)
+        except (IOError, ValueError, KeyError), e:
+            self.log.error("unable to read %s: %s" % (filename, e))
+            return
+
+        if not handoff:
+            self.handoffs.discard(qname)
+            return
+        self.handoffs.add(qname)
+
+        if now < handoff['since'] + self.RETIRE_GRACE:
+            return
+
+        nworkers = self.config.persist_queues[qname][1]
+        if not handoff['fences']:
+            for i in range(1, nworkers + 1):
+                qstats = self.get_queue_stats(qname, i)
+                if self.is_running(qname, i) or qstats.get_stats()[1] > 0:
+                    handoff['fences'][i] = qstats.last_added[0]
+            self.log.info("%s: handoff fences %s" % (qname,
+                handoff['fences']))
+            write_balance_file(filename, weights, overrides, handoff)
+            return
+
+        behind = [i for i, fence in handoff['fences'].iteritems()
+                    if self.get_queue_stats(qname, i).get_flushed() < fence]
+        if not behind:
+            self.log.info("%s: handoff done" % qname)
+        elif now > handoff['since'] + MultiWorkerQueue.HANDOFF_TIMEOUT:
+            self.log.error("%s: handoff timed out waiting for workers %s" % (
+                qname, behind))
+        else:
+            return
+
+        write_balance_file(filename, weights, overrides)
+        self.handoffs.discard(qname)
+
     def start_all_children(self):
         for qname, qinfo in self.config.persist_queues.iteritems():
             (qclass, nworkers) = qinfo
+            scaler = self.scalers.get(qname)
             for i in range(1, nworkers + 1):
+                if scaler and i > scaler.active:
+                    # Retired, but it may have been stopped before it was
+                    # done with its queue.
+                    if not self.queue_backlog(qname, i):
+                        continue
+                    self.draining[(qname, i)] = time.time()
                 self.start_child(qname, qclass, i)
 
     def start_child(self, qname, qclass, index):
@@ -1312,21 +2658,94 @@ class PersistManager(object):
 
         self.processes[p.pid] = (p, qname, qclass, index)
 
+    def stop_child(self, pid):
+        p, qname, qclass, index = self.processes.pop(pid)
+        self.log.info("killing pid %d: %s_%d" % (pid, qname, index))
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    def scale_workers(self):
+        now = time.time()
+
+        for qname, scaler in self.scalers.iteritems():
+            if qname in self.handoffs:
+                continue
+
+            (qclass, nworkers) = self.config.persist_queues[qname]
+            backlog = dict((i, self.queue_backlog(qname, i))
+                            for i in range(1, nworkers + 1))
+            active = scaler.active
+            pending = sum(backlog[i] for i in range(1, active + 1))
+
+            change = scaler.update(pending)
+            if change:
+                set_active_workers(self.balance_file(qname), nworkers,
+                        scaler.active, now)
+                self.handoffs.add(qname)
+
+            if change > 0:
+                index = scaler.active
+                self.log.info("%s: backlog of %d for %d workers, adding worker %d"
+                        % (qname, pending, active, index))
+                if self.draining.pop((qname, index), None) is None:
+                    self.start_child(qname, qclass, index)
+            elif change < 0:
+                index = active
+                self.log.info("%s: backlog of %d for %d workers, retiring worker %d"
+                        % (qname, pending, active, index))
+                self.draining[(qname, index)] = now
+
+        for (qname, index), retired in self.draining.items():
+            if now < retired + self.RETIRE_GRACE or \
+                    self.queue_backlog(qname, index):
+                continue
+
+            self.log.info("%s_%d: queue drained, stopping worker" % (qname,
+                index))
+            del self.draining[(qname, index)]
+            for pid, pinfo in self.processes.items():
+                if pinfo[1] == qname and pinfo[3] == index:
+                    self.stop_child(pid)
+
     def run(self):
         self.log.info("starting")
         self.running = True
 
+        if self.config.persist_balance_dir:
+            self.make_stats = queue_stats_factory(self.config)
+        if self.config.persist_autoscale:
+            self.init_scalers()
+
         self.start_all_children()
+        next_scale = time.time() + self.config.persist_autoscale_interval
+        next_handoff = 0
 
         while self.running:
             try:
-                pid, status = os.wait()
+                pid, status = os.waitpid(-1, os.WNOHANG)
             except OSError, e:
                 if e.errno == errno.EINTR:
                     continue
+                elif e.errno == errno.ECHILD:
+                    pid = 0
                 else:
                     raise
 
+            if not pid:
+                if self.config.persist_balance_dir and \
+                        time.time() >= next_handoff:
+                    for qname, qinfo in self.config.persist_queues.iteritems():
+                        if qinfo[1] > 1:
+                            self.advance_handoff(qname, time.time())
+                    next_handoff = time.time() + self.HANDOFF_CHECK_INTERVAL
+                if self.scalers and time.time() >= next_scale:
+                    self.scale_workers()
+                    next_scale = time.time() + \
+                            self.config.persist_autoscale_interval
+                time.sleep(1)
+                continue
+
             p, qname, qclass, index = self.processes[pid]
             del self.processes[pid]
             self.log.error("child died: pid %d, %s_%d" % (pid, qname, index))
@@ -1335,12 +2754,8 @@ class PersistManager(object):
 
             self.start_child(qname, qclass, index)
 
-        for pid, pinfo in self.processes.iteritems():
-            p, qname, qclass, index = pinfo
-            self.log.info("killing pid %d: %s_%d" % (pid, qname, index))
-
-            os.kill(pid, signal.SIGTERM)
-            os.waitpid(pid, 0)
+        for pid in self.processes.keys():
+            self.stop_child(pid)
 
         self.log.info("exiting")
 
@@ -1396,6 +2811,8 @@ def espersistd():
             sys.exit(1)
     elif opts.role == 'stats':
         stats(name, config, opts)
+    elif opts.role == 'rebalance':
+        rebalance(name, config, opts)
     else:
         print >>sys.stderr, "unknown role: %s" % opts.role
 
@@ -1406,6 +2823,12 @@ def espersistq():
 
     argv = sys.argv
     oparse = get_opt_parser(default_config_file=get_config_path())
+    oparse.add_option("-w", "--warning", dest="warning", type="float",
+            default=None, help="check the p99 queue latency, warning "
+            "threshold in seconds")
+    oparse.add_option("-c", "--critical", dest="critical", type="float",
+            default=None, help="check the p99 queue latency, critical "
+            "threshold in seconds")
     (opts, args) = oparse.parse_args(args=argv)
 
     opts.config_file = os.path.abspath(opts.config_file)
@@ -1416,4 +2839,7 @@ def espersistq():
         print >>sys.stderr, e
         sys.exit(1)
 
+    if opts.warning is not None or opts.critical is not None:
+        sys.exit(check_latency(config, opts.warning, opts.critical))
+
     stats("espersistq", config, opts)
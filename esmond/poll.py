@@ -1,3 +1,8 @@
+import errno
+import heapq
+import itertools
+import json
+import math
 import os
 import signal
 import sys
@@ -6,6 +11,9 @@ import re
 import socket
 import threading
 import Queue
+import __main__
+
+from subprocess import Popen, PIPE, STDOUT
 
 import django
 
@@ -16,6 +24,9 @@ from esmond.util import setproctitle, init_logging, get_logger, \
 from esmond.util import daemonize, setup_exc_handler
 from esmond.config import get_opt_parser, get_config, get_config_path
 from esmond.error import ConfigError, PollerError
+from esmond.hashring import hash_key
+from esmond.lease import LeaseManager
+from esmond.metrics import LogHistogram
 from esmond.persist import PollResult, PersistClient
 from esmond.api.models import Device, IfRef, OIDSet
 
@@ -34,7 +45,49 @@ class PollUnknownIfIndex(PollError):
     pass
 
 
+class PollData(list):
+    """The (var, val) pairs returned by a walk, indexed by OID column.
+
+    The index maps each column (the var up to the first '.') to its pairs.
+    It is built in a single pass the first time a column is looked up, so
+    looking up every OID in an OIDSet is linear in the size of the result
+    rather than a scan of the whole result per OID.  The index isn't
+    updated if the list is changed after that."""
+
+    def __init__(self, pairs=()):
+        list.__init__(self, pairs)
+        self._columns = None
+
+    def _index(self):
+        columns = {}
+        for pair in self:
+            column = pair[0].split('.', 1)[0]
+            try:
+                columns[column].append(pair)
+            except KeyError:
+                columns[column] = [pair]
+        self._columns = columns
+
+    def column(self, name):
+        """The pairs whose var starts with name, like filter_data()."""
+        if self._columns is None:
+            self._index()
+
+        if '.' not in name:
+            matches = [c for c in self._columns if c.startswith(name)]
+            if not matches:
+                return []
+            if len(matches) == 1:
+                return list(self._columns[matches[0]])
+
+        # name is a prefix of several columns or includes part of the
+        # index, scan to keep the order of the result.
+        return [x for x in self if x[0].startswith(name)]
+
+
 def filter_data(name, data):
+    if isinstance(data, PollData):
+        return data.column(name)
     return filter(lambda x: x[0].startswith(name), data)
 
 
@@ -272,7 +325,7 @@ class CiscoCPUCorrelator(PollCorrelator):
 
     oids = ['cpmCPUTotalPhysicalIndex', 'entPhysicalName']
 
-    def setup(self):
+    def setup(self, data):
         self.phys_xlate = self._table_parse(
                 filter_data('cpmCPUTotalPhysicalIndex', data))
         self.name_xlate = self._table_parse(
@@ -342,6 +395,8 @@ class PersistThread(threading.Thread):
     RUN = 1
     REMOVE = 2
 
+    BATCH_SIZE = 100
+
     def __init__(self, name, config, persistq):
         threading.Thread.__init__(self)
 
@@ -357,11 +412,19 @@ class PersistThread(threading.Thread):
         self.state = self.RUN
         while self.state == self.RUN:
             try:
-                task = self.persistq.get(block=True)
+                tasks = [self.persistq.get(block=True)]
             except Queue.Empty:
-                pass
-            else:
-                self.persister.put(task)
+                continue
+
+            # Send whatever else is already waiting along with it.
+            while len(tasks) < self.BATCH_SIZE:
+                try:
+                    tasks.append(self.persistq.get_nowait())
+                except Queue.Empty:
+                    break
+
+            self.persister.put_many(tasks)
+            for task in tasks:
                 self.persistq.task_done()
 
     def stop(self):
@@ -373,18 +436,37 @@ class PollManager(object):
 
     The main polling is done asynchronously in the main thread.  There is a
     second thread which handles the interactions with the persistence
-    system."""
+    system.
+
+    The pollers are kept in a heap ordered by the time of their next poll so
+    the main thread only looks at the pollers that are due and sleeps until
+    the next one is.  Stopped pollers are left in the heap and skipped when
+    they come up.
 
-    def __init__(self, name, opts, args, config):
+    shard is an (index, count) pair when this is one of several poller
+    processes run by a PollSupervisor, only the devices in the shard are
+    polled.  With poll_leases on, the devices are divided between all the
+    pollers on all hosts by leases instead, see esmond.lease."""
+
+    def __init__(self, name, opts, args, config, shard=None):
         self.name = name
         self.opts = opts
         self.args = args
         self.config = config
+        self.shard = shard
 
         self.hostname = socket.gethostname()
 
         self.log = get_logger(self.name)
 
+        self.leases = None
+        if config.poll_leases:
+            instance = config.poll_instance or self.hostname
+            if shard:
+                instance += "_%d" % shard[0]
+            self.leases = LeaseManager(instance, config.poll_lease_time)
+            self.log.info("leasing devices as %s" % instance)
+
         self.running = False
         self.last_reload = time.time()
         self.last_penalty_empty = time.time()
@@ -392,13 +474,24 @@ class PollManager(object):
         self.reload_interval = 30
         self.penalty_interval = 300
 
-        self.devices = Device.objects.active_as_dict()
+        self.devices = self._active_devices()
 
         self.persistq = Queue.Queue()
         self.snmp_poller = AsyncSNMPPoller(config=self.config,
                 name="espolld.snmp_poller")
         self.pollers = {}
 
+        self.tuning_file = None
+        if config.poll_adaptive and config.poll_tuning_dir:
+            self.tuning_file = os.path.join(config.poll_tuning_dir,
+                    "%s.tuning" % self.name)
+            self.snmp_poller.load_tuning(self.tuning_file)
+
+        # (next_poll, seq, key, poller)
+        self.schedule = []
+        self.schedule_seq = itertools.count()
+        self.lateness = LogHistogram()
+
     def start_polling(self):
         self.log.debug("starting, %d devices configured" % len(self.devices))
 
@@ -423,18 +516,71 @@ class PollManager(object):
         self.last_reload = time.time()
 
         while self.running:
-            for poller in self.pollers.itervalues():
-                poller.run_once()
+            self.run_due(time.time())
 
             if self.last_reload + self.config.reload_interval <= time.time():
                 if self.config.debug:
                     django.db.reset_queries()
+                self.report_lateness()
+                self.save_tuning()
                 self.reload()
 
-            time.sleep(1)
+            wakeup = self.last_reload + self.config.reload_interval
+            if self.schedule:
+                wakeup = min(wakeup, self.schedule[0][0])
+            # Signals may be delivered to one of the other threads, so don't
+            # sleep more than a second at a time to notice stop_polling().
+            delay = min(wakeup - time.time(), 1)
+            if delay > 0:
+                time.sleep(delay)
 
         self.shutdown()
 
+    def _schedule(self, key, poller):
+        heapq.heappush(self.schedule,
+                (poller.next_poll, self.schedule_seq.next(), key, poller))
+
+    def run_due(self, now):
+        """Run the pollers that are due at now and schedule their next poll."""
+        while self.schedule and self.schedule[0][0] <= now:
+            (due, seq, key, poller) = heapq.heappop(self.schedule)
+            if self.pollers.get(key) is not poller:
+                continue
+
+            if poller.run_once():
+                self.lateness.add(poller.begin_time - due)
+            self._schedule(key, poller)
+
+    def save_tuning(self):
+        if not self.tuning_file:
+            return
+        try:
+            self.snmp_poller.save_tuning(self.tuning_file)
+        except (IOError, OSError), e:
+            self.log.error("unable to save %s: %s" % (self.tuning_file, e))
+
+    def report_lateness(self):
+        """Log how late the polls since the last report started."""
+        h = self.lateness
+        if h.count:
+            self.log.info("%d polls, lateness p50 %.3fs p99 %.3fs max %.3fs" %
+                    (h.count, h.percentile(50), h.percentile(99), h.max))
+        h.reset()
+
+    def _active_devices(self):
+        devices = Device.objects.active_as_dict()
+        if self.leases:
+            leased = self.leases.claim(devices.keys())
+            for name in devices.keys():
+                if name not in leased:
+                    del devices[name]
+        elif self.shard:
+            (index, count) = self.shard
+            for name in devices.keys():
+                if device_shard(name, count) != index:
+                    del devices[name]
+        return devices
+
     def _start_thread(self, name, t):
         t.setDaemon(True)
         t.setName(name)
@@ -487,7 +633,9 @@ class PollManager(object):
             self.log.error(str(e))
             return
 
+        poller.stagger(time.time())
         self.pollers[key] = poller
+        self._schedule(key, poller)
 
     def _stop_poller(self, poller_name):
         self.log.info("stopping poller %s" % poller_name)
@@ -507,6 +655,9 @@ class PollManager(object):
         self.log.info("draining persistq: %d items remain" % (
             self.persistq.qsize(), ))
         self.persistq.join()
+        if self.leases:
+            self.leases.release()
+        self.save_tuning()
         self.log.info("sucessful shutdown: exiting")
 
     def reload(self):
@@ -515,7 +666,7 @@ class PollManager(object):
 
         self.log.debug("reloading devices and oidsets")
 
-        new_devices = Device.objects.active_as_dict()
+        new_devices = self._active_devices()
 
         new_device_set = set(new_devices.iterkeys())
         old_device_set = set(self.devices.iterkeys())
@@ -561,6 +712,95 @@ class PollManager(object):
         self.last_reload = time.time()
 
 
+def device_shard(name, count):
+    """The shard, 1 through count, of the poller process that polls the
+    device called name."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return hash_key(name) % count + 1
+
+
+class PollSupervisor(object):
+    """Starts poll_processes espolld poller processes and restarts them if
+    they die.
+
+    Each poller is a PollManager for one shard of the devices, see
+    device_shard().  A device is always in the same shard so the pollers
+    pick up added and removed devices when they reload without having to
+    coordinate."""
+
+    def __init__(self, name, opts, config):
+        self.name = name
+        self.opts = opts
+        self.config = config
+        self.running = False
+
+        self.log = get_logger(name)
+        # save the location of the calling script for later use
+        # (os.path.abspath uses current directory and daemonize does a cd /)
+        self.caller_path = os.path.abspath(__main__.__file__)
+
+        self.processes = {}
+
+    def start_child(self, index):
+        args = [sys.executable, self.caller_path,
+                '-r', 'poller',
+                '-n', str(index),
+                '-f', self.opts.config_file]
+
+        p = Popen(args, stdout=PIPE, stderr=STDOUT)
+
+        self.processes[p.pid] = (p, index)
+
+    def stop_child(self, pid):
+        p, index = self.processes.pop(pid)
+        self.log.info("killing pid %d: poller %d" % (pid, index))
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    def run(self):
+        self.log.info("starting %d pollers" % self.config.poll_processes)
+        self.running = True
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for index in range(1, self.config.poll_processes + 1):
+            self.start_child(index)
+
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.ECHILD:
+                    pid = 0
+                else:
+                    raise
+
+            if not pid:
+                time.sleep(1)
+                continue
+
+            p, index = self.processes.pop(pid)
+            self.log.error("child died: pid %d, poller %d" % (pid, index))
+            for line in p.stdout.readlines():
+                self.log.error("pid %d: %s" % (pid, line))
+
+            self.start_child(index)
+
+        for pid in self.processes.keys():
+            self.stop_child(pid)
+
+        self.log.info("exiting")
+
+    def stop(self, x, y):
+        self.log.info("stopping")
+        self.running = False
+
+
 class Poller(object):
     """The Poller class is the base for all pollers.
 
@@ -602,16 +842,45 @@ class Poller(object):
         return '<%s: %s %s>' % (self.__name__, self.device.name,
                 self.oidset.name)
 
+    def stagger(self, now):
+        """Put off the first poll to a fixed offset in the polling interval.
+
+        The offset is picked from the device and OIDSet names so the first
+        polls of all the pollers are spread out over the interval instead of
+        all starting at once, and a poller keeps its place in the interval
+        across restarts."""
+
+        freq = self.oidset.frequency
+        key = ("%s_%s" % (self.device.name, self.oidset.name)).encode('utf-8')
+        offset = (hash_key(key) % (freq * 1000)) / 1000.0
+
+        self.next_poll = now - now % freq + offset
+        if self.next_poll < now:
+            self.next_poll += freq
+
     def run_once(self):
-        if self.time_to_poll():
-            self.log.debug("grabbing data")
-            self.begin_time = time.time()
-            self.next_poll = self.begin_time + self.oidset.frequency
+        """Poll if it is time to.  Returns True if a poll was started."""
+        if not self.time_to_poll():
+            return False
+
+        self.log.debug("grabbing data")
+        self.begin_time = time.time()
+
+        # Keep to the same offset in the interval rather than drifting by
+        # however late this poll is, skip the polls that were missed.
+        freq = self.oidset.frequency
+        self.next_poll += freq
+        if self.next_poll <= self.begin_time:
+            missed = int((self.begin_time - self.next_poll) / freq) + 1
+            self.log.warning("skipping %d polls, %.1f seconds late" %
+                    (missed, self.begin_time - self.next_poll + freq))
+            self.next_poll += missed * freq
 
-            self.begin()
-            self.collect()
+        self.begin()
+        self.collect()
 
-            self.polling_round += 1
+        self.polling_round += 1
+        return True
 
     def begin(self):
         """begin is called immeditately before polling is started.
@@ -686,6 +955,8 @@ class CorrelatedPoller(Poller):
         pass
 
     def finish(self, data):
+        if not isinstance(data, PollData):
+            data = PollData(data)
         self.correlator.setup(data)
 
         ts = time.time()
@@ -735,6 +1006,8 @@ class TranslatedPoller(Poller):
         pass
 
     def finish(self, data):
+        if not isinstance(data, PollData):
+            data = PollData(data)
         self.correlator.setup(data)
         ts = time.time()
         metadata = dict(tsdb_flags=ROW_VALID)
@@ -777,6 +1050,8 @@ class UncorrelatedPoller(Poller):
         pass
 
     def finish(self, data):
+        if not isinstance(data, PollData):
+            data = PollData(data)
         dataout = {}
         for oid in self.oidset.oids.all():
             dataout[oid.name] = filter_data(oid.name, data)
@@ -791,31 +1066,190 @@ class UncorrelatedPoller(Poller):
                         (len(data), time.time() - self.begin_time))
 
 
+class WalkColumn(object):
+    """A column of a bulkwalk: the rows under walk_oid, an OID tuple."""
+
+    def __init__(self, name, walk_oid):
+        self.walk_oid = walk_oid
+        self.last = name
+        self.done = False
+        self.results = []
+
+
 class PollRequest(object):
-    def __init__(self, type, callback, errback, walk_oid=None,
-            additional_oids=[]):
+    """A request in progress.  A bulkwalk walks its columns several at a time,
+    see next_walk()."""
+
+    def __init__(self, type, callback, errback, columns=(), host=None):
         self.type = type
         self.callback = callback
         self.errback = errback
-        self.walk_oid = walk_oid
-        self.additional_oids = additional_oids
-
-        self.results = []
+        self.columns = list(columns)
+        self.active = []
+        self.host = host
+
+        # the time the current GETBULK was sent and its max-repetitions
+        self.sent = None
+        self.repetitions = None
+
+    def next_walk(self, window):
+        """The OIDs to send in the next GETBULK, the last OID seen for up to
+        window of the columns that aren't done.  Empty once they all are."""
+        self.active = [c for c in self.columns if not c.done][:window]
+        return [c.last for c in self.active]
+
+    def add_bulk(self, r):
+        """Add the response to the GETBULK for next_walk().
+
+        The response has the next row of each column in turn, then the row
+        after that and so on.  A column is done at the first OID past its
+        end.  Returns the number of columns that were finished."""
+        n = len(self.active)
+        finished = 0
+        for i, (oid, v) in enumerate(r):
+            column = self.active[i % n]
+            if column.done:
+                continue
+            if oid[:len(column.walk_oid)] != column.walk_oid:
+                column.done = True
+                finished += 1
+                continue
+
+            soid = oid_to_str(oid).split('::')[-1]
+            column.results.append((soid, v))
+            column.last = oid
+
+        return finished
+
+    def results(self):
+        """The rows of all the columns, in the order they were given."""
+        data = PollData()
+        for column in self.columns:
+            data.extend(column.results)
+        return data
+
+
+class SessionTuning(object):
+    """The max-repetitions and timeout learned for polling a device.
+
+    The round trip time is smoothed the way TCP does it (RFC 6298) and the
+    timeout is the smoothed RTT plus four times its variation, kept between
+    min_timeout and max_timeout.  A timeout doubles the timeout until the
+    next response with an RTT.  Like TCP (Karn's rule) the caller passes an
+    RTT of None for a response that may be to a retransmission.
+
+    max-repetitions grows by half while full responses come back in less
+    than a quarter of the timeout.  It drops to what the agent sent back
+    when a response is cut short, as agents do with a GETBULK response that
+    would be too big, and doesn't grow past that number of varbinds after.
+    It is halved on a timeout since a large response that is fragmented on
+    the way back may be what is lost."""
+
+    MIN_REPETITIONS = 5
+    MAX_REPETITIONS = 100
+
+    def __init__(self, maxrepetitions, min_timeout, max_timeout):
+        self.maxrepetitions = maxrepetitions
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout = min_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.max_varbinds = None
+
+    def _clamp_repetitions(self, n):
+        return max(self.MIN_REPETITIONS, min(int(n), self.MAX_REPETITIONS))
+
+    def response(self, rtt, repetitions, columns, received, truncated):
+        """Learn from a response to a GETBULK for repetitions rows of
+        columns columns that had received varbinds, truncated if the agent
+        cut it short."""
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+            self.timeout = max(self.min_timeout, min(
+                int(math.ceil(self.srtt + 4 * self.rttvar)), self.max_timeout))
+
+        if truncated:
+            self.max_varbinds = received
+            self.maxrepetitions = self._clamp_repetitions(received / columns)
+        elif received >= repetitions * columns and rtt is not None and \
+                rtt < self.timeout / 4.0:
+            n = self.maxrepetitions * 1.5
+            if self.max_varbinds:
+                n = min(n, self.max_varbinds / columns)
+            self.maxrepetitions = self._clamp_repetitions(n)
+
+    def timed_out(self):
+        self.maxrepetitions = self._clamp_repetitions(self.maxrepetitions / 2)
+        self.timeout = min(self.timeout * 2, self.max_timeout)
+
+    def to_dict(self):
+        return dict(maxrepetitions=self.maxrepetitions, timeout=self.timeout,
+                srtt=self.srtt, rttvar=self.rttvar,
+                max_varbinds=self.max_varbinds)
+
+    def update(self, d):
+        """Start from the values in d, from to_dict(), within the bounds.
+        Missing values are left alone, raises ValueError or TypeError if a
+        value is bad."""
+        maxrepetitions = self._clamp_repetitions(
+                d.get('maxrepetitions', self.maxrepetitions))
+        timeout = max(self.min_timeout, min(int(d.get('timeout',
+            self.timeout)), self.max_timeout))
+        srtt = d.get('srtt', self.srtt)
+        rttvar = d.get('rttvar', self.rttvar)
+        if srtt is None or rttvar is None:
+            srtt = rttvar = None
+        else:
+            srtt = float(srtt)
+            rttvar = float(rttvar)
+        max_varbinds = d.get('max_varbinds', self.max_varbinds)
+        if max_varbinds is not None:
+            max_varbinds = int(max_varbinds)
 
-    def append(self, oid, value):
-        self.results.append((oid, value))
+        self.maxrepetitions = maxrepetitions
+        self.timeout = timeout
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.max_varbinds = max_varbinds
 
 
 class AsyncSNMPPoller(object):
     """Manage all polling requests and responses.
 
-    AsyncPoller manages all the polling using DLNetSNMP."""
+    AsyncPoller manages all the polling using DLNetSNMP.
+
+    With poll_adaptive on, a SessionTuning is kept for each device and its
+    walks use the learned max-repetitions.  A learned timeout is applied by
+    creating the session again when no requests to it are outstanding."""
+
+    # the timeout is learned between the configured timeout and this many
+    # times it
+    MAX_TIMEOUT_FACTOR = 4
 
     def __init__(self, config=None, name="AsyncSNMPPoller", maxrepetitions=25):
         self.maxrepetitions = maxrepetitions
         self.name = name
         self.config = config
 
+        self.walk_columns = 1
+        self.adaptive = False
+        if self.config:
+            self.walk_columns = max(1, self.config.poll_walk_columns)
+            self.adaptive = self.config.poll_adaptive
+
+        # host -> SessionTuning, learned values not yet applied to a session
+        self.tuning = {}
+        self.learned = {}
+        # host -> (community, version, timeout, retries)
+        self.session_args = {}
+
         self.reqmap = {}
 
         self.sessions = SNMPManager(local_dir="/usr/local/share/snmp",
@@ -838,15 +1272,100 @@ class AsyncSNMPPoller(object):
 
     def add_session(self, host, community, version='2', timeout=2,
             retries=10):
+        if self.adaptive:
+            tuning = SessionTuning(self.maxrepetitions, timeout,
+                    timeout * self.MAX_TIMEOUT_FACTOR)
+            if host in self.learned:
+                tuning.update(self.learned.pop(host))
+            self.tuning[host] = tuning
+            timeout = tuning.timeout
+
+        self._add_session(host, community, version, timeout, retries)
+
+    def _add_session(self, host, community, version, timeout, retries):
         try:
             self.sessions.add_session(host, peername=host, community=community,
                 version=version, timeout=timeout, retries=retries,
                 results_as_list=True)
         except SnmpError, e:
             raise PollerError(str(e))
+        self.session_args[host] = (community, version, timeout, retries)
 
     def remove_session(self, host):
         self.sessions.remove_session(host)
+        self.session_args.pop(host, None)
+        tuning = self.tuning.pop(host, None)
+        if tuning:
+            self.learned[host] = tuning.to_dict()
+
+    def _apply_timeout(self, host):
+        """Create the session for host again if its learned timeout has
+        changed and nothing is waiting on it."""
+        (community, version, timeout, retries) = self.session_args[host]
+        tuning = self.tuning[host]
+        if tuning.timeout == timeout:
+            return
+        for pollreq in self.reqmap.values():
+            if pollreq.host == host:
+                return
+
+        self.log.debug("%s: timeout %d seconds, max-repetitions %d" % (host,
+            tuning.timeout, tuning.maxrepetitions))
+        self.sessions.remove_session(host)
+        self._add_session(host, community, version, tuning.timeout, retries)
+
+    def load_tuning(self, filename):
+        """Start from the values learned for each device in filename, as
+        written by save_tuning()."""
+        try:
+            f = open(filename)
+        except IOError:
+            return
+
+        try:
+            learned = json.load(f)
+        except ValueError, e:
+            self.log.error("ignoring %s: %s" % (filename, e))
+            return
+        finally:
+            f.close()
+
+        if not isinstance(learned, dict):
+            self.log.error("ignoring %s: not a dict" % filename)
+            return
+
+        for host, d in learned.iteritems():
+            # Check the entry before keeping it for add_session().
+            tuning = self.tuning.get(host,
+                    SessionTuning(self.maxrepetitions, 1, 1))
+            try:
+                tuning.update(d)
+            except (AttributeError, TypeError, ValueError), e:
+                self.log.error("%s: ignoring bad entry for %s: %s" % (
+                    filename, host, e))
+                continue
+
+            if host not in self.tuning:
+                self.learned[host] = d
+
+    def save_tuning(self, filename):
+        """Atomically replace filename with the values learned so far."""
+        learned = dict(self.learned)
+        for host, tuning in self.tuning.items():
+            learned[host] = tuning.to_dict()
+
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            json.dump(learned, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def _repetitions(self, host):
+        if host in self.tuning:
+            return self.tuning[host].maxrepetitions
+        return self.maxrepetitions
 
     def shutdown(self):
         self.sessions.destroy()  # BWAHAHAHAH
@@ -857,28 +1376,38 @@ class AsyncSNMPPoller(object):
         A single SNMP GETBULK is not guaranteed to get all the objects
         referred to by the OID in a table.  `bulkwalk` implements a simple
         mechanism for gathering all rows for the given OIDs using GETBULK
-        messages multiple times if necessary."""
+        messages multiple times if necessary.
+
+        Up to walk_columns (poll_walk_columns) of the OIDs are walked at
+        once, each GETBULK asks for the next rows of all of them."""
+
+        if host in self.tuning:
+            self._apply_timeout(host)
 
         try:
             session = self.sessions[host]
         except KeyError:
             raise PollerError("no session defined for %s" % host)
 
-        oids = [str(o) for o in oids]  # make a copy of the oids list
-
-        oid = oids.pop(0)
-        #print "oid >%s<" % (oid)
-        noid = str_to_oid(oid)  # avoid the noid!
-        if noid is None:
-            # XXX tell someone: raise exception?
-            self.log.error("unable to resolve OID: %s" % oid)
+        columns = []
+        for oid in oids:
+            oid = str(oid)
+            noid = str_to_oid(oid)  # avoid the noid!
+            if noid is None:
+                # XXX tell someone: raise exception?
+                self.log.error("unable to resolve OID: %s" % oid)
+                continue
+            columns.append(WalkColumn(oid, tuple(noid)))
+
+        if not columns:
             return
-        noid = tuple(noid)
 
-        pollreq = PollRequest('bulkwalk', callback, errback,
-                walk_oid=noid, additional_oids=oids)
-        reqid = self.sessions[host].async_getbulk(
-                0, self.maxrepetitions, [oid])
+        pollreq = PollRequest('bulkwalk', callback, errback, columns=columns,
+                host=host)
+        pollreq.repetitions = self._repetitions(host)
+        pollreq.sent = time.time()
+        reqid = session.async_getbulk(0, pollreq.repetitions,
+                pollreq.next_walk(self.walk_columns))
         self.reqmap[reqid] = pollreq
 
     def bulkget(self, host, nonrepeaters, maxrepetitions, oids, callback,
@@ -914,34 +1443,33 @@ class AsyncSNMPPoller(object):
             pollreq.callback(r)
             #print "_callback wtf!"
         else:
-            last = ''
-            done = False
-            for last, v in r:
-                if last[:len(pollreq.walk_oid)] != pollreq.walk_oid:
-                    done = True
-                    break
-
-                soid = oid_to_str(last).split('::')[-1]
-                pollreq.results.append((soid, v))
-
-            if done:
-                #print '_callback bulkwalk done', last
-                if pollreq.additional_oids:
-                    #print "MORE", pollreq.additional_oids
-                    oid = pollreq.additional_oids.pop(0)
-                    #print "2>%s<" % oid
-                    pollreq.walk_oid = tuple(str_to_oid(oid))
-                    new_reqid = self.sessions[session].async_getbulk(0,
-                        self.maxrepetitions, [oid])
-                    self.reqmap[new_reqid] = pollreq
-                else:
-                    pollreq.callback(pollreq.results)
-            else:
-                #print '_callback bulkwalk not done', last, oid_to_str(last)
+            columns = len(pollreq.active)
+            finished = pollreq.add_bulk(r)
+
+            tuning = self.tuning.get(pollreq.host)
+            if tuning:
+                # A response that took as long as the timeout may be to a
+                # retry, so its RTT isn't used (Karn's rule).
+                rtt = time.time() - pollreq.sent
+                if rtt >= self.session_args[pollreq.host][2]:
+                    rtt = None
+                # A response that ends a column is short because the
+                # column ran out, otherwise the agent cut it short.
+                tuning.response(rtt,
+                        pollreq.repetitions, columns, len(r),
+                        not finished and
+                            len(r) < pollreq.repetitions * columns)
+
+            oids = pollreq.next_walk(self.walk_columns)
+            if oids:
                 # get more data
+                pollreq.repetitions = self._repetitions(pollreq.host)
+                pollreq.sent = time.time()
                 new_reqid = self.sessions[session].async_getbulk(0,
-                    self.maxrepetitions, [last])
+                    pollreq.repetitions, oids)
                 self.reqmap[new_reqid] = pollreq
+            else:
+                pollreq.callback(pollreq.results())
 
         del self.reqmap[reqid]
 
@@ -950,6 +1478,10 @@ class AsyncSNMPPoller(object):
 
         del self.reqmap[reqid]
 
+        tuning = self.tuning.get(pollreq.host)
+        if tuning:
+            tuning.timed_out()
+
         # XXX look into getting actual error messages
         pollreq.errback("timeout")
 
@@ -1024,11 +1556,18 @@ def espoll():
 
 
 def espolld():
-    """Entry point for espolld."""
+    """Entry point for espolld.
+
+    With poll_processes set to more than 1 espolld is a PollSupervisor that
+    runs that many poller processes, each started with -r poller."""
     argv = sys.argv
     oparse = get_opt_parser(default_config_file=get_config_path())
+    oparse.add_option("-r", "--role", dest="role", default="")
+    oparse.add_option("-n", "--number", dest="number", type="int", default=0)
     (opts, args) = oparse.parse_args(args=argv)
 
+    opts.config_file = os.path.abspath(opts.config_file)
+
     django.setup()
 
     try:
@@ -1037,7 +1576,20 @@ def espolld():
         print e
         sys.exit(1)
 
+    if not opts.role:
+        if config.poll_processes > 1:
+            opts.role = 'supervisor'
+        else:
+            opts.role = 'poller'
+
     name = "espolld"
+    shard = None
+    if opts.role == 'poller' and opts.number:
+        name += ".poller_%d" % opts.number
+        shard = (opts.number, config.poll_processes)
+    elif opts.role not in ('poller', 'supervisor'):
+        print >>sys.stderr, "unknown role: %s" % opts.role
+        sys.exit(1)
 
     init_logging(name, config.syslog_facility, level=config.syslog_priority,
             debug=opts.debug)
@@ -1045,17 +1597,30 @@ def espolld():
 
     setproctitle(name)
 
+    if opts.role == 'supervisor':
+        supervisor = PollSupervisor(name, opts, config)
+
     if not opts.debug:
         exc_handler = setup_exc_handler(name, config)
         exc_handler.install()
 
-        daemonize(name, config.pid_dir,
-                log_stdout_stderr=config.syslog_facility)
+        # the pollers run by a supervisor aren't daemons of their own
+        if not shard:
+            daemonize(name, config.pid_dir,
+                    log_stdout_stderr=config.syslog_facility)
 
     os.umask(0022)
 
+    if opts.role == 'supervisor':
+        try:
+            supervisor.run()
+        except Exception, e:
+            log.error("Problem with supervisor: %s" % e, exc_info=True)
+            sys.exit(1)
+        return
+
     try:
-        poller = PollManager(name, opts, args, config)
+        poller = PollManager(name, opts, args, config, shard=shard)
 
         poller.start_polling()
     except Exception, e:
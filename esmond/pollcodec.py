@@ -0,0 +1,200 @@
+"""
+Compact binary encoding of PollResults for the persist queues.
+
+The JSON encoding repeats the full path of every var in the result.  Most
+results are a list of [path, value] pairs, for those the binary encoding
+stores the data as columns:
+
+    strings   each distinct path fragment once, NUL separated
+    indexes   the index of each path fragment in strings, packed
+    lengths   the length of each path, omitted if every path has two parts
+    values    packed as unsigned, signed or float if they all fit
+
+Any other data is stored as is.  The columns and the rest of the PollResult
+are framed with marshal (format version 2) after a magic/version prefix, so
+the format doesn't depend on the Python version as long as it's 2.x.  The
+packing is done with struct so that almost all of the work is in C.
+Version 2 added the enqueue time, version 1 results are still decoded.
+
+Strings in the data and metadata come back as unicode and tuples as lists,
+just like with JSON, so they compare equal to what's in the database.  decode() also accepts the JSON encoding so that persisters can
+read queues written in either format.
+"""
+
+import json
+import marshal
+import struct
+from itertools import chain, izip
+
+from esmond.error import EsmondError
+
+MAGIC = '\x00EPR'
+VERSION = 2
+PREFIX = MAGIC + chr(VERSION)
+
+MARSHAL_VERSION = 2
+
+FORMATS = ('json', 'binary')
+
+# How the data is stored.
+DATA_RAW = 0
+DATA_VARS = 1
+
+# How the values of var data are stored.
+VALS_RAW = 'r'
+VALS_UINT = 'Q'
+VALS_INT = 'q'
+VALS_FLOAT = 'd'
+
+_int_types = (int, long)
+_path_types = set((list, tuple))
+
+class CodecError(EsmondError):
+    """Unable to encode or decode a PollResult."""
+    pass
+
+def _unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+def _json_shape(obj):
+    """obj as it comes back from JSON: strs decoded and tuples as lists."""
+    t = type(obj)
+    if t is str:
+        return obj.decode('utf-8')
+    if t is list or t is tuple:
+        return [_json_shape(x) for x in obj]
+    if t is dict:
+        return dict((_json_shape(k), _json_shape(v))
+                for k, v in obj.iteritems())
+    return obj
+
+def _pack_vals(vals):
+    fmt = '<%d' % len(vals)
+    types = set(map(type, vals))
+
+    if types <= set(_int_types):
+        for kind in (VALS_UINT, VALS_INT):
+            try:
+                return kind, struct.pack(fmt + kind, *vals)
+            except struct.error:
+                pass
+    elif types == set((float,)):
+        return VALS_FLOAT, struct.pack(fmt + VALS_FLOAT, *vals)
+
+    return VALS_RAW, _json_shape(vals)
+
+def _encode_vars(data):
+    """
+    Returns the columns for data if it is a list of [path, value] pairs
+    where the path is a list of strings, None otherwise.
+    """
+    if not isinstance(data, list) or not data:
+        return None
+
+    try:
+        paths, vals = zip(*data)
+    except (TypeError, ValueError):
+        return None
+
+    if not set(map(type, paths)) <= _path_types:
+        return None
+
+    names = list(chain.from_iterable(paths))
+    table = list(set(names))
+    index = dict(izip(table, xrange(len(table))))
+    indexes = map(index.__getitem__, names)
+
+    # The table is stored as a single NUL separated utf-8 string, which
+    # is a lot faster to encode and decode than a string at a time.
+    try:
+        try:
+            table = '\x00'.join(table)
+        except UnicodeDecodeError:
+            # a mix of unicode and non-ascii str
+            table = '\x00'.join(map(_unicode, table))
+    except TypeError:
+        # not a path
+        return None
+    if table.count('\x00') != len(index) - 1:
+        return None
+    if isinstance(table, unicode):
+        table = table.encode('utf-8')
+
+    lengths = map(len, paths)
+    if lengths.count(2) == len(lengths):
+        lengths = None
+    else:
+        lengths = struct.pack('<%dH' % len(lengths), *lengths)
+
+    return (table, struct.pack('<%dI' % len(indexes), *indexes), lengths) + \
+            _pack_vals(vals)
+
+def _decode_vars(columns):
+    table, indexes, lengths, kind, vals = columns
+
+    table = table.decode('utf-8').split(u'\x00')
+    indexes = struct.unpack('<%dI' % (len(indexes) / 4), indexes)
+    names = [table[i] for i in indexes]
+
+    if lengths is None:
+        it = iter(names)
+        paths = [[a, b] for a, b in izip(it, it)]
+    else:
+        paths = []
+        offset = 0
+        for l in struct.unpack('<%dH' % (len(lengths) / 2), lengths):
+            paths.append(names[offset:offset+l])
+            offset += l
+
+    if kind != VALS_RAW:
+        vals = struct.unpack('<%d%s' % (len(vals) / 8, kind), vals)
+
+    return [[p, v] for p, v in izip(paths, vals)]
+
+def encode(result):
+    """Return the binary encoding of a PollResult."""
+
+    try:
+        columns = _encode_vars(result.data)
+        if columns is None:
+            data = (DATA_RAW, _json_shape(result.data))
+        else:
+            data = (DATA_VARS, columns)
+
+        return PREFIX + marshal.dumps((_unicode(result.oidset_name),
+            _unicode(result.device_name), _unicode(result.oid_name),
+            result.timestamp, _json_shape(result.metadata),
+            getattr(result, 'enqueue_ts', None)) + data, MARSHAL_VERSION)
+    except ValueError, e:
+        raise CodecError("unable to encode %s: %s" % (result, e))
+
+def decode(data):
+    """
+    Decode a PollResult encoded with encode() or as JSON and return a dict
+    of PollResult() keyword arguments.
+    """
+
+    if not data.startswith(MAGIC):
+        return json.loads(data)
+
+    version = ord(data[len(MAGIC)])
+    if version not in (1, VERSION):
+        raise CodecError("unsupported version %d" % version)
+
+    try:
+        fields = marshal.loads(data[len(PREFIX):])
+        if version == 1:
+            fields = fields[:5] + (None,) + fields[5:]
+        oidset_name, device_name, oid_name, timestamp, metadata, \
+            enqueue_ts, kind, data = fields
+
+        if kind == DATA_VARS:
+            data = _decode_vars(data)
+    except (EOFError, ValueError, TypeError, IndexError, struct.error), e:
+        raise CodecError("corrupt poll result: %s" % e)
+
+    return dict(oidset_name=oidset_name, device_name=device_name,
+            oid_name=oid_name, timestamp=timestamp, data=data,
+            metadata=metadata, enqueue_ts=enqueue_ts)
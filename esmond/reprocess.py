@@ -0,0 +1,342 @@
+"""
+Rebuild the base rates and rollups of an OIDSet from the raw data.
+
+esreprocess replays the counter values stored in raw_data through the same
+aggregate_base_rate() and generate_aggregations() code that espersistd
+uses and writes the result over what is in base_rates, rate_aggregations
+and stat_aggregations.  Use it after fixing an aggregation bug or adding an
+aggregate frequency to an OIDSet::
+
+    $ esreprocess -f esmond.conf -b 2013-01-01 -e 2014-01-01 FastPollHC
+
+The work is split into tasks of one path (one raw_data row per year) and a
+window of time.  The windows line up with the largest aggregation so that
+every bin is computed from all of its data by one task, and each task
+starts from the last raw value before its window just like a persister
+would.  The tasks are run by a pool of processes, each with its own
+CASSANDRA_DB.
+
+Counter columns can't be overwritten, so a task reads the bins that are
+there and adds the difference from the replayed value.  Bins in the window
+that the raw data doesn't account for are zeroed (removed for the stat
+aggregations).  Running the same reprocessing again changes nothing.  The
+range should end before the data the persisters are currently writing.
+"""
+
+import calendar
+import json
+import multiprocessing
+import sys
+import time
+
+import django
+
+from esmond.api import SNMP_NAMESPACE
+from esmond.api.models import OIDSet
+from esmond.cassandra import CASSANDRA_DB, RawRateData, AggregationBin, \
+        Metadata, SEEK_BACK_THRESHOLD, _split_rowkey
+from esmond.config import get_opt_parser, get_config, get_config_path
+from esmond.error import ConfigError
+from esmond.persist import CassandraPollPersister, HEARTBEAT_FREQ_MULTIPLIER
+from esmond.util import get_logger, init_logging
+
+# Length in seconds of the windows the work is split into, rounded up to a
+# multiple of the largest aggregation.
+WINDOW = 7 * 86400
+
+class ReplayDB(object):
+    """
+    Stands in for CASSANDRA_DB while samples are replayed.  The metadata is
+    kept in memory and the bins are summed up instead of being written.
+    """
+
+    def __init__(self):
+        self.metadata_cache = {}
+        # row key -> {jstime: {column: value}}
+        self.rates = {}
+        self.aggs = {}
+        self.stats = {}
+
+    def get_metadata(self, raw_data):
+        k = raw_data.get_meta_key()
+        if k not in self.metadata_cache:
+            meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
+                    min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
+            self.metadata_cache[k] = meta_d.get_document()
+            return meta_d
+
+        return Metadata(**self.metadata_cache[k])
+
+    def update_metadata(self, k, metadata):
+        for i in ['last_val', 'min_ts', 'last_update']:
+            self.metadata_cache[k][i] = getattr(metadata, i)
+
+    def _add(self, rows, key, ts, vals):
+        cols = rows.setdefault(key, {}).setdefault(ts, {})
+        for k, v in vals.iteritems():
+            cols[k] = cols.get(k, 0) + v
+
+    def _agg(self, raw_data, agg_ts, freq):
+        return AggregationBin(ts=agg_ts, freq=freq, val=raw_data.val,
+                base_freq=raw_data.freq, count=1, min=raw_data.val,
+                max=raw_data.val, path=raw_data.path)
+
+    def update_rate_bin(self, ratebin):
+        self._add(self.rates, ratebin.get_key(), ratebin.ts_to_jstime(),
+                {'val': ratebin.val, 'is_valid': ratebin.is_valid})
+
+    def update_rate_aggregation(self, raw_data, agg_ts, freq):
+        agg = self._agg(raw_data, agg_ts, freq)
+        self._add(self.aggs, agg.get_key(), agg.ts_to_jstime(),
+                {'val': agg.val, str(agg.base_freq): 1})
+
+    def update_stat_aggregation(self, raw_data, agg_ts, freq):
+        # Same as CASSANDRA_DB.update_stat_aggregation() for a bin that
+        # is started from scratch.
+        agg = self._agg(raw_data, agg_ts, freq)
+        bins = self.stats.setdefault(agg.get_key(), {})
+        ts = raw_data.ts_to_jstime()
+
+        stat = bins.get(agg.ts_to_jstime())
+        if stat is None:
+            bins[agg.ts_to_jstime()] = {'min': agg.val, 'max': agg.val,
+                    'min_ts': ts, 'max_ts': ts}
+        elif agg.val > stat['max']:
+            stat['max'] = agg.val
+            stat['max_ts'] = ts
+        elif agg.val < stat['min']:
+            stat['min'] = agg.val
+            stat['min_ts'] = ts
+
+class ReplayPersister(CassandraPollPersister):
+    """A CassandraPollPersister that writes to a ReplayDB."""
+
+    def __init__(self, log):
+        self.log = log
+        self.db = ReplayDB()
+
+def windows(begin, end, aggregates):
+    """
+    Split the time from begin to end (Unix timestamps) into windows that
+    line up with the largest of aggregates.  Yields (start, end) pairs of
+    JavaScript timestamps.
+    """
+    step = max(aggregates or [1])
+    window = (WINDOW + step - 1) / step * step
+
+    begin -= begin % step
+    if end % step:
+        end += step - end % step
+
+    for t in xrange(begin, end, window):
+        yield t * 1000, min(t + window, end) * 1000
+
+def find_paths(db, set_name, oid_names, freq, devices=None):
+    """
+    Return the paths in raw_data for the oids in oid_names of set_name
+    polled every freq ms, only for the given devices if there are any.
+    """
+    paths = set()
+    freq = str(freq)
+
+    for key, cols in db.raw_data._column_family.get_range(column_count=0,
+            filter_empty=False):
+        parts = _split_rowkey(key)
+        # namespace, device, set name, oid, var..., freq, year
+        if len(parts) < 6 or parts[0] != SNMP_NAMESPACE or \
+                parts[2] != set_name or parts[3] not in oid_names or \
+                parts[-2] != freq:
+            continue
+        if devices and parts[1] not in devices:
+            continue
+        paths.add(tuple(parts[:-2]))
+
+    return sorted(paths)
+
+def _write_bins(batcher, rows, keys, start, end, counters):
+    """
+    Make the bins from start up to end in the rows given by keys the same
+    as the replayed ones in rows.
+    """
+    for key in keys:
+        have = dict(batcher._column_family.xget(key, column_start=start,
+            column_finish=end - 1))
+
+        for ts, cols in rows.get(key, {}).iteritems():
+            if not start <= ts < end:
+                continue
+
+            old = have.pop(ts, {})
+            if counters:
+                diff = dict((c, v - old.get(c, 0)) for c, v in cols.iteritems())
+                for c, v in old.iteritems():
+                    if c not in cols:
+                        diff[c] = -v
+                diff = dict((c, v) for c, v in diff.iteritems() if v)
+                if diff:
+                    batcher.insert(key, {ts: diff})
+            elif cols != dict(old):
+                batcher.insert(key, {ts: cols})
+
+        for ts, old in have.iteritems():
+            if counters:
+                diff = dict((c, -v) for c, v in old.iteritems() if v)
+                if diff:
+                    batcher.insert(key, {ts: diff})
+            else:
+                batcher.remove(key, super_column=ts)
+
+def reprocess_window(db, path, freq, aggregates, start, end, log):
+    """
+    Replay the raw data for path (polled every freq ms) and write the base
+    rates and the aggregations (a list of frequencies in seconds) from
+    start up to end, JavaScript timestamps.  Returns the number of values
+    replayed.
+    """
+    persister = ReplayPersister(log)
+    raw = db.raw_data._column_family
+    path = list(path)
+    n = 0
+
+    def replay(ts, val):
+        data = RawRateData(path=path, ts=ts, val=json.loads(val), freq=freq)
+        delta_v = persister.aggregate_base_rate(data)
+        if delta_v is not None:
+            data.val = delta_v
+            persister.generate_aggregations(data, aggregates)
+
+    # The last value before the window, as the persister would have found
+    # it in the metadata cache.
+    ret = raw.multiget(db._get_row_keys(path, freq,
+                start - SEEK_BACK_THRESHOLD, start - 1),
+            column_start=start - 1, column_finish=start - SEEK_BACK_THRESHOLD,
+            column_count=1, column_reversed=True)
+    if ret:
+        replay(*ret[ret.keys()[-1]].items()[0])
+
+    for key in db._get_row_keys(path, freq, start, end - 1):
+        for ts, val in raw.xget(key, column_start=start, column_finish=end - 1):
+            replay(ts, val)
+            n += 1
+
+    # The first value after the window has a share of its delta in the
+    # last bins of the window.
+    after = end + freq * HEARTBEAT_FREQ_MULTIPLIER
+    ret = raw.multiget(db._get_row_keys(path, freq, end, after),
+            column_start=end, column_finish=after, column_count=1)
+    if ret:
+        replay(*ret[ret.keys()[0]].items()[0])
+
+    replayed = persister.db
+    _write_bins(db.rates, replayed.rates,
+            db._get_row_keys(path, freq, start, end - 1), start, end, True)
+    for agg in aggregates:
+        keys = db._get_row_keys(path, agg * 1000, start, end - 1)
+        _write_bins(db.aggs, replayed.aggs, keys, start, end, True)
+        _write_bins(db.stat_agg, replayed.stats, keys, start, end, False)
+
+    return n
+
+# The CASSANDRA_DB of a pool process.
+_db = None
+
+def _init_worker(config_file):
+    global _db
+    _db = CASSANDRA_DB(get_config(config_file), qname='reprocess')
+
+def _run_task(task):
+    path, freq, aggregates, start, end = task
+    n = reprocess_window(_db, path, freq, aggregates, start, end,
+            get_logger('esreprocess'))
+    _db.flush()
+    return n
+
+def _parse_time(s):
+    """A Unix timestamp or a YYYY-MM-DD date (UTC)."""
+    try:
+        return int(s)
+    except ValueError:
+        return calendar.timegm(time.strptime(s, '%Y-%m-%d'))
+
+def esreprocess():
+    """Entry point for esreprocess."""
+    django.setup()
+
+    argv = sys.argv
+    oparse = get_opt_parser(default_config_file=get_config_path())
+    oparse.usage = "%prog [options] oidset [device ...]"
+    oparse.add_option("-b", "--begin", dest="begin", default=None,
+            help="start of the range, a Unix timestamp or YYYY-MM-DD")
+    oparse.add_option("-e", "--end", dest="end", default=None,
+            help="end of the range (default: the start of today, UTC)")
+    oparse.add_option("-j", "--jobs", dest="jobs", type="int",
+            default=multiprocessing.cpu_count(),
+            help="number of processes (default: %default)")
+    (opts, args) = oparse.parse_args(args=argv)
+
+    if len(args) < 2:
+        oparse.error("requires an oidset argument")
+    if not opts.begin:
+        oparse.error("requires --begin")
+
+    oidset_name = args[1]
+    devices = set(args[2:])
+
+    try:
+        begin = _parse_time(opts.begin)
+        if opts.end:
+            end = _parse_time(opts.end)
+        else:
+            end = int(time.time())
+            end -= end % 86400
+    except ValueError, e:
+        oparse.error("bad time: %s" % e)
+
+    try:
+        config = get_config(opts.config_file, opts)
+    except ConfigError, e:
+        print >>sys.stderr, e
+        sys.exit(1)
+
+    init_logging("esreprocess", config.syslog_facility,
+            level=config.syslog_priority, debug=opts.debug)
+
+    try:
+        oidset = OIDSet.objects.get(name=oidset_name)
+    except OIDSet.DoesNotExist:
+        print >>sys.stderr, "error: unknown OIDSet: %s" % oidset_name
+        sys.exit(1)
+
+    poller_args = {}
+    if oidset.poller_args:
+        poller_args = dict(arg.split('=') for arg in oidset.poller_args.split())
+    set_name = poller_args.get('set_name', oidset.name)
+    oid_names = set(oid.name for oid in oidset.oids.all() if oid.aggregate)
+    freq = oidset.frequency_ms
+    aggregates = list(oidset.aggregates or [])
+
+    db = CASSANDRA_DB(config, qname='reprocess')
+    paths = find_paths(db, set_name, oid_names, freq, devices)
+    # The pool processes are forked, they each open their own connections.
+    db.close()
+
+    tasks = [(path, freq, aggregates, start, stop)
+            for path in paths
+            for start, stop in windows(begin, end, aggregates)]
+
+    print "%d paths, %d tasks" % (len(paths), len(tasks))
+
+    pool = multiprocessing.Pool(opts.jobs, _init_worker, (opts.config_file,))
+    t0 = time.time()
+    done = 0
+    values = 0
+
+    for n in pool.imap_unordered(_run_task, tasks, chunksize=16):
+        done += 1
+        values += n
+        if done % 1000 == 0 or done == len(tasks):
+            print "%d/%d tasks, %d values, %.0f values/sec" % (done,
+                    len(tasks), values, values / (time.time() - t0))
+
+    pool.close()
+    pool.join()
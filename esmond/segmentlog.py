@@ -0,0 +1,325 @@
+"""
+A durable queue made of append-only, memory mapped segment files.
+
+Each queue is a directory holding::
+
+    head                 write position: segment, offset, next sequence number
+    offset               read position: segment, offset, next sequence number
+    lock                 flock()ed by writers while appending
+    <seq>.log            segment files, named after their first sequence number
+    spare.<seq>          finished segments kept around to be reused
+
+Segments are preallocated to a fixed size and written through a shared mmap.
+Every record is a header (payload length, crc32 of the payload, sequence
+number) followed by the payload.  The payload is written before the header,
+so a header with the expected sequence number means the record is complete.
+Recycled segments still contain old records but those have older sequence
+numbers so they are never mistaken for new data.  When a record doesn't fit
+in the current segment the writer starts a new one and leaves a marker
+record pointing the reader at it.
+
+There can be any number of writers but only one reader per queue.  The
+reader's position is committed to the offset file explicitly, so anything
+read but not committed is read again after a crash.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import zlib
+
+from esmond.error import EsmondError
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_SPARE_SEGMENTS = 2
+
+RECORD = struct.Struct('<IIQ')
+POSITION = struct.Struct('<QQQ')
+
+NEXT_SEGMENT = 0xffffffff
+
+class SegmentLogError(EsmondError):
+    """Unable to use a segment log."""
+    pass
+
+class _Position(object):
+    """A (segment, offset, seq) triple kept in a small mmaped file."""
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            # Sequence numbers start at 1 so that the zeros in a new 
+            # segment don't look like a record.  link() so that only one
+            # process initializes the file.
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            f = open(tmp, 'wb')
+            try:
+                f.write(POSITION.pack(0, 0, 1))
+            finally:
+                f.close()
+            try:
+                os.link(tmp, filename)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.unlink(tmp)
+
+        fd = os.open(filename, os.O_RDWR)
+        try:
+            self.m = mmap.mmap(fd, POSITION.size)
+        finally:
+            os.close(fd)
+
+    def get(self):
+        return POSITION.unpack_from(self.m, 0)
+
+    def set(self, segment, offset, seq):
+        POSITION.pack_into(self.m, 0, segment, offset, seq)
+
+    def close(self):
+        self.m.close()
+
+class SegmentLog(object):
+    """
+    One queue directory.  Writers call append(), the reader calls read()
+    and then commit() once it is done with what it has read.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise SegmentLogError("unable to create %s: %s" %
+                        (directory, e))
+
+        self.head = _Position(os.path.join(directory, 'head'))
+        self.offset = _Position(os.path.join(directory, 'offset'))
+
+        self.lock_fd = None
+
+        # Segment currently mapped by the writer and the reader.
+        self.wseg = None
+        self.wmap = None
+        self.rseg = None
+        self.rmap = None
+
+        self.read_pos = None
+        self.finished = []
+
+        # Records that were skipped because their checksum was bad.
+        self.corrupt = 0
+
+    def _segment_file(self, seg):
+        return os.path.join(self.directory, '%020d.log' % seg)
+
+    def _map(self, seg, access):
+        try:
+            f = open(self._segment_file(seg), 'r+b')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return mmap.mmap(f.fileno(), 0, access=access)
+        finally:
+            f.close()
+
+    def __len__(self):
+        n = self.head.get()[2] - self.offset.get()[2]
+        if n < 0:
+            n = 0
+        return n
+
+    @property
+    def last_added(self):
+        return self.head.get()[2]
+
+    @property
+    def last_read(self):
+        return self.offset.get()[2]
+
+    # Writer
+
+    def _new_segment(self, seg, size):
+        """
+        Create the segment file for seg, reusing a spare segment if there
+        is one.  The file is set up under a temporary name and renamed
+        into place so the reader never maps a partial file.
+        """
+        tmp = os.path.join(self.directory, 'new.%d' % os.getpid())
+
+        for name in os.listdir(self.directory):
+            if name.startswith('spare.'):
+                try:
+                    os.rename(os.path.join(self.directory, name), tmp)
+                    break
+                except OSError:
+                    continue
+
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        os.rename(tmp, self._segment_file(seg))
+
+    def _writer_map(self, seg):
+        if self.wseg != seg:
+            if self.wmap:
+                self.wmap.close()
+            self.wmap = self._map(seg, mmap.ACCESS_WRITE)
+            if self.wmap is None:
+                self._new_segment(seg, self.segment_size)
+                self.wmap = self._map(seg, mmap.ACCESS_WRITE)
+            self.wseg = seg
+        return self.wmap
+
+    def append(self, payloads):
+        """Append a list of strings to the log."""
+
+        if self.lock_fd is None:
+            self.lock_fd = os.open(os.path.join(self.directory, 'lock'),
+                    os.O_RDWR | os.O_CREAT, 0644)
+
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            seg, off, seq = self.head.get()
+            m = self._writer_map(seg)
+
+            # A writer may have died after writing records but before
+            # updating the head, skip over anything already there.
+            while True:
+                length, crc, rseq = RECORD.unpack_from(m, off)
+                if rseq != seq:
+                    break
+                if length == NEXT_SEGMENT:
+                    seg, off = seq, 0
+                    m = self._writer_map(seg)
+                else:
+                    off += RECORD.size + length
+                    seq += 1
+
+            for payload in payloads:
+                need = RECORD.size + len(payload)
+                if off + need + RECORD.size > len(m):
+                    self._new_segment(seq, max(self.segment_size,
+                        need + RECORD.size))
+                    RECORD.pack_into(m, off, NEXT_SEGMENT, 0, seq)
+                    m.flush()
+                    seg, off = seq, 0
+                    m = self._writer_map(seg)
+
+                m[off+RECORD.size:off+need] = payload
+                RECORD.pack_into(m, off, len(payload),
+                        zlib.crc32(payload) & 0xffffffff, seq)
+                off += need
+                seq += 1
+
+            self.head.set(seg, off, seq)
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    # Reader
+
+    def read(self, n=1):
+        """
+        Return a list of up to n payloads that follow the last ones
+        returned.  Nothing is committed until commit() is called.
+        """
+        if self.read_pos is None:
+            self.read_pos = self.offset.get()
+
+        seg, off, seq = self.read_pos
+        vals = []
+
+        while len(vals) < n:
+            if self.rseg != seg:
+                if self.rmap:
+                    self.rmap.close()
+                self.rmap = self._map(seg, mmap.ACCESS_READ)
+                self.rseg = seg
+            m = self.rmap
+            if m is None or off + RECORD.size > len(m):
+                break
+
+            length, crc, rseq = RECORD.unpack_from(m, off)
+            if rseq != seq:
+                break
+
+            if length == NEXT_SEGMENT:
+                self.finished.append(seg)
+                seg, off = seq, 0
+                continue
+
+            payload = m[off+RECORD.size:off+RECORD.size+length]
+            off += RECORD.size + length
+            seq += 1
+
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                self.corrupt += 1
+                continue
+
+            vals.append(payload)
+
+        self.read_pos = (seg, off, seq)
+
+        return vals
+
+    def commit(self, pos=None):
+        """
+        Record that everything returned by read() (or everything before
+        pos, a read_pos saved earlier) has been dealt with and recycle the
+        segments the reader has finished with.
+        """
+        if pos is None:
+            pos = self.read_pos
+        if pos is None:
+            return
+
+        self.offset.set(*pos)
+
+        # Segments are named after their first sequence number.
+        done = [seg for seg in self.finished if seg < pos[0]]
+        for seg in done:
+            if self.rseg == seg:
+                self.rmap.close()
+                self.rseg = self.rmap = None
+            spares = [n for n in os.listdir(self.directory)
+                        if n.startswith('spare.')]
+            try:
+                if len(spares) < MAX_SPARE_SEGMENTS:
+                    os.rename(self._segment_file(seg),
+                            os.path.join(self.directory, 'spare.%d' % seg))
+                else:
+                    os.unlink(self._segment_file(seg))
+            except OSError:
+                pass
+
+        self.finished = [seg for seg in self.finished if seg >= pos[0]]
+
+    def sync(self):
+        """Flush the mapped files to disk."""
+        for m in (self.wmap, self.head.m, self.offset.m):
+            if m:
+                m.flush()
+
+    def close(self):
+        self.commit()
+        self.sync()
+        for m in (self.wmap, self.rmap):
+            if m:
+                m.close()
+        self.wmap = self.rmap = None
+        self.wseg = self.rseg = None
+        self.head.close()
+        self.offset.close()
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
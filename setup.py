@@ -25,6 +25,7 @@ setup(
             'espoll = esmond.poll:espoll',
             'espersistd = esmond.persist:espersistd',
             'espersistq = esmond.persist:espersistq',
+            'esreprocess = esmond.reprocess:esreprocess',
             'esfetch = esmond.fetch:esfetch',
             'esdbd = esmond.newdb:esdb_standalone',
             'gen_ma_storefile = esmond.perfsonar:gen_ma_storefile',
@@ -316,10 +316,12 @@ def main():
                     
             print "Sending request to delete %d rows for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s" % (len(expired_data), md_key, et.event_type, et.summary_type, et.summary_window)
             try:
-                cf.send()
+                cf.send(wait=True)
             except Exception as e:
                 sys.stderr.write("Error sending delete: {0}".format(e))
             print "Deleted %d rows for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s" % (len(expired_data), md_key, et.event_type, et.summary_type, et.summary_window)
+    
+    db.close()
         
     #Clean out metadata from relational database
     for md_key in metadata_counts: